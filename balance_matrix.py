@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+
+# Final balances of one investment horizon as a dense matrix with one row per strategy and one column per starting month.
+# All strategies share the same starting months, so the dates and the labels are only stored once, and percentiles,
+# slices by starting month and comparisons between strategies are computed on the matrix without grouping rows.
+class BalanceMatrix:
+
+    first_dates: np.ndarray
+    strategy_labels: list[str]
+    final_balances: np.ndarray
+
+    def __init__(self, first_dates: np.ndarray, strategy_labels: list[str], final_balances: np.ndarray) -> None:
+        self.first_dates = np.asarray(first_dates).astype('datetime64[ns]')
+        self.strategy_labels = list(strategy_labels)
+        self.final_balances = np.asarray(final_balances, dtype=float).reshape(len(self.strategy_labels), self.first_dates.shape[0])
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        strategy_count, start_count = self.final_balances.shape
+        return strategy_count, start_count
+
+    @property
+    def nbytes(self) -> int:
+        return self.first_dates.nbytes + self.final_balances.nbytes
+
+    def get_strategy_index(self, investment_strategy_label: str) -> int:
+        return self.strategy_labels.index(investment_strategy_label)
+
+    def get_strategy_balances(self, investment_strategy_label: str) -> np.ndarray:
+        return self.final_balances[self.get_strategy_index(investment_strategy_label)]
+
+    # Starting months after the given date.
+    def get_starts_after(self, start_date) -> 'BalanceMatrix':
+        first_index = np.searchsorted(self.first_dates, np.datetime64(start_date), side='right')
+        return BalanceMatrix(self.first_dates[first_index:], self.strategy_labels, self.final_balances[:, first_index:])
+
+    def get_starts_between(self, start_date, end_date) -> 'BalanceMatrix':
+        first_index = np.searchsorted(self.first_dates, np.datetime64(start_date), side='left')
+        last_index = np.searchsorted(self.first_dates, np.datetime64(end_date), side='right')
+        return BalanceMatrix(self.first_dates[first_index:last_index], self.strategy_labels, self.final_balances[:, first_index:last_index])
+
+    # One row per strategy and one column per percent.
+    def get_percentiles(self, percents: list[float]) -> np.ndarray:
+        return np.percentile(self.final_balances, percents, axis=1).T
+
+    def get_sorted_balances(self) -> np.ndarray:
+        return np.sort(self.final_balances, axis=1)
+
+    # Share of starting months in which each strategy ended with a higher balance than the given one.
+    def get_share_above(self, investment_strategy_label: str) -> np.ndarray:
+        return (self.final_balances > self.get_strategy_balances(investment_strategy_label)).mean(axis=1)
+
+    def get_ratios_to(self, investment_strategy_label: str) -> np.ndarray:
+        return self.final_balances / self.get_strategy_balances(investment_strategy_label)
+
+    # The long format with one row per strategy and starting month, ordered by strategy.
+    def to_data_frame(self) -> pd.DataFrame:
+        strategy_count, start_count = self.shape
+        return pd.DataFrame({
+            'first_date': np.tile(self.first_dates, strategy_count),
+            'final_balance': self.final_balances.ravel(),
+            'investment_strategy': pd.Categorical.from_codes(
+                np.repeat(np.arange(strategy_count, dtype=np.int16), start_count), categories=self.strategy_labels),
+        })
+
+    def write_csv(self, path: str) -> None:
+        self.to_data_frame().to_csv(path)
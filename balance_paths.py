@@ -0,0 +1,112 @@
+import json
+import numpy as np
+import pandas as pd
+
+# Titles of the metrics computed by get_risk_metrics.
+risk_metrics = dict(
+    max_drawdown_percent='Max drawdown, %',
+    worst_year_percent='Worst year, %',
+    real_cagr_percent='Real CAGR, %',
+    years_under_water='Longest time under water, years',
+)
+
+default_band_percents = (10, 50, 90)
+
+
+# Returns of every year of (..., years + 1) arrays of inflation adjusted yearly balances, without the contributions of the year,
+# which are annual_contributions in the money of the first month. Contributions made during the year are counted as made at its end.
+# A year that starts without money has no return.
+def get_yearly_returns(yearly_balances: np.ndarray, annual_contributions: float) -> np.ndarray:
+    previous_balances = yearly_balances[..., :-1]
+    return np.divide(
+        yearly_balances[..., 1:] - annual_contributions, previous_balances,
+        out=np.ones(previous_balances.shape), where=previous_balances > 0)
+
+
+# Drawdowns, the time under water and the CAGR are those of the growth of the invested money, i.e. of the product of the yearly returns,
+# so that contributions don't hide losses. All metrics are computed for all simulations at once from yearly balances.
+def get_risk_metrics(yearly_balances: np.ndarray, annual_contributions: float) -> dict[str, np.ndarray]:
+    yearly_returns = get_yearly_returns(np.asarray(yearly_balances, dtype=float), annual_contributions)
+    years = yearly_returns.shape[-1]
+    growth = np.concatenate([np.ones(yearly_returns.shape[:-1] + (1,)), np.cumprod(yearly_returns, axis=-1)], axis=-1)
+    peaks = np.maximum.accumulate(growth, axis=-1)
+    year_indices = np.arange(years + 1)
+    last_peak_years = np.maximum.accumulate(np.where(growth < peaks, 0, year_indices), axis=-1)
+    return dict(
+        max_drawdown_percent=(1 - growth / peaks).max(axis=-1) * 100,
+        worst_year_percent=(yearly_returns.min(axis=-1) - 1) * 100,
+        real_cagr_percent=(growth[..., -1] ** (1 / years) - 1) * 100,
+        years_under_water=(year_indices - last_peak_years).max(axis=-1).astype(float),
+    )
+
+
+# Inflation adjusted balances at the start of every year of every simulation of one investment horizon, as a float32
+# (strategy, starting month, year) array. The array is memory-mapped from path.balances.npy, so neither writing nor reading
+# the paths of a full run has to fit into memory. The starting months and the strategy labels are stored next to it.
+class BalancePaths:
+
+    first_dates: np.ndarray
+    strategy_labels: list[str]
+    balances: np.ndarray
+
+    def __init__(self, first_dates: np.ndarray, strategy_labels: list[str], balances: np.ndarray) -> None:
+        self.first_dates = np.asarray(first_dates).astype('datetime64[ns]')
+        self.strategy_labels = list(strategy_labels)
+        self.balances = balances
+
+    @staticmethod
+    def create(path: str, first_dates: np.ndarray, strategy_labels: list[str], investment_years: int) -> 'BalancePaths':
+        first_dates = np.asarray(first_dates).astype('datetime64[ns]')
+        np.save(f'{path}.first_dates.npy', first_dates)
+        with open(f'{path}.json', 'w', encoding='utf-8') as labels_file:
+            json.dump(dict(strategy_labels=list(strategy_labels)), labels_file)
+        balances = np.lib.format.open_memmap(
+            f'{path}.balances.npy', mode='w+', dtype=np.float32, shape=(len(strategy_labels), first_dates.shape[0], investment_years + 1))
+        return BalancePaths(first_dates, strategy_labels, balances)
+
+    @staticmethod
+    def open(path: str) -> 'BalancePaths':
+        with open(f'{path}.json', encoding='utf-8') as labels_file:
+            strategy_labels = json.load(labels_file)['strategy_labels']
+        return BalancePaths(np.load(f'{path}.first_dates.npy'), strategy_labels, np.load(f'{path}.balances.npy', mmap_mode='r'))
+
+    @property
+    def investment_years(self) -> int:
+        return self.balances.shape[2] - 1
+
+    def close(self) -> None:
+        if isinstance(self.balances, np.memmap) and self.balances.mode != 'r':
+            self.balances.flush()
+
+    def __enter__(self) -> 'BalancePaths':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    # Metrics are computed one strategy at a time, so only the paths of one strategy are read into memory.
+    # Every metric is a (strategy, starting month) array.
+    def get_risk_metrics(self, annual_contributions: float) -> dict[str, np.ndarray]:
+        strategy_metrics = [get_risk_metrics(strategy_balances, annual_contributions) for strategy_balances in self.balances]
+        return {
+            metric: np.array([metrics[metric] for metrics in strategy_metrics]).reshape(len(self.strategy_labels), self.first_dates.shape[0])
+            for metric in risk_metrics
+        }
+
+    # Percentiles of the balance in every year over the starting months, as a (strategy, percent, year) array.
+    def get_percentile_bands(self, percents=default_band_percents) -> np.ndarray:
+        if not self.first_dates.shape[0]:
+            return np.full((len(self.strategy_labels), len(percents), self.investment_years + 1), np.nan)
+        return np.array([
+            np.percentile(np.asarray(strategy_balances, dtype=float), percents, axis=0) for strategy_balances in self.balances
+        ]).reshape(len(self.strategy_labels), len(percents), self.investment_years + 1)
+
+    # The long format with one row per strategy and starting month, ordered by strategy.
+    def get_risk_metrics_data_frame(self, annual_contributions: float) -> pd.DataFrame:
+        strategy_count, start_count = len(self.strategy_labels), self.first_dates.shape[0]
+        return pd.DataFrame({
+            'first_date': np.tile(self.first_dates, strategy_count),
+            'investment_strategy': pd.Categorical.from_codes(
+                np.repeat(np.arange(strategy_count, dtype=np.int16), start_count), categories=self.strategy_labels),
+            **{metric: values.ravel() for metric, values in self.get_risk_metrics(annual_contributions).items()},
+        })
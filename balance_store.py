@@ -0,0 +1,165 @@
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from typing import Iterator
+
+from balance_matrix import BalanceMatrix
+
+default_chunk_rows = 65536
+
+
+# Streams final balances to an Arrow IPC file in record batches of chunk_rows rows, so that only one chunk is kept in memory.
+# The key column holds start dates as int64 nanoseconds or path numbers, and the strategy is stored as an index into
+# the list of strategy labels instead of repeating the label in every row.
+class BalanceWriter:
+
+    chunk_rows: int
+    rows: int
+    _schema: pa.Schema
+    _dictionary: pa.Array
+    _writer: pa.ipc.RecordBatchFileWriter
+    _pending: list[tuple[np.ndarray, np.ndarray, np.ndarray]]
+    _pending_rows: int
+
+    def __init__(self, path: str, strategy_labels: list[str], key_column: str = 'first_date', chunk_rows: int = default_chunk_rows) -> None:
+        self.chunk_rows = chunk_rows
+        self.rows = 0
+        self._schema = pa.schema(
+            [
+                (key_column, pa.int64()),
+                ('final_balance', pa.float64()),
+                ('investment_strategy', pa.dictionary(pa.int16(), pa.string())),
+            ],
+            metadata=dict(strategy_labels=json.dumps(list(strategy_labels))))
+        self._dictionary = pa.array(list(strategy_labels), type=pa.string())
+        self._writer = pa.ipc.new_file(path, self._schema)
+        self._pending = []
+        self._pending_rows = 0
+
+    def write(self, strategy_index: int, keys: np.ndarray, final_balances: np.ndarray) -> None:
+        keys = np.asarray(keys)
+        if np.issubdtype(keys.dtype, np.datetime64):
+            keys = keys.astype('datetime64[ns]').view(np.int64)
+        self._pending.append((
+            keys.astype(np.int64, copy=False),
+            np.asarray(final_balances, dtype=float),
+            np.full(keys.shape[0], strategy_index, dtype=np.int16)))
+        self._pending_rows += keys.shape[0]
+        while self._pending_rows >= self.chunk_rows:
+            self._flush(self.chunk_rows)
+
+    def close(self) -> None:
+        if self._pending_rows:
+            self._flush(self._pending_rows)
+        self._writer.close()
+
+    def __enter__(self) -> 'BalanceWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _flush(self, rows: int) -> None:
+        keys, final_balances, strategy_indices = (np.concatenate(column) for column in zip(*self._pending))
+        self._writer.write_batch(pa.record_batch(
+            [
+                pa.array(keys[:rows]),
+                pa.array(final_balances[:rows]),
+                pa.DictionaryArray.from_arrays(pa.array(strategy_indices[:rows]), self._dictionary),
+            ],
+            schema=self._schema))
+        self.rows += rows
+        self._pending = [(keys[rows:], final_balances[rows:], strategy_indices[rows:])] if rows < keys.shape[0] else []
+        self._pending_rows -= rows
+
+
+# Reads a file written by BalanceWriter through a memory map, one strategy or one chunk at a time.
+class BalanceReader:
+
+    key_column: str
+    strategy_labels: list[str]
+    _source: pa.MemoryMappedFile
+    _reader: pa.ipc.RecordBatchFileReader
+
+    def __init__(self, path: str) -> None:
+        self._source = pa.memory_map(path, 'r')
+        self._reader = pa.ipc.open_file(self._source)
+        self.key_column = self._reader.schema.field(0).name
+        self.strategy_labels = json.loads(self._reader.schema.metadata[b'strategy_labels'])
+
+    def close(self) -> None:
+        self._source.close()
+
+    def __enter__(self) -> 'BalanceReader':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def get_strategy_balances(self, strategy_index: int) -> tuple[np.ndarray, np.ndarray]:
+        keys = []
+        final_balances = []
+        for batch_index in range(self._reader.num_record_batches):
+            batch = self._reader.get_batch(batch_index)
+            selected = batch.column(2).indices.to_numpy() == strategy_index
+            if selected.any():
+                keys.append(batch.column(0).to_numpy()[selected])
+                final_balances.append(batch.column(1).to_numpy()[selected])
+        keys_array = np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64)
+        if self.key_column == 'first_date':
+            keys_array = keys_array.view('datetime64[ns]')
+        return keys_array, np.concatenate(final_balances) if final_balances else np.zeros(0)
+
+    def iter_strategy_balances(self) -> Iterator[tuple[str, np.ndarray, np.ndarray]]:
+        for strategy_index, investment_strategy_label in enumerate(self.strategy_labels):
+            keys, final_balances = self.get_strategy_balances(strategy_index)
+            yield investment_strategy_label, keys, final_balances
+
+    def iter_data_frames(self) -> Iterator[pd.DataFrame]:
+        for batch_index in range(self._reader.num_record_batches):
+            batch = self._reader.get_batch(batch_index)
+            keys = batch.column(0).to_numpy()
+            yield pd.DataFrame({
+                self.key_column: keys.view('datetime64[ns]') if self.key_column == 'first_date' else keys,
+                'final_balance': batch.column(1).to_numpy(),
+                'investment_strategy': pd.Categorical.from_codes(batch.column(2).indices.to_numpy(), categories=self.strategy_labels),
+            })
+
+    def to_data_frame(self) -> pd.DataFrame:
+        data_frames = list(self.iter_data_frames())
+        if not data_frames:
+            return pd.DataFrame({
+                self.key_column: np.zeros(0, dtype='datetime64[ns]' if self.key_column == 'first_date' else np.int64),
+                'final_balance': np.zeros(0),
+                'investment_strategy': pd.Categorical([], categories=self.strategy_labels),
+            })
+        return pd.concat(data_frames, ignore_index=True)
+
+    # Every strategy has to have been written with the same starting months in the same order, as gather_all_balances does.
+    def to_matrix(self) -> BalanceMatrix:
+        if self.key_column != 'first_date':
+            raise ValueError(f'balances keyed by {self.key_column} have no starting months')
+        batches = [self._reader.get_batch(batch_index) for batch_index in range(self._reader.num_record_batches)]
+        if not batches:
+            return BalanceMatrix(np.zeros(0, dtype='datetime64[ns]'), self.strategy_labels, np.zeros((len(self.strategy_labels), 0)))
+        keys, final_balances, strategy_indices = (
+            np.concatenate([batch.column(0).to_numpy() for batch in batches]),
+            np.concatenate([batch.column(1).to_numpy() for batch in batches]),
+            np.concatenate([batch.column(2).indices.to_numpy() for batch in batches]))
+        order = np.argsort(strategy_indices, kind='stable')
+        start_count = keys.shape[0] // len(self.strategy_labels)
+        if start_count * len(self.strategy_labels) != keys.shape[0]:
+            raise ValueError('strategies have different numbers of starting months')
+        return BalanceMatrix(keys[order[:start_count]].view('datetime64[ns]'), self.strategy_labels, final_balances[order])
+
+    def write_csv(self, path: str) -> None:
+        rows = 0
+        with open(path, 'w', newline='') as csv_file:
+            for data_frame in self.iter_data_frames():
+                data_frame.index = pd.RangeIndex(rows, rows + data_frame.shape[0])
+                data_frame.to_csv(csv_file, header=rows == 0)
+                rows += data_frame.shape[0]
+            if not rows:
+                self.to_data_frame().to_csv(csv_file)
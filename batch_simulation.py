@@ -0,0 +1,253 @@
+import numpy as np
+
+from typing import Sequence
+
+from instrumentation import instrumentation
+from invesment_strategies import *
+from market_data import MarketData, as_market_data
+from simulation import SimulationRunner, get_skip_rows
+
+# Final balances of the batch engine match SimulationRunner.run_simulation up to this relative error.
+# The only differences are the order of floating point additions, e.g. bonds bought in the same period
+# are kept in a single ladder slot instead of two separate Bond objects.
+BATCH_RELATIVE_TOLERANCE = 1e-12
+
+
+class BatchSimulationRunner(SimulationRunner):
+
+    def run_simulations(self, data, skip_rows, investment_years: int, investment_strategy: InvestmentStrategy) -> list[dict]:
+        return self.run_many_simulations(data, skip_rows, investment_years, [investment_strategy])[0]
+
+    def run_many_simulations(self, data, skip_rows, investment_years: int, investment_strategies: Sequence[InvestmentStrategy]) -> list[list[dict]]:
+        first_dates = as_market_data(data).timestamps[np.asarray(skip_rows, dtype=np.int64)].tolist()
+        return [
+            [
+                dict(first_date=first_date, final_balance=final_balance)
+                for first_date, final_balance in zip(first_dates, final_balances)
+            ]
+            for _, final_balances in self.simulate_many(data, skip_rows, investment_years, investment_strategies)
+        ]
+
+    def simulate(self, data, skip_rows, investment_years: int, investment_strategy: InvestmentStrategy):
+        return self.simulate_many(data, skip_rows, investment_years, [investment_strategy])[0]
+
+    def simulate_many(self, data, skip_rows, investment_years: int, investment_strategies: Sequence[InvestmentStrategy]) -> list[tuple[np.ndarray, np.ndarray]]:
+
+        market_data = as_market_data(data)
+        first_dates = market_data.dates[np.asarray(skip_rows, dtype=np.int64)].astype('datetime64[ns]')
+
+        batch_strategies = [investment_strategy for investment_strategy in investment_strategies if investment_strategy.supports_batch]
+        if batch_strategies:
+            periodic_data = self._get_periodic_data(market_data, skip_rows, investment_years)
+            batch_balances = iter(self.simulate_paths_many(periodic_data, investment_years, batch_strategies))
+
+        simulations = []
+        for investment_strategy in investment_strategies:
+            if investment_strategy.supports_batch:
+                final_balances = next(batch_balances)
+            else:
+                final_balances = np.array([
+                    self.run_simulation(market_data, i, investment_years, investment_strategy)['final_balance']
+                    for i in skip_rows
+                ])
+            simulations.append((first_dates, final_balances))
+
+        return simulations
+
+    def simulate_yearly_balances(self, data, skip_rows, investment_years: int, investment_strategies: Sequence[InvestmentStrategy]) -> list[np.ndarray]:
+
+        market_data = as_market_data(data)
+
+        batch_strategies = [investment_strategy for investment_strategy in investment_strategies if investment_strategy.supports_batch]
+        if batch_strategies:
+            periodic_data = self._get_periodic_data(market_data, skip_rows, investment_years)
+            batch_balances = iter(self.simulate_paths_many_periods(
+                periodic_data, list(range(0, investment_years * self.periods_per_year + 1, self.periods_per_year)), batch_strategies))
+
+        return [
+            next(batch_balances).T if investment_strategy.supports_batch
+            else super().simulate_yearly_balances(market_data, skip_rows, investment_years, [investment_strategy])[0]
+            for investment_strategy in investment_strategies
+        ]
+
+    # Horizon independent strategies are simulated once per starting month, to the longest horizon that fits into the data after it,
+    # and the balances of shorter horizons are recorded on the way. Other strategies are simulated for every horizon separately.
+    def simulate_horizons(
+        self, data, start_from: int, investment_years_options: list[int],
+        investment_strategies: Sequence[InvestmentStrategy]) -> dict[int, list[tuple[np.ndarray, np.ndarray]]]:
+
+        market_data = as_market_data(data)
+        fan_out = [investment_strategy.horizon_independent and investment_strategy.supports_batch for investment_strategy in investment_strategies]
+        fan_out_strategies = [investment_strategy for investment_strategy, is_fan_out in zip(investment_strategies, fan_out) if is_fan_out]
+        separate_simulations = super().simulate_horizons(
+            market_data, start_from, investment_years_options,
+            [investment_strategy for investment_strategy, is_fan_out in zip(investment_strategies, fan_out) if not is_fan_out])
+
+        # Starting months of a longer horizon are the first starting months of every shorter one,
+        # so each segment of starting months is simulated to the longest horizon it belongs to.
+        segments = []
+        first_start = 0
+        for investment_years in sorted(set(investment_years_options), reverse=True):
+            skip_rows = get_skip_rows(len(market_data), start_from, investment_years)[first_start:]
+            if not fan_out_strategies or not len(skip_rows):
+                continue
+            recorded_years = sorted(set(years for years in investment_years_options if years <= investment_years))
+            segments.append((recorded_years, self.simulate_paths_many_horizons(
+                self._get_periodic_data(market_data, skip_rows, investment_years), recorded_years, fan_out_strategies)))
+            first_start = skip_rows.stop
+
+        simulations = {}
+        for investment_years in investment_years_options:
+            first_dates = market_data.dates[np.asarray(get_skip_rows(len(market_data), start_from, investment_years), dtype=np.int64)]
+            fan_out_balances = iter([
+                np.concatenate(
+                    [balances[strategy_index][recorded_years.index(investment_years)] for recorded_years, balances in segments
+                     if investment_years in recorded_years] + [np.zeros(0)])
+                for strategy_index in range(len(fan_out_strategies))
+            ])
+            separate_balances = iter(separate_simulations[investment_years])
+            simulations[investment_years] = [
+                (first_dates.astype('datetime64[ns]'), next(fan_out_balances)) if is_fan_out else next(separate_balances)
+                for is_fan_out in fan_out
+            ]
+
+        return simulations
+
+    def simulate_paths_many(self, market_data: MarketData, investment_years: int, investment_strategies: Sequence[InvestmentStrategy]) -> list[np.ndarray]:
+        return [balances[0] for balances in self.simulate_paths_many_horizons(market_data, [investment_years], investment_strategies)]
+
+    def simulate_paths_many_horizons(
+        self, market_data: MarketData, investment_years_options: list[int], investment_strategies: Sequence[InvestmentStrategy]) -> list[np.ndarray]:
+        for investment_strategy in investment_strategies:
+            check_horizons(investment_years_options, investment_strategy)
+        return self.simulate_paths_many_periods(
+            market_data, [investment_years * self.periods_per_year for investment_years in investment_years_options], investment_strategies)
+
+    # Strategies with the same stack key are run together, each over its own copy of the market data columns,
+    # so that adding such a strategy doesn't add work done in Python per simulated period.
+    def simulate_paths_many_periods(
+        self, market_data: MarketData, recorded_periods: list[int], investment_strategies: Sequence[InvestmentStrategy]) -> list[np.ndarray]:
+
+        groups: dict = {}
+        for strategy_index, investment_strategy in enumerate(investment_strategies):
+            stack_key = investment_strategy.stack_key
+            groups.setdefault(strategy_index if stack_key is None else stack_key, []).append(strategy_index)
+
+        size = market_data.days.shape[1]
+        final_balances: list = [None] * len(investment_strategies)
+        for strategy_indices in groups.values():
+            if len(strategy_indices) == 1:
+                final_balances[strategy_indices[0]] = self.simulate_paths_periods(
+                    market_data, recorded_periods, investment_strategies[strategy_indices[0]])
+                continue
+            group_strategies = [investment_strategies[strategy_index] for strategy_index in strategy_indices]
+            stacked_strategy = type(group_strategies[0]).stack(group_strategies, size)
+            stacked_balances = self.simulate_paths_periods(
+                market_data.tile(len(group_strategies)), recorded_periods, stacked_strategy
+            ).reshape(len(recorded_periods), len(group_strategies), size)
+            for group_index, strategy_index in enumerate(strategy_indices):
+                final_balances[strategy_index] = stacked_balances[:, group_index]
+
+        return final_balances
+
+    def simulate_paths(self, market_data: MarketData, investment_years: int, investment_strategy: InvestmentStrategy) -> np.ndarray:
+        return self.simulate_paths_horizons(market_data, [investment_years], investment_strategy)[0]
+
+    # Returns the inflation adjusted balances at the end of every horizon as a (horizons, paths) array.
+    def simulate_paths_horizons(self, market_data: MarketData, investment_years_options: list[int], investment_strategy: InvestmentStrategy) -> np.ndarray:
+        check_horizons(investment_years_options, investment_strategy)
+        return self.simulate_paths_periods(
+            market_data, [investment_years * self.periods_per_year for investment_years in investment_years_options], investment_strategy)
+
+    # Runs the strategy over market data that is already laid out as (periods + 1, paths) arrays of values at the start of every period,
+    # either consecutive periods of the historical data or synthetic paths. The strategy invests for the last of the recorded periods.
+    # Returns the inflation adjusted balances after every recorded period as a (recorded periods, paths) array.
+    def simulate_paths_periods(self, market_data: MarketData, recorded_periods: list[int], investment_strategy: InvestmentStrategy) -> np.ndarray:
+
+        if not investment_strategy.supports_batch:
+            raise Exception(f'{type(investment_strategy).__name__} does not implement execute_batch')
+
+        size = market_data.days.shape[1]
+        if instrumentation.enabled:
+            instrumentation.count('simulations', size)
+        days = market_data.days
+        cpi = market_data.cpi
+        sp500_index = market_data.sp500_index
+        sp500_dividend = market_data.sp500_dividend
+        vbmfx_price = market_data.vbmfx_price
+        vbmfx_dividend = market_data.vbmfx_dividend
+        bonds_10y_rate_percent = market_data.bonds_10y_rate_percent
+
+        portfolio = BatchPortfolio(np.zeros(size) + self.initial_balance, self.asset_configs, self.periods_per_year, self.capital_gains_tax_rate_percent)
+        period_count = max(recorded_periods)
+        final_balances = np.empty((len(recorded_periods), size))
+
+        for period_index in range(period_count + 1):
+
+            this_date = BatchDates(period_index, days[period_index])
+
+            asset_results = BatchAssetResults(
+                size,
+                sp500=BatchAssetResult(sp500_index[period_index], sp500_dividend[period_index]),
+                vbmfx=BatchAssetResult(vbmfx_price[period_index], vbmfx_dividend[period_index]),
+                tb10y=BatchAssetResult(np.full(size, 100.0), bonds_10y_rate_percent[period_index])
+            )
+
+            if period_index == 0:
+                investment_strategy.start_investing_batch(this_date, portfolio, asset_results)
+            else:
+                self._collect_dividends_and_pay_devidend_taxes(this_date, portfolio, asset_results)
+                self._collect_maturity(this_date, portfolio)
+                self._pay_all_fees(portfolio)
+                portfolio.cash += self.annual_contributions / self.periods_per_year * cpi[period_index] / cpi[0]
+                investment_strategy.execute_batch(this_date, period_index, period_count, portfolio, asset_results)
+
+            for recorded_index, recorded_period in enumerate(recorded_periods):
+                if recorded_period == period_index:
+                    final_balances[recorded_index] = self._summarize(this_date, portfolio, asset_results) * cpi[0] / cpi[period_index]
+
+        return final_balances
+
+    def _get_periodic_data(self, market_data: MarketData, skip_rows, investment_years: int) -> MarketData:
+        periodic_data = market_data.periodic_batch(skip_rows, investment_years, self.months_per_period)
+
+        months = periodic_data.dates.astype('datetime64[M]').astype(np.int64) % 12
+        mismatched = (months - months[0]) % self.months_per_period != 0
+        if mismatched.any():
+            period_index, column = np.argwhere(mismatched)[0]
+            raise Exception(
+                f'Current month ({periodic_data.dates[period_index, column]}) is not a whole number of periods after the first month '
+                f'({periodic_data.dates[0, column]})')
+
+        return periodic_data
+
+    # Batch portfolios and results are dicts keyed by asset labels rather than lists of assets.
+    def _collect_dividends_and_pay_devidend_taxes(self, this_date, portfolio, results) -> None:
+        for label, position in portfolio.items():
+            dividends = position.get_dividends(results[label]) / self.periods_per_year
+            dividends_post_tax = dividends * (100 - self.dividend_tax_rate_percent) / 100
+            portfolio.cash += dividends_post_tax
+            if self.asset_configs[label].accumulate_dividens:
+                portfolio.buy(this_date, label, dividends_post_tax, results)
+
+    def _collect_maturity(self, this_date, portfolio) -> None:
+        for position in portfolio.values():
+            maturity = position.get_maturity(this_date)
+            if maturity is not None:
+                portfolio.cash += maturity
+
+    def _pay_all_fees(self, portfolio) -> None:
+        for position in portfolio.values():
+            position.pay_fees()
+
+    @staticmethod
+    def _summarize(this_date, portfolio, results):
+        balance = 0.0
+        for label, position in portfolio.items():
+            balance += position.get_value(this_date, results[label])
+        return balance
+
+
+def check_horizons(investment_years_options: list[int], investment_strategy: InvestmentStrategy) -> None:
+    if len(set(investment_years_options)) > 1 and not investment_strategy.horizon_independent:
+        raise Exception(f'{type(investment_strategy).__name__} depends on the investment horizon and has to be simulated for every horizon separately')
@@ -0,0 +1,167 @@
+import altair as alt
+import argparse
+import contextlib
+import functools
+import io
+import json
+import numpy as np
+import os
+import parameters
+import platform
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+from typing import Callable
+
+from invesment_strategies import InvestmentStrategy
+from market_data import as_market_data, get_data
+from prepare_charts import gather_all_balances, gather_balances, get_returns_charts, get_start_date_options, save_charts, simulation_runners
+from result_cache import ResultCache
+from simulation import SimulationRunner, get_skip_rows
+
+default_baseline_path = 'benchmark_baseline.json'
+default_threshold_percent = 20
+measurements = ('seconds', 'peak_memory_bytes')
+
+
+def get_benchmarks(simulation_engine: str, charts_dir: str) -> list[tuple[str, Callable[[], object]]]:
+
+    p = parameters.parameters
+    investment_strategies = p['investment_strategies']
+    investment_years_options = p['investment_years_options']
+    runner_arguments = (p['initial_balance'], p['annual_contributions'], p['dividend_tax_rate_percent'], p['asset_configs'])
+
+    data = get_data(p['daily_sampling'])
+    market_data = as_market_data(data)
+
+    benchmarks: list[tuple[str, Callable[[], object]]] = [('get_data', lambda: get_data(p['daily_sampling']))]
+
+    # The last starting month of the longest horizon has data for every asset.
+    simulation_runner = SimulationRunner(*runner_arguments, p['period'], p['capital_gains_tax_rate_percent'])
+    investment_years = max(investment_years_options)
+    skip_rows = get_skip_rows(len(market_data), 0, investment_years)[-1]
+    strategy_classes: dict[str, InvestmentStrategy] = {}
+    for investment_strategy, _ in investment_strategies:
+        strategy_classes.setdefault(type(investment_strategy).__name__, investment_strategy)
+    for strategy_class_name, investment_strategy in strategy_classes.items():
+        benchmarks.append((
+            f'run_simulation {strategy_class_name}',
+            functools.partial(simulation_runner.run_simulation, market_data, skip_rows, investment_years, investment_strategy)))
+
+    def run_gather_balances(investment_years: int):
+        return gather_balances(
+            market_data, investment_strategies, 0, investment_years, *runner_arguments, simulation_engine=simulation_engine, period=p['period'],
+            capital_gains_tax_rate_percent=p['capital_gains_tax_rate_percent'])
+
+    for investment_years in investment_years_options:
+        benchmarks.append((
+            f'gather_balances {investment_years}y {simulation_engine}',
+            functools.partial(run_gather_balances, investment_years)))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        balances_paths = gather_all_balances(
+            market_data, investment_strategies, 0, investment_years_options, simulation_runners[simulation_engine](*runner_arguments, p['period'], p['capital_gains_tax_rate_percent']), 1,
+            ResultCache(os.path.join(charts_dir, 'results')), os.path.join(charts_dir, 'balance_{investment_years}y.arrow'))
+    start_date_options = get_start_date_options(market_data, p['skip_time_percent_options'])
+
+    def build_and_save_charts():
+        selection = alt.selection_multi(bind='legend', fields=['investment_strategy'])
+        charts = get_returns_charts(
+            balances_paths, start_date_options, investment_years_options, p['chart_points'], p['chart_data_dir'], selection)
+        save_charts(charts, 'benchmark', os.path.join(charts_dir, 'returns.html'))
+
+    benchmarks.append(('save_charts returns.html', build_and_save_charts))
+
+    return benchmarks
+
+
+# Time is the best of several repeats, each long enough to not be dominated by the timer resolution.
+# Peak memory is measured in a separate run, since tracing allocations slows the code down.
+def measure(function: Callable[[], object], repeat: int) -> dict:
+    with contextlib.redirect_stdout(io.StringIO()):
+        timer = timeit.Timer(function)
+        number, _ = timer.autorange()
+        seconds = min(timer.repeat(repeat, number)) / number
+        tracemalloc.start()
+        try:
+            function()
+            _, peak_memory_bytes = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return dict(seconds=seconds, ops_per_second=1 / seconds, peak_memory_bytes=peak_memory_bytes)
+
+
+def get_environment() -> dict:
+    return dict(python=platform.python_version(), numpy=np.__version__, machine=platform.machine(), processor=platform.processor())
+
+
+def get_regressions(results: dict, baseline: dict, threshold_percent: float) -> list[str]:
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for measurement in measurements:
+            if result[measurement] > baseline[name][measurement] * (1 + threshold_percent / 100):
+                regressions.append(
+                    f'{name}: {measurement} {result[measurement]:.6g} is more than {threshold_percent}% above the baseline {baseline[name][measurement]:.6g}')
+    return regressions
+
+
+def run_benchmarks(baseline_path: str, save: bool, threshold_percent: float, repeat: int, name_filter: str, simulation_engine: str) -> bool:
+
+    baseline = None
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['environment'] != get_environment():
+            print(f'warning: the baseline was recorded in a different environment: {baseline["environment"]}')
+
+    # The cached results and the charts of the benchmarks are written to a temporary directory, which is removed afterwards.
+    results = {}
+    with tempfile.TemporaryDirectory() as charts_dir:
+        print('preparing benchmarks')
+        with contextlib.redirect_stdout(io.StringIO()):
+            benchmarks = get_benchmarks(simulation_engine, charts_dir)
+
+        for name, function in benchmarks:
+            if name_filter not in name:
+                continue
+            results[name] = measure(function, repeat)
+            change = ''
+            if baseline is not None and name in baseline['results']:
+                change = f' ({results[name]["seconds"] / baseline["results"][name]["seconds"] * 100 - 100:+.1f}% time)'
+            print(
+                f'{name:60s} {results[name]["ops_per_second"]:12.3f} ops/s {results[name]["seconds"] * 1000:12.3f} ms '
+                f'{results[name]["peak_memory_bytes"] / 2 ** 20:10.3f} MiB peak{change}')
+
+    if save:
+        if baseline is not None:
+            results = {**baseline['results'], **results}
+        with open(baseline_path, 'w') as baseline_file:
+            json.dump(dict(environment=get_environment(), results=results), baseline_file, indent=2)
+        print(f'saved the baseline to {baseline_path}')
+        return True
+
+    if baseline is None:
+        print(f'no baseline at {baseline_path}, run with --save to record one')
+        return True
+
+    regressions = get_regressions(results, baseline['results'], threshold_percent)
+    for regression in regressions:
+        print(f'regression: {regression}')
+    return not regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time data ingestion, simulations and chart rendering and compare them with a baseline.')
+    parser.add_argument('--baseline', default=default_baseline_path)
+    parser.add_argument('--save', action='store_true', help='record the results as the new baseline instead of comparing with it')
+    parser.add_argument('--threshold-percent', type=float, default=default_threshold_percent)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--filter', default='', help='only run benchmarks with names containing this text')
+    parser.add_argument('--simulation-engine', default=parameters.parameters['simulation_engine'])
+    arguments = parser.parse_args()
+    sys.exit(0 if run_benchmarks(
+        arguments.baseline, arguments.save, arguments.threshold_percent, arguments.repeat, arguments.filter, arguments.simulation_engine) else 1)
@@ -0,0 +1,86 @@
+import contextlib
+import json
+import time
+
+from typing import Iterator, Optional
+
+
+# Collects wall clock time per phase and counts of events in the simulation code. It is off by default:
+# hot paths only check `instrumentation.enabled` before counting anything, so a normal run pays almost nothing for it.
+# Events are counted in the current process only, so runs with several workers only count what the main process does.
+class Instrumentation:
+
+    enabled: bool
+    phases: dict[str, float]
+    counters: dict[str, int]
+    peaks: dict[str, int]
+    strategies: dict[str, dict]
+    _strategy: Optional[dict]
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.reset()
+
+    def reset(self) -> None:
+        self.phases = {}
+        self.counters = {}
+        self.peaks = {}
+        self.strategies = {}
+        self._strategy = None
+
+    def enable(self) -> None:
+        self.reset()
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + amount
+        if self._strategy is not None:
+            self._strategy['counters'][name] = self._strategy['counters'].get(name, 0) + amount
+
+    def peak(self, name: str, value: int) -> None:
+        self.peaks[name] = max(self.peaks.get(name, value), value)
+        if self._strategy is not None:
+            self._strategy['peaks'][name] = max(self._strategy['peaks'].get(name, value), value)
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+    # Time and events within the block are also added to the totals of the given strategy.
+    @contextlib.contextmanager
+    def strategy(self, label: str) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        previous_strategy = self._strategy
+        self._strategy = self.strategies.setdefault(label, dict(seconds=0.0, counters={}, peaks={}))
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._strategy['seconds'] += time.perf_counter() - start
+            self._strategy = previous_strategy
+
+    def get_report(self) -> dict:
+        return dict(
+            phases_seconds=self.phases,
+            counters=self.counters,
+            peaks=self.peaks,
+            strategies=self.strategies)
+
+    def write_report(self, path: str) -> None:
+        with open(path, 'w') as report_file:
+            json.dump(self.get_report(), report_file, indent=2)
+
+
+instrumentation = Instrumentation()
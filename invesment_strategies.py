@@ -1,23 +1,45 @@
+import heapq
 import math
+import numpy as np
 import numpy_financial as npf
 
+from collections import deque
 from datetime import datetime, timedelta
-from typing import List, Optional
+from typing import Callable, Optional
+
+from instrumentation import instrumentation
 
 cash = 'cash'
 sp500 = 'sp500'
 vbmfx = 'vbmfx'
 tb10y = 'tb10y'
 
+# Portfolios and asset results keep the assets in lists in this order, looked up by label only for strategies.
+assets = (cash, sp500, vbmfx, tb10y)
+asset_indices = {asset: asset_index for asset_index, asset in enumerate(assets)}
+cash_index = asset_indices[cash]
+sp500_index = asset_indices[sp500]
+vbmfx_index = asset_indices[vbmfx]
+tb10y_index = asset_indices[tb10y]
+
+
+# Tax lots of an asset are sold oldest first or with the highest cost basis per share first.
+fifo = 'fifo'
+hifo = 'hifo'
+
 
 class AssetConfig:
 
     fees_percent: float
     accumulate_dividens: bool
+    lot_selection: str
 
-    def __init__(self, fees_percent: float, accumulate_dividens: bool):
+    def __init__(self, fees_percent: float, accumulate_dividens: bool, lot_selection: str = fifo):
+        if lot_selection not in (fifo, hifo):
+            raise ValueError(f'Unknown lot selection {lot_selection}')
         self.fees_percent = fees_percent
         self.accumulate_dividens = accumulate_dividens
+        self.lot_selection = lot_selection
 
 
 class AssetConfigs(dict[str, AssetConfig]):
@@ -29,27 +51,66 @@ class AssetConfigs(dict[str, AssetConfig]):
 
 class AssetResult:
 
+    __slots__ = ('price', 'dividends', 'is_empty')
+
     price: float
     dividends: float
+    is_empty: bool
 
     def __init__(self, price: float, dividends: float) -> None:
+        self.set(price, dividends)
+
+    def set(self, price: float, dividends: float) -> None:
         self.price = price
         self.dividends = dividends
+        self.is_empty = math.isnan(price) or math.isnan(dividends)
 
-    @property
-    def is_empty(self):
-        return math.isnan(self.price) or math.isnan(self.dividends)
 
+# Results of all assets in a period, one AssetResult per asset index. Assets without data are empty.
+# The simulation fills the same results in place every period, so strategies must not keep them from one period to the next.
+# Results can be read by label like the dict they used to be.
+class AssetResults:
+
+    __slots__ = ('results',)
 
-class AssetResults(dict[str, AssetResult]):
+    results: list[AssetResult]
 
     def __init__(self, **kwargs) -> None:
-        kwargs.update({cash: AssetResult(1, 0)})
-        super().__init__(kwargs)
+        self.results = [AssetResult(math.nan, math.nan) for _ in assets]
+        self.results[cash_index].set(1, 0)
+        for label, result in kwargs.items():
+            self.results[asset_indices[label]] = result
+
+    def __getitem__(self, label: str) -> AssetResult:
+        return self.results[asset_indices[label]]
+
+    def get(self, label: str, default=None) -> Optional[AssetResult]:
+        asset_index = asset_indices.get(label)
+        return default if asset_index is None else self.results[asset_index]
+
+    def __contains__(self, label) -> bool:
+        return label in asset_indices
+
+    def __iter__(self):
+        return iter(assets)
+
+    def __len__(self) -> int:
+        return len(assets)
+
+    def keys(self):
+        return assets
+
+    def values(self) -> list[AssetResult]:
+        return self.results
+
+    def items(self):
+        return zip(assets, self.results)
 
 
 class Position:
 
+    __slots__ = ()
+
     def get_dividends(self, result: Optional[AssetResult]) -> float:
         raise NotImplementedError('pay_dividends')
 
@@ -62,7 +123,8 @@ class Position:
     def buy(self, this_date: datetime, value: float, result: AssetResult) -> None:
         raise NotImplementedError('buy')
 
-    def sell(self, this_date: datetime, value: float, result: AssetResult) -> None:
+    # Returns the capital gain realized by the sale, if the position keeps the cost basis.
+    def sell(self, this_date: datetime, value: float, result: AssetResult) -> Optional[float]:
         raise NotImplementedError('sell')
 
     def pay_fees(self) -> None:
@@ -71,6 +133,8 @@ class Position:
 
 class CashPosition(Position):
 
+    __slots__ = ('count',)
+
     count: float
 
     def __init__(self, count: float):
@@ -98,14 +162,51 @@ class CashPosition(Position):
         pass
 
 
+# Shares bought in the same period, with the price paid for them. Fees are paid in shares of every lot, so instead of updating
+# every lot each period, lots keep units, which are shares divided by the fee_scale of their position.
+class TaxLot:
+
+    __slots__ = ('lot_id', 'date', 'units', 'cost_basis')
+
+    lot_id: int
+    date: datetime
+    units: float
+    cost_basis: float
+
+    def __init__(self, lot_id: int, date: datetime, units: float, cost_basis: float) -> None:
+        self.lot_id = lot_id
+        self.date = date
+        self.units = units
+        self.cost_basis = cost_basis
+
+
+# Lots are sold in the order of the lot selection of the asset, kept in a deque for fifo and in a heap for hifo, or one by one
+# by id with sell_lot. Lots sold out of order are removed from lots and skipped when they reach the front of the deque or the heap,
+# so a sale takes amortized constant or logarithmic time in the number of lots instead of a scan of all of them.
 class EquityPosition(Position):
 
+    __slots__ = ('count', 'fees_percent', 'periods_per_year', 'lot_selection', 'lots', 'fee_scale', '_fifo_lots', '_hifo_lots', '_last_lot', '_next_lot_id')
+
     count: float
     fees_percent: float
+    periods_per_year: int
+    lot_selection: str
+    lots: dict[int, TaxLot]
+    # The share of a share bought at the start that is left after the fees paid since then.
+    fee_scale: float
 
-    def __init__(self, count: float, fees_percent: float):
+    def __init__(self, count: float, fees_percent: float, periods_per_year: int = 1, lot_selection: str = fifo):
         self.count = count
         self.fees_percent = fees_percent
+        self.periods_per_year = periods_per_year
+        self.lot_selection = lot_selection
+        self.lots = {}
+        self.fee_scale = 1.0
+        # Only the one of the lot selection is used. Lots in the heap are ordered by the negated cost basis per unit, then by id.
+        self._fifo_lots: deque[TaxLot] = deque()
+        self._hifo_lots: list[tuple[float, int, TaxLot]] = []
+        self._last_lot: Optional[TaxLot] = None
+        self._next_lot_id = 0
 
     def get_dividends(self, result: Optional[AssetResult]) -> float:
         if not result or result.is_empty:
@@ -125,14 +226,73 @@ class EquityPosition(Position):
     def buy(self, this_date: datetime, value: float, result: AssetResult) -> None:
         assert value >= 0
         self.count += value / result.price
+        if not value:
+            return
+        units = value / result.price / self.fee_scale
+        lot = self._last_lot
+        if lot is not None and lot.date == this_date and lot.units:
+            lot.units += units
+            lot.cost_basis += value
+            return
+        lot = TaxLot(self._next_lot_id, this_date, units, value)
+        self._next_lot_id += 1
+        self.lots[lot.lot_id] = lot
+        self._last_lot = lot
+        if self.lot_selection == fifo:
+            self._fifo_lots.append(lot)
+        else:
+            heapq.heappush(self._hifo_lots, (-value / units, lot.lot_id, lot))
 
-    def sell(self, this_date: datetime, value: float, result: AssetResult) -> None:
+    def sell(self, this_date: datetime, value: float, result: AssetResult) -> float:
         assert value >= 0
         self.count -= value / result.price
         assert self.count >= -0.000001
+        units = value / result.price / self.fee_scale
+        capital_gain = 0.0
+        while units > 0 and self.lots:
+            lot = self._get_next_lot()
+            sold_units = min(units, lot.units)
+            capital_gain += self._sell_units(lot, sold_units, result.price)
+            units -= sold_units
+        return capital_gain
+
+    # Sells value from the lot with the given id instead of the lots next in the lot selection.
+    def sell_lot(self, this_date: datetime, lot_id: int, value: float, result: AssetResult) -> float:
+        assert value >= 0
+        self.count -= value / result.price
+        assert self.count >= -0.000001
+        lot = self.lots[lot_id]
+        return self._sell_units(lot, min(value / result.price / self.fee_scale, lot.units), result.price)
 
+    def get_lot_count(self, lot_id: int) -> float:
+        return self.lots[lot_id].units * self.fee_scale
+
+    # Fees are given per year, so paying them every period takes the same share of the position over a year.
     def pay_fees(self) -> None:
-        self.count *= (100 - self.fees_percent) / 100
+        fee_factor = ((100 - self.fees_percent) / 100) ** (1 / self.periods_per_year)
+        self.count *= fee_factor
+        self.fee_scale *= fee_factor
+
+    def _get_next_lot(self) -> TaxLot:
+        if self.lot_selection == fifo:
+            while not self._fifo_lots[0].units:
+                self._fifo_lots.popleft()
+            return self._fifo_lots[0]
+        while not self._hifo_lots[0][2].units:
+            heapq.heappop(self._hifo_lots)
+        return self._hifo_lots[0][2]
+
+    def _sell_units(self, lot: TaxLot, units: float, price: float) -> float:
+        if units >= lot.units:
+            cost_basis = lot.cost_basis
+            lot.units = 0.0
+            lot.cost_basis = 0.0
+            del self.lots[lot.lot_id]
+        else:
+            cost_basis = lot.cost_basis * units / lot.units
+            lot.units -= units
+            lot.cost_basis -= cost_basis
+        return units * self.fee_scale * price - cost_basis
 
 
 class Bond:
@@ -164,248 +324,978 @@ class Bond:
         return this_date >= self.marurity_date
 
 
-class Tb10yPosition(Position):
+tb10y_maturity_days = 365.25 * 10
+
+# A 10 year bond is matured at most 10 years and one period after it was bought (10 years of the
+# calendar are 3652 or 3653 days, see Bond.is_matured), so with one slot per purchase period
+# a ring of 10 years of periods and 2 more slots is never overwritten before the bond in it matures.
+def get_bond_ladder_capacity(periods_per_year: int) -> int:
+    return 10 * periods_per_year + 2
+
+
+bond_ladder_capacity = get_bond_ladder_capacity(1)
+
+
+def get_bond_values(
+    face_values: np.ndarray, rates_percent: np.ndarray, maturity_days: np.ndarray,
+    this_days, market_rate_percent) -> np.ndarray:
+    # Same expression as npf.pv in Bond.get_value, evaluated for many bonds at once.
+    # The operations are done in place in the same order, since allocating a temporary array per operation
+    # costs more than the arithmetic for ladders with a slot per month.
+    if instrumentation.enabled:
+        instrumentation.count('bond_pricings', int(np.count_nonzero(face_values)))
+    time_to_maturity = np.subtract(maturity_days, this_days)
+    time_to_maturity *= 86400.0
+    time_to_maturity /= 3600
+    time_to_maturity /= 24
+    time_to_maturity /= 365.25
+    rate = market_rate_percent / 100
+    values = np.multiply(face_values, rates_percent)
+    values /= 100
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        temp = np.power(1 + rate, time_to_maturity)
+        fact = np.subtract(temp, 1)
+        fact /= rate
+        np.copyto(fact, time_to_maturity, where=rate == 0)
+        values *= fact
+        values += face_values
+        values /= temp
+    np.copyto(values, 0.0, where=face_values == 0)
+    return values
 
-    bonds: List[Bond]
 
-    def __init__(self) -> None:
-        self.bonds = []
+class Tb10yPosition(Position):
+
+    # The ladder is a ring buffer with one slot per purchase period, oldest period first.
+    # Bonds bought on the same date have the same rate and maturity, so they share a slot.
+    __slots__ = ('face_values', 'rates_percent', 'maturity_days', 'months_per_period', 'first_period', 'length')
+
+    face_values: np.ndarray
+    rates_percent: np.ndarray
+    maturity_days: np.ndarray
+    months_per_period: int
+    first_period: int
+    length: int
+
+    def __init__(self, periods_per_year: int = 1) -> None:
+        self.face_values = np.zeros(bond_ladder_capacity)
+        self.rates_percent = np.zeros(bond_ladder_capacity)
+        self.maturity_days = np.zeros(bond_ladder_capacity)
+        self.months_per_period = 12 // periods_per_year
+        self.first_period = 0
+        self.length = 0
 
     def get_dividends(self, result: Optional[AssetResult]) -> float:
         if not result or result.is_empty:
-            assert not self.bonds
+            assert not self.length
             return 0
-        return sum(bond.get_dividends() for bond in self.bonds)
+        return (self.face_values * self.rates_percent / 100).sum()
 
     def get_value(self, this_date: datetime, result: Optional[AssetResult]) -> float:
         if not result or result.is_empty:
-            assert not self.bonds
+            assert not self.length
             return 0
-        return sum(bond.get_value(this_date, result) for bond in self.bonds)
+        return get_bond_values(
+            self.face_values, self.rates_percent, self.maturity_days, this_date.toordinal(), result.dividends).sum()
 
     def get_maturity(self, this_date: datetime) -> Optional[float]:
-        matured_bonds = [bond for bond in self.bonds if bond.is_matured(this_date)]
-        for bond in matured_bonds:
-            self.bonds.remove(bond)
-        return sum(bond.face_value for bond in matured_bonds)
+        this_days = this_date.toordinal()
+        maturity = 0.0
+        while self.length and this_days >= self.maturity_days[self._slot(self.first_period)]:
+            slot = self._slot(self.first_period)
+            if instrumentation.enabled and self.face_values[slot]:
+                instrumentation.count('bonds_expired')
+            maturity += self.face_values[slot]
+            self.face_values[slot] = 0
+            self.first_period += 1
+            self.length -= 1
+        return maturity
 
     def buy(self, this_date: datetime, value: float, result: AssetResult) -> None:
         assert value >= 0
-        self.bonds.append(Bond(value, result.dividends, this_date, timedelta(days=365.25 * 10)))
+        maturity_days = this_date.toordinal() + tb10y_maturity_days
+        this_period = (this_date.year * 12 + this_date.month - 1) // self.months_per_period
+        if not self.length:
+            self.first_period = this_period
+        last_period = self.first_period + self.length - 1
+        if this_period == last_period:
+            slot = self._slot(last_period)
+            assert self.maturity_days[slot] == maturity_days and self.rates_percent[slot] == result.dividends
+            self.face_values[slot] += value
+            return
+        assert this_period > last_period
+        while self.first_period + self.length <= this_period:
+            if self.length == self.face_values.shape[0]:
+                self._grow()
+            slot = self._slot(self.first_period + self.length)
+            self.face_values[slot] = 0
+            self.rates_percent[slot] = 0
+            self.maturity_days[slot] = 0
+            self.length += 1
+        slot = self._slot(this_period)
+        self.face_values[slot] = value
+        self.rates_percent[slot] = result.dividends
+        self.maturity_days[slot] = maturity_days
+        if instrumentation.enabled:
+            instrumentation.count('bonds_created')
+            instrumentation.peak('tb10y_ladder_length', self.length)
 
     def sell(self, this_date: datetime, value: float, result: AssetResult) -> None:
-        sold_value = 0.0
-        while sold_value < value:
-            first_bond = self.bonds[0]
-            first_bond_value = first_bond.get_value(this_date, result)
-            remaining_to_sell = value - sold_value
-            if first_bond_value < remaining_to_sell:
-                self.bonds.remove(first_bond)
-                sold_value += first_bond_value
-            else:
-                first_bond.face_value *= (1 - remaining_to_sell / first_bond_value)
-                sold_value += remaining_to_sell
-                assert first_bond.get_value(this_date, result) + remaining_to_sell - first_bond_value < 0.000001
+        if value <= 0:
+            return
+        slots = self._slot(self.first_period + np.arange(self.length))
+        bond_values = get_bond_values(
+            self.face_values[slots], self.rates_percent[slots], self.maturity_days[slots],
+            this_date.toordinal(), result.dividends)
+        sold_after = np.cumsum(bond_values)
+        sold_before = sold_after - bond_values
+        fully_sold = int(np.searchsorted(sold_after, value, side='left'))
+        if fully_sold == self.length:
+            # Selling the whole ladder can ask for slightly more than it is worth because of rounding, like selling other positions.
+            if not self.length or value > sold_after[-1] + 0.000001:
+                raise IndexError(f'Cannot sell {value} of bonds worth {sold_after[-1] if self.length else 0.0}')
+            self.face_values[slots] = 0
+            self.first_period += self.length
+            self.length = 0
+            return
+        self.face_values[slots[:fully_sold]] = 0
+        remaining_to_sell = value - sold_before[fully_sold]
+        self.face_values[slots[fully_sold]] *= (1 - remaining_to_sell / bond_values[fully_sold])
+        self.first_period += fully_sold
+        self.length -= fully_sold
 
     def pay_fees(self) -> None:
         pass
 
+    def _slot(self, period):
+        return period % self.face_values.shape[0]
+
+    def _grow(self) -> None:
+        slots = self._slot(self.first_period + np.arange(self.length))
+        capacity = self.face_values.shape[0] * 2
+        for name in ('face_values', 'rates_percent', 'maturity_days'):
+            values = np.zeros(capacity)
+            values[(self.first_period + np.arange(self.length)) % capacity] = getattr(self, name)[slots]
+            setattr(self, name, values)
+
+
+# Positions of all assets, one per asset index. Positions can be read by label like the dict the portfolio used to be.
+# Capital gains tax is paid from cash on every sale of equities. Losses are carried forward and offset later gains.
+class Portfolio:
+
+    __slots__ = ('positions', 'cash_position', 'periods_per_year', 'capital_gains_tax_rate_percent', 'capital_losses')
+
+    positions: list[Position]
+    cash_position: CashPosition
+    periods_per_year: int
+    capital_gains_tax_rate_percent: float
+    capital_losses: float
+
+    def __init__(self, initial_balance: float, configs: AssetConfigs, periods_per_year: int = 1, capital_gains_tax_rate_percent: float = 0):
+        self.periods_per_year = periods_per_year
+        self.capital_gains_tax_rate_percent = capital_gains_tax_rate_percent
+        self.capital_losses = 0.0
+        self.cash_position = CashPosition(initial_balance)
+        self.positions = [
+            self.cash_position,
+            EquityPosition(0, configs[sp500].fees_percent, periods_per_year, configs[sp500].lot_selection),
+            EquityPosition(0, configs[vbmfx].fees_percent, periods_per_year, configs[vbmfx].lot_selection),
+            Tb10yPosition(periods_per_year),
+        ]
 
-class Portfolio(dict[str, Position]):
+    @property
+    def cash(self) -> float:
+        return self.cash_position.count
 
+    @cash.setter
+    def cash(self, value: float) -> None:
+        self.cash_position.count = value
 
-    def __init__(self, initial_balance: float, configs: AssetConfigs):
-        self.init_position(cash, CashPosition(initial_balance))
-        self.init_position(sp500, EquityPosition(0, configs[sp500].fees_percent))
-        self.init_position(vbmfx, EquityPosition(0, configs[vbmfx].fees_percent))
-        self.init_position(tb10y, Tb10yPosition())
+    def buy(self, this_date: datetime, label: str, value: float, results: AssetResults):
+        if instrumentation.enabled:
+            instrumentation.count('buy')
+        asset_index = asset_indices[label]
+        self.positions[asset_index].buy(this_date, value, results.results[asset_index])
+        self.cash_position.sell(this_date, value, results.results[cash_index])
 
-    def _cash(self) -> float:
-        return self[cash].get_value(None, None)  # type: ignore
+    def sell(self, this_date: datetime, label: str, value: float, results: AssetResults):
+        if instrumentation.enabled:
+            instrumentation.count('sell')
+        asset_index = asset_indices[label]
+        capital_gain = self.positions[asset_index].sell(this_date, value, results.results[asset_index])
+        self.cash_position.buy(this_date, value, results.results[cash_index])
+        self._pay_capital_gains_tax(this_date, capital_gain, results)
+
+    # Sells value from a single tax lot of an equity position, see EquityPosition.lots.
+    def sell_lot(self, this_date: datetime, label: str, lot_id: int, value: float, results: AssetResults):
+        if instrumentation.enabled:
+            instrumentation.count('sell')
+        asset_index = asset_indices[label]
+        position = self.positions[asset_index]
+        if not isinstance(position, EquityPosition):
+            raise ValueError(f'Only equity positions have tax lots, {label} has none')
+        capital_gain = position.sell_lot(this_date, lot_id, value, results.results[asset_index])
+        self.cash_position.buy(this_date, value, results.results[cash_index])
+        self._pay_capital_gains_tax(this_date, capital_gain, results)
+
+    def _pay_capital_gains_tax(self, this_date: datetime, capital_gain: Optional[float], results: AssetResults) -> None:
+        if capital_gain is None or not self.capital_gains_tax_rate_percent:
+            return
+        taxable_gain = capital_gain - self.capital_losses
+        self.capital_losses = max(-taxable_gain, 0.0)
+        if taxable_gain > 0:
+            self.cash_position.sell(this_date, taxable_gain * self.capital_gains_tax_rate_percent / 100, results.results[cash_index])
 
-    def _set_cash(self, value: float) -> None:
-        self[cash].count = value  # type: ignore
+    def __getitem__(self, label: str) -> Position:
+        return self.positions[asset_indices[label]]
 
-    cash = property(_cash, _set_cash)
+    def get(self, label: str, default=None) -> Optional[Position]:
+        asset_index = asset_indices.get(label)
+        return default if asset_index is None else self.positions[asset_index]
 
-    def init_position(self, label: str, position: Position):
-        self.setdefault(label, position)
+    def __contains__(self, label) -> bool:
+        return label in asset_indices
 
-    def buy(self, this_date: datetime, label: str, value: float, results: AssetResults):
+    def __iter__(self):
+        return iter(assets)
+
+    def __len__(self) -> int:
+        return len(assets)
+
+    def keys(self):
+        return assets
+
+    def values(self) -> list[Position]:
+        return self.positions
+
+    def items(self):
+        return zip(assets, self.positions)
+
+
+class BatchDates:
+
+    index: int
+    days: np.ndarray
+
+    def __init__(self, index: int, days: np.ndarray) -> None:
+        self.index = index
+        self.days = days
+
+
+class BatchAssetResult:
+
+    price: np.ndarray
+    dividends: np.ndarray
+
+    def __init__(self, price: np.ndarray, dividends: np.ndarray) -> None:
+        self.price = price
+        self.dividends = dividends
+
+    @property
+    def is_empty(self) -> np.ndarray:
+        return np.isnan(self.price) | np.isnan(self.dividends)
+
+
+class BatchAssetResults(dict[str, BatchAssetResult]):
+
+    def __init__(self, size: int, **kwargs) -> None:
+        kwargs.update({cash: BatchAssetResult(np.ones(size), np.zeros(size))})
+        super().__init__(kwargs)
+
+
+class BatchCashPosition:
+
+    count: np.ndarray
+
+    def __init__(self, count: np.ndarray):
+        self.count = count
+
+    def get_dividends(self, result: BatchAssetResult) -> np.ndarray:
+        return np.zeros_like(self.count)
+
+    def get_value(self, this_date: BatchDates, result: Optional[BatchAssetResult]) -> np.ndarray:
+        return self.count
+
+    def get_maturity(self, this_date: BatchDates) -> Optional[np.ndarray]:
+        return None
+
+    def buy(self, this_date: BatchDates, value: np.ndarray, result: BatchAssetResult) -> None:
+        assert np.all(value >= 0)
+        self.count = self.count + value
+
+    def sell(self, this_date: BatchDates, value: np.ndarray, result: BatchAssetResult) -> None:
+        assert np.all(value >= 0)
+        self.count = self.count - value
+        assert np.all(self.count >= -0.000001)
+
+    def pay_fees(self) -> None:
+        pass
+
+
+# With track_lots, the position keeps a tax lot per period in a slot of the period index, with units and cost bases as
+# (capacity, size) arrays, see TaxLot. Every column keeps the slots of its lots in the order they are sold in a column of lot_order:
+# a queue between lot_order_starts and lot_order_ends for fifo, and a heap of the first lot_order_ends slots for hifo, with the
+# highest cost basis per unit first and the oldest lot first among equal ones, like EquityPosition. A sale sells from the first lot
+# of every column that still has something to sell, one lot per step, so it takes steps for the lots it sells out and not for all of them.
+class BatchEquityPosition:
+
+    count: np.ndarray
+    fees_percent: float
+    periods_per_year: int
+    lot_selection: str
+    track_lots: bool
+    lot_units: np.ndarray
+    lot_cost_bases: np.ndarray
+    lot_cost_bases_per_unit: np.ndarray
+    lot_order: np.ndarray
+    lot_order_starts: np.ndarray
+    lot_order_ends: np.ndarray
+    fee_scale: float
+
+    def __init__(self, count: np.ndarray, fees_percent: float, periods_per_year: int = 1, lot_selection: str = fifo, track_lots: bool = False):
+        self.count = count
+        self.fees_percent = fees_percent
+        self.periods_per_year = periods_per_year
+        self.lot_selection = lot_selection
+        self.track_lots = track_lots
+        size = count.shape[0]
+        lot_capacity = 12 * periods_per_year if track_lots else 0
+        self.lot_units = np.zeros((lot_capacity, size))
+        self.lot_cost_bases = np.zeros((lot_capacity, size))
+        self.lot_cost_bases_per_unit = np.zeros((lot_capacity, size))
+        self.lot_order = np.zeros((lot_capacity, size), dtype=np.int64)
+        self.lot_order_starts = np.zeros(size, dtype=np.int64)
+        self.lot_order_ends = np.zeros(size, dtype=np.int64)
+        self.fee_scale = 1.0
+
+    def get_dividends(self, result: BatchAssetResult) -> np.ndarray:
+        return np.where(result.is_empty, 0.0, self.count * result.dividends)
+
+    def get_value(self, this_date: BatchDates, result: BatchAssetResult) -> np.ndarray:
+        return np.where(result.is_empty, 0.0, self.count * result.price)
+
+    def get_maturity(self, this_date: BatchDates) -> Optional[np.ndarray]:
+        return None
+
+    def buy(self, this_date: BatchDates, value: np.ndarray, result: BatchAssetResult) -> None:
+        assert np.all(value >= 0)
+        bought = np.divide(value, result.price, out=np.zeros_like(self.count), where=value != 0)
+        self.count = self.count + bought
+        if not self.track_lots:
+            return
+        slot = this_date.index
+        while slot >= self.lot_units.shape[0]:
+            self._grow_lots()
+        # Buys of the same period go to the same lot, which is a new one if the slot has no units left.
+        new_lots = np.flatnonzero((value != 0) & (self.lot_units[slot] == 0))
+        units = bought / self.fee_scale
+        self.lot_units[slot] += units
+        self.lot_cost_bases[slot] += value
+        if new_lots.shape[0]:
+            self.lot_cost_bases_per_unit[slot, new_lots] = value[new_lots] / units[new_lots]
+            self._push_lots(new_lots, slot)
+
+    # Returns the capital gains realized by the sale if the position tracks lots.
+    def sell(self, this_date: BatchDates, value: np.ndarray, result: BatchAssetResult) -> Optional[np.ndarray]:
+        assert np.all(value >= 0)
+        sold = np.divide(value, result.price, out=np.zeros_like(self.count), where=value != 0)
+        self.count = self.count - sold
+        assert np.all(self.count >= -0.000001)
+        if not self.track_lots:
+            return None
+        capital_gains = np.zeros_like(self.count)
+        units_to_sell = sold / self.fee_scale
+        columns = np.flatnonzero(value > 0)
+        while True:
+            columns = columns[(units_to_sell[columns] > 0) & (self.lot_order_starts[columns] < self.lot_order_ends[columns])]
+            if not columns.shape[0]:
+                return capital_gains
+            slots = self.lot_order[self.lot_order_starts[columns], columns]
+            lot_units = self.lot_units[slots, columns]
+            lot_cost_bases = self.lot_cost_bases[slots, columns]
+            sold_units = np.minimum(units_to_sell[columns], lot_units)
+            fully_sold = sold_units >= lot_units
+            sold_cost_bases = np.where(fully_sold, lot_cost_bases, lot_cost_bases * sold_units / lot_units)
+            capital_gains[columns] += sold_units * self.fee_scale * result.price[columns] - sold_cost_bases
+            units_to_sell[columns] -= sold_units
+            self.lot_units[slots, columns] = np.where(fully_sold, 0.0, lot_units - sold_units)
+            self.lot_cost_bases[slots, columns] = np.where(fully_sold, 0.0, lot_cost_bases - sold_cost_bases)
+            self._pop_lots(columns[fully_sold])
+
+    def pay_fees(self) -> None:
+        fee_factor = ((100 - self.fees_percent) / 100) ** (1 / self.periods_per_year)
+        self.count = self.count * fee_factor
+        self.fee_scale *= fee_factor
+
+    def _push_lots(self, columns: np.ndarray, slot: int) -> None:
+        if self.lot_selection == fifo:
+            # A column without lots starts its queue over, so the queue never holds more entries than there are slots.
+            empty = self.lot_order_starts[columns] == self.lot_order_ends[columns]
+            self.lot_order_starts[columns[empty]] = 0
+            self.lot_order_ends[columns[empty]] = 0
+            self.lot_order[self.lot_order_ends[columns], columns] = slot
+            self.lot_order_ends[columns] += 1
+            return
+        positions = self.lot_order_ends[columns]
+        self.lot_order[positions, columns] = slot
+        self.lot_order_ends[columns] += 1
+        while columns.shape[0]:
+            parents = (positions - 1) // 2
+            moving = (positions > 0) & self._is_sold_before(
+                self.lot_order[positions, columns], self.lot_order[np.maximum(parents, 0), columns], columns)
+            columns, positions, parents = columns[moving], positions[moving], parents[moving]
+            self._swap_lots(columns, positions, parents)
+            positions = parents
+
+    def _pop_lots(self, columns: np.ndarray) -> None:
+        if self.lot_selection == fifo:
+            self.lot_order_starts[columns] += 1
+            return
+        self.lot_order_ends[columns] -= 1
+        ends = self.lot_order_ends[columns]
+        self.lot_order[0, columns] = self.lot_order[ends, columns]
+        positions = np.zeros_like(columns)
+        capacity = self.lot_order.shape[0]
+        while columns.shape[0]:
+            children = 2 * positions + 1
+            right_children = children + 1
+            take_right = (right_children < ends) & self._is_sold_before(
+                self.lot_order[np.minimum(right_children, capacity - 1), columns],
+                self.lot_order[np.minimum(children, capacity - 1), columns], columns)
+            children = np.where(take_right, right_children, children)
+            moving = (children < ends) & self._is_sold_before(
+                self.lot_order[np.minimum(children, capacity - 1), columns], self.lot_order[positions, columns], columns)
+            columns, positions, children, ends = columns[moving], positions[moving], children[moving], ends[moving]
+            self._swap_lots(columns, positions, children)
+            positions = children
+
+    def _is_sold_before(self, slots: np.ndarray, other_slots: np.ndarray, columns: np.ndarray) -> np.ndarray:
+        cost_bases_per_unit = self.lot_cost_bases_per_unit[slots, columns]
+        other_cost_bases_per_unit = self.lot_cost_bases_per_unit[other_slots, columns]
+        return (cost_bases_per_unit > other_cost_bases_per_unit) | ((cost_bases_per_unit == other_cost_bases_per_unit) & (slots < other_slots))
+
+    def _swap_lots(self, columns: np.ndarray, positions: np.ndarray, other_positions: np.ndarray) -> None:
+        slots = self.lot_order[positions, columns]
+        self.lot_order[positions, columns] = self.lot_order[other_positions, columns]
+        self.lot_order[other_positions, columns] = slots
+
+    def _grow_lots(self) -> None:
+        for name in ('lot_units', 'lot_cost_bases', 'lot_cost_bases_per_unit', 'lot_order'):
+            values = getattr(self, name)
+            setattr(self, name, np.concatenate([values, np.zeros_like(values)]))
+
+
+class BatchTb10yPosition:
+
+    face_values: np.ndarray
+    rates_percent: np.ndarray
+    maturity_days: np.ndarray
+    # Values of the bonds in the ladder as of the period they were computed for, dropped whenever the ladder changes.
+    # Strategies value the ladder before they sell from it, so this saves pricing it twice per period.
+    _bond_values: Optional[tuple[int, np.ndarray]]
+
+    def __init__(self, size: int, capacity: int = bond_ladder_capacity) -> None:
+        self.face_values = np.zeros((capacity, size))
+        self.rates_percent = np.zeros((capacity, size))
+        self.maturity_days = np.zeros((capacity, size))
+        self._bond_values = None
+
+    def get_dividends(self, result: BatchAssetResult) -> np.ndarray:
+        return (self.face_values * self.rates_percent / 100).sum(axis=0)
+
+    def get_value(self, this_date: BatchDates, result: BatchAssetResult) -> np.ndarray:
+        return self._get_bond_values(this_date, result).sum(axis=0)
+
+    def get_maturity(self, this_date: BatchDates) -> Optional[np.ndarray]:
+        matured = this_date.days >= self.maturity_days
+        if instrumentation.enabled:
+            instrumentation.count('bonds_expired', int(np.count_nonzero(matured & (self.face_values != 0))))
+        maturity = np.where(matured, self.face_values, 0.0).sum(axis=0)
+        self.face_values[matured] = 0
+        self._bond_values = None
+        return maturity
+
+    def buy(self, this_date: BatchDates, value: np.ndarray, result: BatchAssetResult) -> None:
+        assert np.all(value >= 0)
+        slot = this_date.index % self.face_values.shape[0]
+        if instrumentation.enabled:
+            instrumentation.count('bonds_created', int(np.count_nonzero((self.face_values[slot] == 0) & (value != 0))))
+        self.face_values[slot] += value
+        self.rates_percent[slot] = result.dividends
+        self.maturity_days[slot] = this_date.days + tb10y_maturity_days
+        self._bond_values = None
+        if instrumentation.enabled:
+            instrumentation.peak('tb10y_ladder_length', int(np.count_nonzero(self.face_values, axis=0).max()))
+
+    # Only columns that sell something are touched, the bonds of other columns are kept as they are.
+    def sell(self, this_date: BatchDates, value: np.ndarray, result: BatchAssetResult) -> None:
+        columns = np.flatnonzero(value > 0)
+        if not columns.shape[0]:
+            return
+        value = value[columns]
+        capacity = self.face_values.shape[0]
+        oldest_first = (this_date.index + 1 + np.arange(capacity)) % capacity
+        bonds = np.ix_(oldest_first, columns)
+        bond_values = self._get_bond_values(this_date, result)[bonds]
+        sold_after = np.cumsum(bond_values, axis=0)
+        sold_before = sold_after - bond_values
+        fully_sold = sold_after < value
+        partially_sold = ~fully_sold & (sold_before < value)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            factors = np.where(
+                fully_sold,
+                0.0,
+                np.where(partially_sold, 1 - (value - sold_before) / bond_values, 1.0))
+        self.face_values[bonds] *= factors
+        self._bond_values = None
+
+    def pay_fees(self) -> None:
+        pass
+
+    def _get_bond_values(self, this_date: BatchDates, result: BatchAssetResult) -> np.ndarray:
+        if self._bond_values is None or self._bond_values[0] != this_date.index:
+            self._bond_values = (
+                this_date.index,
+                get_bond_values(self.face_values, self.rates_percent, self.maturity_days, this_date.days, result.dividends))
+        return self._bond_values[1]
+
+
+# Lots are only tracked with a capital gains tax, since without it they don't change the balances.
+class BatchPortfolio(dict):
+
+    periods_per_year: int
+    capital_gains_tax_rate_percent: float
+    capital_losses: np.ndarray
+
+    def __init__(self, initial_balance: np.ndarray, configs: AssetConfigs, periods_per_year: int = 1, capital_gains_tax_rate_percent: float = 0):
+        size = initial_balance.shape[0]
+        self.periods_per_year = periods_per_year
+        self.capital_gains_tax_rate_percent = capital_gains_tax_rate_percent
+        self.capital_losses = np.zeros(size)
+        track_lots = capital_gains_tax_rate_percent != 0
+        self.setdefault(cash, BatchCashPosition(initial_balance))
+        for label in (sp500, vbmfx):
+            self.setdefault(label, BatchEquityPosition(
+                np.zeros(size), configs[label].fees_percent, periods_per_year, configs[label].lot_selection, track_lots))
+        self.setdefault(tb10y, BatchTb10yPosition(size, get_bond_ladder_capacity(periods_per_year)))
+
+    def _cash(self) -> np.ndarray:
+        return self[cash].count
+
+    def _set_cash(self, value: np.ndarray) -> None:
+        self[cash].count = value
+
+    cash = property(_cash, _set_cash)
+
+    def buy(self, this_date: BatchDates, label: str, value: np.ndarray, results: BatchAssetResults):
+        if instrumentation.enabled:
+            instrumentation.count('batch_buy')
         self[label].buy(this_date, value, results[label])
         self[cash].sell(this_date, value, results[cash])
 
-    def sell(self, this_date: datetime, label: str, value: float, results: AssetResults):
-        self[label].sell(this_date, value, results[label])
+    def sell(self, this_date: BatchDates, label: str, value: np.ndarray, results: BatchAssetResults):
+        if instrumentation.enabled:
+            instrumentation.count('batch_sell')
+        capital_gains = self[label].sell(this_date, value, results[label])
         self[cash].buy(this_date, value, results[cash])
+        if capital_gains is not None and self.capital_gains_tax_rate_percent:
+            taxable_gains = capital_gains - self.capital_losses
+            self.capital_losses = np.maximum(-taxable_gains, 0.0)
+            self[cash].sell(this_date, np.maximum(taxable_gains, 0.0) * self.capital_gains_tax_rate_percent / 100, results[cash])
 
 
 class InvestmentStrategy:
 
+    # Strategies that never look at balances when deciding what to do have final balances linear in the initial balance
+    # and the contributions, so they can be computed from a couple of basis simulations.
+    linear: bool = False
+
+    # Strategies with the same stack key can be run together by the batch engine, see RebalancingStrategy.stack.
+    stack_key = None
+
     def start_investing(self, this_date: datetime, portfolio: Portfolio, results: AssetResults) -> None:
         pass
 
-    def execute(self, this_date: datetime, year_index: int, investment_years: int, portfolio: Portfolio, results: AssetResults) -> None:
+    def execute(self, this_date: datetime, period_index: int, period_count: int, portfolio: Portfolio, results: AssetResults) -> None:
         raise NotImplementedError('execute')
 
+    def start_investing_batch(self, this_date: BatchDates, portfolio: BatchPortfolio, results: BatchAssetResults) -> None:
+        pass
+
+    def execute_batch(self, this_date: BatchDates, period_index: int, period_count: int, portfolio: BatchPortfolio, results: BatchAssetResults) -> None:
+        raise NotImplementedError('execute_batch')
+
+    @property
+    def supports_batch(self) -> bool:
+        return type(self).execute_batch is not InvestmentStrategy.execute_batch
+
+    # Strategies that never look at period_count do the same in the first years of every horizon,
+    # so a single simulation to the longest horizon gives the balances of all shorter horizons.
+    # Subclasses override it with a property or a class attribute.
+    @property
+    def horizon_independent(self) -> bool:
+        return False
+
 
 class Sp500Strategy(InvestmentStrategy):
 
+    linear = True
+    horizon_independent = True
+
     def start_investing(self, this_date: datetime, portfolio: Portfolio, results: AssetResults) -> None:
         self.execute(this_date, 0, 100, portfolio, results)
 
-    def execute(self, this_date: datetime, year_index: int, investment_years: int, portfolio: Portfolio, results: AssetResults) -> None:
+    def execute(self, this_date: datetime, period_index: int, period_count: int, portfolio: Portfolio, results: AssetResults) -> None:
         portfolio.buy(this_date, sp500, portfolio.cash, results)
 
+    def start_investing_batch(self, this_date: BatchDates, portfolio: BatchPortfolio, results: BatchAssetResults) -> None:
+        self.execute_batch(this_date, 0, 100, portfolio, results)
 
-def fixed_target_sp500_percent(target_sp500_percent: float):
-    def get_target_sp500_percent(year_index, investment_years):
-        return target_sp500_percent
-    return get_target_sp500_percent
+    def execute_batch(self, this_date: BatchDates, period_index: int, period_count: int, portfolio: BatchPortfolio, results: BatchAssetResults) -> None:
+        portfolio.buy(this_date, sp500, portfolio.cash, results)
 
 
-def linearly_changing_target_sp500_percent(target_sp500_percent_start: float, target_sp500_percent_end: float):
-    def get_target_sp500_percent(year_index, investment_years):
-        return \
-            target_sp500_percent_start \
-            + (target_sp500_percent_end - target_sp500_percent_start) * (year_index / investment_years)
-    return get_target_sp500_percent
+contributions_only = 'contributions_only'
+full_rebalancing = 'full_rebalancing'
 
 
-class Sp500AndVbmfxStrategyWoSelling(InvestmentStrategy):
+# Target allocations are given as percents of every asset of a strategy but the last one, which gets the rest.
+class TargetSchedule:
 
-    def __init__(self, get_target_sp500_percent):
-        self.get_target_sp500_percent = get_target_sp500_percent
-        self.sp500_strategy = Sp500Strategy()
+    @property
+    def horizon_independent(self) -> bool:
+        return False
 
-    def start_investing(self, this_date: datetime, portfolio: Portfolio, results: AssetResults) -> None:
+    def get_target_percents(self, period_count: int) -> np.ndarray:
+        raise NotImplementedError('get_target_percents')
 
-        if results[vbmfx].is_empty:
-            self.sp500_strategy.start_investing(this_date, portfolio, results)
-            return
 
-        target_sp500_percent = self.get_target_sp500_percent(0, 100)
-        portfolio.buy(this_date, sp500, portfolio.cash * target_sp500_percent / 100, results)
-        portfolio.buy(this_date, vbmfx, portfolio.cash, results)
+# Target percents at given fractions of the investment horizon, linearly interpolated in between.
+class PiecewiseTargetSchedule(TargetSchedule):
 
-    def execute(self, this_date: datetime, year_index: int, investment_years: int, portfolio: Portfolio, results: AssetResults) -> None:
+    points: tuple[tuple[float, tuple[float, ...]], ...]
 
-        if results[vbmfx].is_empty:
-            self.sp500_strategy.execute(this_date, 0, 100, portfolio, results)
-            return
+    def __init__(self, points) -> None:
+        self.points = tuple((float(fraction), tuple(float(percent) for percent in percents)) for fraction, percents in points)
+        self._target_percents: dict[int, np.ndarray] = {}
 
-        sp500_balance = portfolio[sp500].get_value(this_date, results[sp500])
-        vbmfx_balance = portfolio[vbmfx].get_value(this_date, results[vbmfx])
-        sp500_percent = sp500_balance / (sp500_balance + vbmfx_balance) * 100
-        target_sp500_percent = self.get_target_sp500_percent(year_index, investment_years)
-        if sp500_percent <= target_sp500_percent:
-            portfolio.buy(this_date, sp500, portfolio.cash, results)
-        else:
-            portfolio.buy(this_date, vbmfx, portfolio.cash, results)
+    # Targets that are the same at every point don't change over the horizon.
+    @property
+    def horizon_independent(self) -> bool:
+        return len(set(percents for _, percents in self.points)) == 1
 
+    def get_target_percents(self, period_count: int) -> np.ndarray:
+        target_percents = self._target_percents.get(period_count)
+        if target_percents is None:
+            fractions = np.arange(period_count + 1) / period_count
+            point_fractions = np.array([fraction for fraction, _ in self.points])
+            point_percents = np.array([percents for _, percents in self.points])
+            target_percents = np.column_stack([
+                np.interp(fractions, point_fractions, point_percents[:, asset_index])
+                for asset_index in range(point_percents.shape[1])
+            ])
+            self._target_percents[period_count] = target_percents
+        return target_percents
 
-class Sp500AndTb10yStrategyWoSelling(InvestmentStrategy):
+    def __call__(self, period_index, period_count):
+        return self.get_target_percents(period_count)[period_index, 0]
 
-    def __init__(self, get_target_sp500_percent):
+
+class FunctionTargetSchedule(TargetSchedule):
+
+    get_target_sp500_percent: Callable[[int, int], float]
+
+    def __init__(self, get_target_sp500_percent: Callable[[int, int], float]) -> None:
         self.get_target_sp500_percent = get_target_sp500_percent
+        self._target_percents: dict[int, np.ndarray] = {}
 
-    def start_investing(self, this_date: datetime, portfolio: Portfolio, results: AssetResults) -> None:
-        target_sp500_percent = self.get_target_sp500_percent(0, 100)
-        portfolio.buy(this_date, sp500, portfolio.cash * target_sp500_percent / 100, results)
-        portfolio.buy(this_date, tb10y, portfolio.cash, results)
-
-    def execute(self, this_date: datetime, year_index: int, investment_years: int, portfolio: Portfolio, results: AssetResults) -> None:
-        sp500_balance = portfolio[sp500].get_value(this_date, results[sp500])
-        tb10y_balance = portfolio[tb10y].get_value(this_date, results[tb10y])
-        sp500_percent = sp500_balance / (sp500_balance + tb10y_balance) * 100
-        target_sp500_percent = self.get_target_sp500_percent(year_index, investment_years)
-        if sp500_percent <= target_sp500_percent:
-            portfolio.buy(this_date, sp500, portfolio.cash, results)
-        else:
-            portfolio.buy(this_date, tb10y, portfolio.cash, results)
+    def get_target_percents(self, period_count: int) -> np.ndarray:
+        target_percents = self._target_percents.get(period_count)
+        if target_percents is None:
+            target_percents = np.array([
+                [self.get_target_sp500_percent(period_index, period_count)]
+                for period_index in range(period_count + 1)
+            ])
+            self._target_percents[period_count] = target_percents
+        return target_percents
 
 
-class Sp500AndVbmfxStrategyWithSelling(InvestmentStrategy):
+# Target schedules are classes rather than closures so that strategies can be pickled and sent to worker processes.
+class FixedTargetSp500Percent(PiecewiseTargetSchedule):
 
-    def __init__(self, get_target_sp500_percent):
-        self.get_target_sp500_percent = get_target_sp500_percent
-        self.sp500_strategy = Sp500Strategy()
+    target_sp500_percent: float
+
+    def __init__(self, target_sp500_percent: float) -> None:
+        super().__init__([(0, [target_sp500_percent])])
+        self.target_sp500_percent = target_sp500_percent
+
+
+class LinearlyChangingTargetSp500Percent(PiecewiseTargetSchedule):
+
+    target_sp500_percent_start: float
+    target_sp500_percent_end: float
+
+    def __init__(self, target_sp500_percent_start: float, target_sp500_percent_end: float) -> None:
+        super().__init__([(0, [target_sp500_percent_start]), (1, [target_sp500_percent_end])])
+        self.target_sp500_percent_start = target_sp500_percent_start
+        self.target_sp500_percent_end = target_sp500_percent_end
+
+
+def fixed_target_sp500_percent(target_sp500_percent: float):
+    return FixedTargetSp500Percent(target_sp500_percent)
+
+
+def linearly_changing_target_sp500_percent(target_sp500_percent_start: float, target_sp500_percent_end: float):
+    return LinearlyChangingTargetSp500Percent(target_sp500_percent_start, target_sp500_percent_end)
+
+
+def piecewise_target_percents(points):
+    return PiecewiseTargetSchedule(points)
+
+
+def as_target_schedule(target_schedule) -> TargetSchedule:
+    if isinstance(target_schedule, TargetSchedule):
+        return target_schedule
+    return FunctionTargetSchedule(target_schedule)
+
+
+# Keeps a set of assets at target percents of the portfolio. The first asset must always have data.
+# Until all other assets have data, everything is invested into the first asset.
+# With contributions_only, the cash is invested into the first asset that is at or below its target percent, or the last asset.
+# With full_rebalancing, assets over their targets are sold and the cash is split between assets under their targets.
+class RebalancingStrategy(InvestmentStrategy):
+
+    assets: tuple[str, ...]
+    indices: tuple[int, ...]
+    target_schedule: TargetSchedule
+    rebalancing: str
+
+    def __init__(self, assets, target_schedule, rebalancing: str) -> None:
+        if rebalancing not in (contributions_only, full_rebalancing):
+            raise ValueError(f'Unknown rebalancing {rebalancing}')
+        self.assets = tuple(assets)
+        self.indices = tuple(asset_indices[asset] for asset in self.assets)
+        self.target_schedule = as_target_schedule(target_schedule)
+        self.rebalancing = rebalancing
+
+    @property
+    def horizon_independent(self) -> bool:
+        return self.target_schedule.horizon_independent
+
+    @property
+    def stack_key(self):
+        return (RebalancingStrategy, self.assets)
+
+    @staticmethod
+    def stack(investment_strategies: list['RebalancingStrategy'], size: int) -> 'StackedRebalancingStrategy':
+        return StackedRebalancingStrategy(investment_strategies, size)
 
     def start_investing(self, this_date: datetime, portfolio: Portfolio, results: AssetResults) -> None:
 
-        if results[vbmfx].is_empty:
-            self.sp500_strategy.start_investing(this_date, portfolio, results)
+        target_percents = self.target_schedule.get_target_percents(100)[0]
+
+        if any(results.results[asset_index].is_empty for asset_index in self.indices[1:]):
+            portfolio.buy(this_date, self.assets[0], portfolio.cash, results)
             return
 
-        target_sp500_percent = self.get_target_sp500_percent(0, 100)
-        portfolio.buy(this_date, sp500, portfolio.cash * target_sp500_percent / 100, results)
-        portfolio.buy(this_date, vbmfx, portfolio.cash, results)
+        initial_cash = portfolio.cash
+        for asset, target_percent in zip(self.assets, target_percents):
+            portfolio.buy(this_date, asset, initial_cash * target_percent / 100, results)
+        portfolio.buy(this_date, self.assets[-1], portfolio.cash, results)
+
+    def execute(self, this_date: datetime, period_index: int, period_count: int, portfolio: Portfolio, results: AssetResults) -> None:
 
-    def execute(self, this_date: datetime, year_index: int, investment_years: int, portfolio: Portfolio, results: AssetResults) -> None:
+        target_percents = self.target_schedule.get_target_percents(period_count)[period_index]
 
-        if results[vbmfx].is_empty:
-            self.sp500_strategy.execute(this_date, 0, 100, portfolio, results)
+        if any(results.results[asset_index].is_empty for asset_index in self.indices[1:]):
+            portfolio.buy(this_date, self.assets[0], portfolio.cash, results)
             return
 
-        sp500_balance = portfolio[sp500].get_value(this_date, results[sp500])
-        vbmfx_balance = portfolio[vbmfx].get_value(this_date, results[vbmfx])
-        final_balance = sp500_balance + vbmfx_balance + portfolio.cash
-        target_sp500_percent = self.get_target_sp500_percent(year_index, investment_years)
-        target_sp500_balance = final_balance * target_sp500_percent / 100
-        target_vbmfx_balance = final_balance - target_sp500_balance
-        if target_sp500_balance <= sp500_balance:
-            portfolio.buy(this_date, vbmfx, portfolio.cash, results)
-            sell_amount = sp500_balance - target_sp500_balance
-            portfolio.sell(this_date, sp500, sell_amount, results)
-            portfolio.buy(this_date, vbmfx, sell_amount, results)
-        elif target_vbmfx_balance <= vbmfx_balance:
-            portfolio.buy(this_date, sp500, portfolio.cash, results)
-            sell_amount = vbmfx_balance - target_vbmfx_balance
-            portfolio.sell(this_date, vbmfx, sell_amount, results)
-            portfolio.buy(this_date, sp500, sell_amount, results)
-        else:
-            portfolio.buy(this_date, vbmfx, target_vbmfx_balance - vbmfx_balance, results)
-            portfolio.buy(this_date, sp500, target_sp500_balance - sp500_balance, results)
+        balances = [portfolio.positions[asset_index].get_value(this_date, results.results[asset_index]) for asset_index in self.indices]
+        invested_balance = balances[0]
+        for balance in balances[1:]:
+            invested_balance += balance
+
+        if self.rebalancing == contributions_only:
+            chosen_asset = self.assets[-1]
+            for asset, balance, target_percent in zip(self.assets, balances, target_percents):
+                if invested_balance and balance / invested_balance * 100 <= target_percent:
+                    chosen_asset = asset
+                    break
+            portfolio.buy(this_date, chosen_asset, portfolio.cash, results)
+            return
 
+        target_balances = get_target_balances(invested_balance + portfolio.cash, target_percents)
+        deficits = []
+        for asset, balance, target_balance in zip(self.assets, balances, target_balances):
+            if target_balance <= balance:
+                portfolio.sell(this_date, asset, balance - target_balance, results)
+                deficits.append(0.0)
+            else:
+                deficits.append(target_balance - balance)
+        cash_to_invest = portfolio.cash
+        deficit_sum = deficits[0]
+        for deficit in deficits[1:]:
+            deficit_sum += deficit
+        for asset, deficit in zip(self.assets, deficits):
+            if deficit > 0:
+                portfolio.buy(this_date, asset, cash_to_invest * deficit / deficit_sum, results)
+
+    def start_investing_batch(self, this_date: BatchDates, portfolio: BatchPortfolio, results: BatchAssetResults) -> None:
+        start_rebalancing_batch(self.assets, this_date, self.target_schedule.get_target_percents(100)[0], portfolio, results)
+
+    def execute_batch(self, this_date: BatchDates, period_index: int, period_count: int, portfolio: BatchPortfolio, results: BatchAssetResults) -> None:
+        rebalance_batch(
+            self.assets, this_date, self.target_schedule.get_target_percents(period_count)[period_index],
+            self.rebalancing == full_rebalancing, portfolio, results)
+
+
+# Runs several rebalancing strategies over the same assets at once, each of them over its own block of size columns.
+class StackedRebalancingStrategy(InvestmentStrategy):
+
+    assets: tuple[str, ...]
+    investment_strategies: list[RebalancingStrategy]
+    size: int
+
+    def __init__(self, investment_strategies: list[RebalancingStrategy], size: int) -> None:
+        self.assets = investment_strategies[0].assets
+        self.investment_strategies = investment_strategies
+        self.size = size
+        self._full_rebalancing = np.repeat([strategy.rebalancing == full_rebalancing for strategy in investment_strategies], size)
+        self._target_percents: dict[int, np.ndarray] = {}
 
-class Sp500AndTb10yStrategyWithSelling(InvestmentStrategy):
+    @property
+    def horizon_independent(self) -> bool:
+        return all(strategy.horizon_independent for strategy in self.investment_strategies)
+
+    def start_investing_batch(self, this_date: BatchDates, portfolio: BatchPortfolio, results: BatchAssetResults) -> None:
+        start_rebalancing_batch(self.assets, this_date, self._get_target_percents(100, 0), portfolio, results)
+
+    def execute_batch(self, this_date: BatchDates, period_index: int, period_count: int, portfolio: BatchPortfolio, results: BatchAssetResults) -> None:
+        rebalance_batch(
+            self.assets, this_date, self._get_target_percents(period_count, period_index),
+            self._full_rebalancing, portfolio, results)
+
+    def _get_target_percents(self, period_count: int, period_index: int) -> np.ndarray:
+        target_percents = self._target_percents.get(period_count)
+        if target_percents is None:
+            target_percents = np.stack(
+                [strategy.target_schedule.get_target_percents(period_count) for strategy in self.investment_strategies],
+                axis=-1)
+            self._target_percents[period_count] = target_percents
+        return np.repeat(target_percents[period_index], self.size, axis=-1)
+
+
+def get_target_balances(total_balance, target_percents) -> list:
+    target_balances = [total_balance * target_percent / 100 for target_percent in target_percents]
+    last_target_balance = total_balance
+    for target_balance in target_balances:
+        last_target_balance = last_target_balance - target_balance
+    return target_balances + [last_target_balance]
+
+
+def get_waiting_for_data(assets: tuple[str, ...], results: BatchAssetResults) -> np.ndarray:
+    waiting_for_data = np.zeros(results[assets[0]].price.shape[0], dtype=bool)
+    for asset in assets[1:]:
+        waiting_for_data |= results[asset].is_empty
+    return waiting_for_data
+
+
+def start_rebalancing_batch(
+    assets: tuple[str, ...], this_date: BatchDates, target_percents: np.ndarray, portfolio: BatchPortfolio, results: BatchAssetResults) -> None:
+
+    waiting_for_data = get_waiting_for_data(assets, results)
+    initial_cash = portfolio.cash
+    for asset_index, (asset, target_percent) in enumerate(zip(assets, target_percents)):
+        waiting_amount = initial_cash if asset_index == 0 else 0.0
+        portfolio.buy(this_date, asset, np.where(waiting_for_data, waiting_amount, initial_cash * target_percent / 100), results)
+    portfolio.buy(this_date, assets[-1], np.where(waiting_for_data, 0.0, portfolio.cash), results)
+
+
+def rebalance_batch(
+    assets: tuple[str, ...], this_date: BatchDates, target_percents: np.ndarray, full_rebalancing,
+    portfolio: BatchPortfolio, results: BatchAssetResults) -> None:
+
+    full_rebalancing = np.asarray(full_rebalancing, dtype=bool)
+    waiting_for_data = get_waiting_for_data(assets, results)
+    rebalancing = full_rebalancing & ~waiting_for_data
+    contributing = ~full_rebalancing & ~waiting_for_data
+
+    balances = [portfolio[asset].get_value(this_date, results[asset]) for asset in assets]
+    invested_balance = balances[0]
+    for balance in balances[1:]:
+        invested_balance = invested_balance + balance
+    cash_to_contribute = portfolio.cash
+
+    chosen_assets = np.full(invested_balance.shape[0], len(assets) - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for asset_index in reversed(range(len(assets) - 1)):
+            chosen = balances[asset_index] / invested_balance * 100 <= target_percents[asset_index]
+            chosen_assets = np.where(chosen, asset_index, chosen_assets)
+
+    target_balances = get_target_balances(invested_balance + cash_to_contribute, target_percents)
+    deficits = []
+    for asset, balance, target_balance in zip(assets, balances, target_balances):
+        over_target = target_balance <= balance
+        sell_amount = np.where(rebalancing & over_target, balance - target_balance, 0.0)
+        if sell_amount.any():
+            portfolio.sell(this_date, asset, sell_amount, results)
+        deficits.append(np.where(over_target, 0.0, target_balance - balance))
+
+    cash_to_invest = portfolio.cash
+    deficit_sum = deficits[0]
+    for deficit in deficits[1:]:
+        deficit_sum = deficit_sum + deficit
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for asset_index, (asset, deficit) in enumerate(zip(assets, deficits)):
+            waiting_amount = cash_to_contribute if asset_index == 0 else 0.0
+            buy_amount = np.where(
+                waiting_for_data,
+                waiting_amount,
+                np.where(
+                    contributing,
+                    np.where(chosen_assets == asset_index, cash_to_contribute, 0.0),
+                    np.where(rebalancing & (deficit > 0), cash_to_invest * deficit / deficit_sum, 0.0)))
+            portfolio.buy(this_date, asset, buy_amount, results)
+
+
+class Sp500AndVbmfxStrategyWoSelling(RebalancingStrategy):
 
     def __init__(self, get_target_sp500_percent):
-        self.get_target_sp500_percent = get_target_sp500_percent
+        super().__init__((sp500, vbmfx), get_target_sp500_percent, contributions_only)
 
-    def start_investing(self, this_date: datetime, portfolio: Portfolio, results: AssetResults) -> None:
-        target_sp500_percent = self.get_target_sp500_percent(0, 100)
-        portfolio.buy(this_date, sp500, portfolio.cash * target_sp500_percent / 100, results)
-        portfolio.buy(this_date, tb10y, portfolio.cash, results)
-
-    def execute(self, this_date: datetime, year_index: int, investment_years: int, portfolio: Portfolio, results: AssetResults) -> None:
-        sp500_balance = portfolio[sp500].get_value(this_date, results[sp500])
-        tb10y_balance = portfolio[tb10y].get_value(this_date, results[tb10y])
-        final_balance = sp500_balance + tb10y_balance + portfolio.cash
-        target_sp500_percent = self.get_target_sp500_percent(year_index, investment_years)
-        target_sp500_balance = final_balance * target_sp500_percent / 100
-        target_tb10y_balance = final_balance - target_sp500_balance
-        if target_sp500_balance <= sp500_balance:
-            portfolio.buy(this_date, tb10y, portfolio.cash, results)
-            sell_amount = sp500_balance - target_sp500_balance
-            portfolio.sell(this_date, sp500, sell_amount, results)
-            portfolio.buy(this_date, tb10y, sell_amount, results)
-        elif target_tb10y_balance <= tb10y_balance:
-            portfolio.buy(this_date, sp500, portfolio.cash, results)
-            sell_amount = tb10y_balance - target_tb10y_balance
-            portfolio.sell(this_date, tb10y, sell_amount, results)
-            portfolio.buy(this_date, sp500, sell_amount, results)
-        else:
-            portfolio.buy(this_date, tb10y, target_tb10y_balance - tb10y_balance, results)
-            portfolio.buy(this_date, sp500, target_sp500_balance - sp500_balance, results)
+
+class Sp500AndTb10yStrategyWoSelling(RebalancingStrategy):
+
+    def __init__(self, get_target_sp500_percent):
+        super().__init__((sp500, tb10y), get_target_sp500_percent, contributions_only)
+
+
+class Sp500AndVbmfxStrategyWithSelling(RebalancingStrategy):
+
+    def __init__(self, get_target_sp500_percent):
+        super().__init__((sp500, vbmfx), get_target_sp500_percent, full_rebalancing)
+
+
+class Sp500AndTb10yStrategyWithSelling(RebalancingStrategy):
+
+    def __init__(self, get_target_sp500_percent):
+        super().__init__((sp500, tb10y), get_target_sp500_percent, full_rebalancing)
 
 
 class FixedPercentStrategy(InvestmentStrategy):
 
+    linear = True
+    horizon_independent = True
+
     percent: float
 
     def __init__(self, percent) -> None:
         self.percent = percent
 
-    def execute(self, this_date: datetime, year_index: int, investment_years: int, portfolio: Portfolio, results: AssetResults) -> None:
-        portfolio.cash *= 1 + self.percent / 100
+    # The percent is per year and is compounded over the periods of a year.
+    def execute(self, this_date: datetime, period_index: int, period_count: int, portfolio: Portfolio, results: AssetResults) -> None:
+        portfolio.cash *= (1 + self.percent / 100) ** (1 / portfolio.periods_per_year)
+
+    def execute_batch(self, this_date: BatchDates, period_index: int, period_count: int, portfolio: BatchPortfolio, results: BatchAssetResults) -> None:
+        portfolio.cash = portfolio.cash * ((1 + self.percent / 100) ** (1 / portfolio.periods_per_year))
@@ -0,0 +1,429 @@
+import math
+import numpy as np
+
+from typing import Sequence, Union
+
+from batch_simulation import BatchSimulationRunner
+from instrumentation import instrumentation
+from invesment_strategies import *
+from market_data import MarketData
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+if numba is not None:
+    jit = numba.njit(cache=True, error_model='numpy')
+    jit_parallel = numba.njit(cache=True, error_model='numpy', parallel=True)
+    prange = numba.prange
+else:
+    def jit(function):
+        return function
+    jit_parallel = jit
+    prange = range
+
+sp500_strategy_kind = 0
+fixed_percent_strategy_kind = 1
+rebalancing_strategy_kind = 2
+
+
+class JitStrategy:
+
+    kind: int
+    growth: float
+    assets: np.ndarray
+    start_target_percents: np.ndarray
+    target_percents: np.ndarray
+    full_rebalancing: bool
+
+    def __init__(
+        self, kind: int, period_count: int, growth: float = 1.0, assets=(), start_target_percents=None, target_percents=None,
+        full_rebalancing: bool = False) -> None:
+        self.kind = kind
+        self.growth = growth
+        self.assets = np.array([asset_indices[asset] for asset in assets], dtype=np.int64)
+        self.start_target_percents = np.zeros(1) if start_target_percents is None else np.ascontiguousarray(start_target_percents, dtype=float)
+        self.target_percents = np.zeros((period_count + 1, 1)) if target_percents is None else np.ascontiguousarray(target_percents, dtype=float)
+        self.full_rebalancing = full_rebalancing
+
+
+# Only strategies whose behaviour is fully described by their configuration can be compiled,
+# subclasses that override what they do are left to the NumPy engine.
+# The kernel doesn't keep tax lots, so strategies that sell are left to the NumPy engine too when capital gains are taxed.
+def get_jit_strategy(
+    investment_strategy: InvestmentStrategy, period_count: int, periods_per_year: int = 1,
+    capital_gains_tax_rate_percent: float = 0) -> Optional[JitStrategy]:
+    if type(investment_strategy) is Sp500Strategy:
+        return JitStrategy(sp500_strategy_kind, period_count)
+    if type(investment_strategy) is FixedPercentStrategy:
+        return JitStrategy(
+            fixed_percent_strategy_kind, period_count, growth=float((1 + investment_strategy.percent / 100) ** (1 / periods_per_year)))
+    if isinstance(investment_strategy, RebalancingStrategy) \
+            and type(investment_strategy).start_investing_batch is RebalancingStrategy.start_investing_batch \
+            and type(investment_strategy).execute_batch is RebalancingStrategy.execute_batch \
+            and all(asset in asset_indices and asset != cash for asset in investment_strategy.assets) \
+            and not (investment_strategy.rebalancing == full_rebalancing and capital_gains_tax_rate_percent):
+        return JitStrategy(
+            rebalancing_strategy_kind,
+            period_count,
+            assets=investment_strategy.assets,
+            start_target_percents=investment_strategy.target_schedule.get_target_percents(100)[0],
+            target_percents=investment_strategy.target_schedule.get_target_percents(period_count),
+            full_rebalancing=investment_strategy.rebalancing == full_rebalancing)
+    return None
+
+
+class JitSimulationRunner(BatchSimulationRunner):
+
+    # Whether the paths are simulated on all CPU cores, see simulate_jit.
+    parallel: bool = True
+
+    def __init__(
+        self, initial_balance: Union[float, np.ndarray], annual_contributions: Union[float, np.ndarray], dividend_tax_rate_percent: float,
+        asset_configs: AssetConfigs, period: str = 'annual', capital_gains_tax_rate_percent: float = 0) -> None:
+        super().__init__(initial_balance, annual_contributions, dividend_tax_rate_percent, asset_configs, period, capital_gains_tax_rate_percent)
+        if numba is None:
+            print('numba is not installed, the jit simulation engine runs as plain Python')
+
+    # Stacking strategies only saves work done in Python per period, which compiled strategies don't have.
+    def simulate_paths_many_periods(
+        self, market_data: MarketData, recorded_periods: list[int], investment_strategies: Sequence[InvestmentStrategy]) -> list[np.ndarray]:
+        compiled = [
+            get_jit_strategy(investment_strategy, max(recorded_periods), self.periods_per_year, self.capital_gains_tax_rate_percent) is not None
+            for investment_strategy in investment_strategies
+        ]
+        batch_balances = iter(super().simulate_paths_many_periods(
+            market_data, recorded_periods,
+            [investment_strategy for investment_strategy, is_compiled in zip(investment_strategies, compiled) if not is_compiled]))
+        return [
+            self.simulate_paths_periods(market_data, recorded_periods, investment_strategy) if is_compiled else next(batch_balances)
+            for investment_strategy, is_compiled in zip(investment_strategies, compiled)
+        ]
+
+    def simulate_paths_periods(self, market_data: MarketData, recorded_periods: list[int], investment_strategy: InvestmentStrategy) -> np.ndarray:
+
+        period_count = max(recorded_periods)
+        jit_strategy = get_jit_strategy(investment_strategy, period_count, self.periods_per_year, self.capital_gains_tax_rate_percent)
+        if jit_strategy is None:
+            return super().simulate_paths_periods(market_data, recorded_periods, investment_strategy)
+
+        # The kernel walks one path at a time, so the values of a path are laid out next to each other.
+        size = market_data.days.shape[1]
+        if instrumentation.enabled:
+            instrumentation.count('simulations', size)
+        prices = np.empty((size, period_count + 1, len(asset_indices)))
+        prices[:, :, cash_index] = 1.0
+        prices[:, :, sp500_index] = market_data.sp500_index.T
+        prices[:, :, asset_indices[vbmfx]] = market_data.vbmfx_price.T
+        prices[:, :, tb10y_index] = 100.0
+        dividends = np.empty((size, period_count + 1, len(asset_indices)))
+        dividends[:, :, cash_index] = 0.0
+        dividends[:, :, sp500_index] = market_data.sp500_dividend.T
+        dividends[:, :, asset_indices[vbmfx]] = market_data.vbmfx_dividend.T
+        dividends[:, :, tb10y_index] = market_data.bonds_10y_rate_percent.T
+        # Fees are taken per period the same way as BatchEquityPosition.pay_fees does.
+        fee_factors = np.zeros(len(asset_indices))
+        accumulate_dividends = np.zeros(len(asset_indices), dtype=np.bool_)
+        for asset, asset_index in asset_indices.items():
+            fee_factors[asset_index] = ((100 - self.asset_configs[asset].fees_percent) / 100) ** (1 / self.periods_per_year)
+            accumulate_dividends[asset_index] = self.asset_configs[asset].accumulate_dividens
+
+        return (simulate_jit if self.parallel else simulate_jit_serial)(
+            jit_strategy.kind, jit_strategy.growth, jit_strategy.assets, jit_strategy.start_target_percents,
+            jit_strategy.target_percents, jit_strategy.full_rebalancing, np.array(recorded_periods, dtype=np.int64), self.periods_per_year,
+            get_bond_ladder_capacity(self.periods_per_year),
+            np.ascontiguousarray(market_data.days.T, dtype=float), np.ascontiguousarray(market_data.cpi.T, dtype=float), prices, dividends,
+            np.zeros(size) + self.initial_balance, np.zeros(size) + self.annual_contributions / self.periods_per_year,
+            float(self.dividend_tax_rate_percent), fee_factors, accumulate_dividends)
+
+
+# The functions below follow BatchSimulationRunner.simulate_paths_periods one path at a time, with the same order of operations.
+
+@jit
+def get_bond_value(face_value, rate_percent, maturity_days, this_days, market_rate_percent):
+    if face_value == 0:
+        return 0.0
+    time_to_maturity = (maturity_days - this_days) * 86400.0 / 3600 / 24 / 365.25
+    rate = market_rate_percent / 100
+    coupon = face_value * rate_percent / 100
+    temp = (1 + rate) ** time_to_maturity
+    if rate == 0:
+        fact = time_to_maturity
+    else:
+        fact = (temp - 1) / rate
+    return (face_value + coupon * fact) / temp
+
+
+@jit
+def get_value(asset, this_days, price, dividends, counts, face_values, rates_percent, maturity_days):
+    if asset == tb10y_index:
+        value = 0.0
+        for slot in range(face_values.shape[0]):
+            value += get_bond_value(face_values[slot], rates_percent[slot], maturity_days[slot], this_days, dividends)
+        return value
+    if asset == cash_index:
+        return counts[cash_index]
+    if math.isnan(price) or math.isnan(dividends):
+        return 0.0
+    return counts[asset] * price
+
+
+@jit
+def buy(asset, value, period_index, this_days, price, dividends, counts, face_values, rates_percent, maturity_days):
+    if asset == tb10y_index:
+        slot = period_index % face_values.shape[0]
+        face_values[slot] += value
+        rates_percent[slot] = dividends
+        maturity_days[slot] = this_days + tb10y_maturity_days
+    elif value != 0:
+        counts[asset] = counts[asset] + value / price
+    counts[cash_index] = counts[cash_index] - value
+
+
+@jit
+def sell(asset, value, period_index, this_days, price, dividends, counts, face_values, rates_percent, maturity_days):
+    if asset == tb10y_index:
+        capacity = face_values.shape[0]
+        sold_after = 0.0
+        for position in range(capacity):
+            slot = (period_index + 1 + position) % capacity
+            bond_value = get_bond_value(face_values[slot], rates_percent[slot], maturity_days[slot], this_days, dividends)
+            sold_after = sold_after + bond_value
+            sold_before = sold_after - bond_value
+            if sold_after < value:
+                face_values[slot] *= 0.0
+            elif sold_before < value:
+                face_values[slot] *= 1 - (value - sold_before) / bond_value
+    elif value != 0:
+        counts[asset] = counts[asset] - value / price
+    counts[cash_index] = counts[cash_index] + value
+
+
+@jit
+def is_waiting_for_data(assets, prices, dividends):
+    for asset in assets[1:]:
+        if math.isnan(prices[asset]) or math.isnan(dividends[asset]):
+            return True
+    return False
+
+
+@jit
+def start_rebalancing(assets, target_percents, period_index, this_days, prices, dividends, counts, face_values, rates_percent, maturity_days):
+    if is_waiting_for_data(assets, prices, dividends):
+        asset = assets[0]
+        buy(asset, counts[cash_index], period_index, this_days, prices[asset], dividends[asset], counts, face_values, rates_percent, maturity_days)
+        return
+    initial_cash = counts[cash_index]
+    for asset_index in range(assets.shape[0] - 1):
+        asset = assets[asset_index]
+        buy(
+            asset, initial_cash * target_percents[asset_index] / 100, period_index, this_days, prices[asset], dividends[asset],
+            counts, face_values, rates_percent, maturity_days)
+    asset = assets[assets.shape[0] - 1]
+    buy(asset, counts[cash_index], period_index, this_days, prices[asset], dividends[asset], counts, face_values, rates_percent, maturity_days)
+
+
+@jit
+def rebalance(
+    assets, target_percents, full_rebalancing, period_index, this_days, prices, dividends, counts, face_values, rates_percent, maturity_days,
+    balances, target_balances, deficits):
+
+    asset_count = assets.shape[0]
+    cash_to_contribute = counts[cash_index]
+
+    if is_waiting_for_data(assets, prices, dividends):
+        asset = assets[0]
+        buy(asset, cash_to_contribute, period_index, this_days, prices[asset], dividends[asset], counts, face_values, rates_percent, maturity_days)
+        return
+
+    for asset_index in range(asset_count):
+        asset = assets[asset_index]
+        balances[asset_index] = get_value(
+            asset, this_days, prices[asset], dividends[asset], counts, face_values, rates_percent, maturity_days)
+    invested_balance = balances[0]
+    for asset_index in range(1, asset_count):
+        invested_balance = invested_balance + balances[asset_index]
+
+    if not full_rebalancing:
+        chosen_asset_index = asset_count - 1
+        for asset_index in range(asset_count - 2, -1, -1):
+            if balances[asset_index] / invested_balance * 100 <= target_percents[asset_index]:
+                chosen_asset_index = asset_index
+        asset = assets[chosen_asset_index]
+        buy(asset, cash_to_contribute, period_index, this_days, prices[asset], dividends[asset], counts, face_values, rates_percent, maturity_days)
+        return
+
+    total_balance = invested_balance + cash_to_contribute
+    last_target_balance = total_balance
+    for asset_index in range(asset_count - 1):
+        target_balances[asset_index] = total_balance * target_percents[asset_index] / 100
+        last_target_balance = last_target_balance - target_balances[asset_index]
+    target_balances[asset_count - 1] = last_target_balance
+
+    for asset_index in range(asset_count):
+        asset = assets[asset_index]
+        if target_balances[asset_index] <= balances[asset_index]:
+            sell(
+                asset, balances[asset_index] - target_balances[asset_index], period_index, this_days, prices[asset], dividends[asset],
+                counts, face_values, rates_percent, maturity_days)
+            deficits[asset_index] = 0.0
+        else:
+            deficits[asset_index] = target_balances[asset_index] - balances[asset_index]
+
+    cash_to_invest = counts[cash_index]
+    deficit_sum = deficits[0]
+    for asset_index in range(1, asset_count):
+        deficit_sum = deficit_sum + deficits[asset_index]
+    for asset_index in range(asset_count):
+        if deficits[asset_index] > 0:
+            asset = assets[asset_index]
+            buy(
+                asset, cash_to_invest * deficits[asset_index] / deficit_sum, period_index, this_days, prices[asset], dividends[asset],
+                counts, face_values, rates_percent, maturity_days)
+
+
+@jit
+def execute_strategy(
+    kind, growth, assets, target_percents, full_rebalancing, period_index, this_days, prices, dividends,
+    counts, face_values, rates_percent, maturity_days, balances, target_balances, deficits):
+
+    if kind == sp500_strategy_kind:
+        asset = sp500_index
+        buy(asset, counts[cash_index], period_index, this_days, prices[asset], dividends[asset], counts, face_values, rates_percent, maturity_days)
+    elif kind == fixed_percent_strategy_kind:
+        counts[cash_index] = counts[cash_index] * growth
+    else:
+        rebalance(
+            assets, target_percents, full_rebalancing, period_index, this_days, prices, dividends, counts, face_values, rates_percent, maturity_days,
+            balances, target_balances, deficits)
+
+
+@jit
+def record_balances(
+    recorded_periods, period_index, column, days, cpi, prices, dividends, counts, face_values, rates_percent, maturity_days, final_balances):
+    for recorded_index in range(recorded_periods.shape[0]):
+        if recorded_periods[recorded_index] == period_index:
+            balance = 0.0
+            for asset in range(prices.shape[2]):
+                balance += get_value(
+                    asset, days[column, period_index], prices[column, period_index, asset], dividends[column, period_index, asset],
+                    counts, face_values, rates_percent, maturity_days)
+            final_balances[recorded_index, column] = balance * cpi[column, 0] / cpi[column, period_index]
+
+
+@jit
+def simulate_path_jit(
+    column, kind, growth, assets, start_target_percents, target_percents, full_rebalancing, recorded_periods, periods_per_year,
+    bond_ladder_capacity, days, cpi, prices, dividends, initial_balances, contributions, dividend_tax_rate_percent, fee_factors,
+    accumulate_dividends, final_balances):
+
+    asset_count = prices.shape[2]
+    period_count = recorded_periods.max()
+
+    counts = np.zeros(asset_count)
+    counts[cash_index] = initial_balances[column]
+    face_values = np.zeros(bond_ladder_capacity)
+    rates_percent = np.zeros(bond_ladder_capacity)
+    maturity_days = np.zeros(bond_ladder_capacity)
+    balances = np.empty(assets.shape[0])
+    target_balances = np.empty(assets.shape[0])
+    deficits = np.empty(assets.shape[0])
+
+    for period_index in range(period_count + 1):
+
+        this_days = days[column, period_index]
+        period_prices = prices[column, period_index]
+        period_dividends = dividends[column, period_index]
+
+        if period_index == 0:
+            if kind == sp500_strategy_kind:
+                execute_strategy(
+                    kind, growth, assets, start_target_percents, full_rebalancing, period_index, this_days, period_prices, period_dividends,
+                    counts, face_values, rates_percent, maturity_days, balances, target_balances, deficits)
+            elif kind == rebalancing_strategy_kind:
+                start_rebalancing(
+                    assets, start_target_percents, period_index, this_days, period_prices, period_dividends,
+                    counts, face_values, rates_percent, maturity_days)
+            record_balances(
+                recorded_periods, period_index, column, days, cpi, prices, dividends, counts, face_values, rates_percent, maturity_days,
+                final_balances)
+            continue
+
+        for asset in range(asset_count):
+            if asset == cash_index:
+                asset_dividends = 0.0
+            elif asset == tb10y_index:
+                asset_dividends = 0.0
+                for slot in range(bond_ladder_capacity):
+                    asset_dividends += face_values[slot] * rates_percent[slot] / 100
+            elif math.isnan(period_prices[asset]) or math.isnan(period_dividends[asset]):
+                asset_dividends = 0.0
+            else:
+                asset_dividends = counts[asset] * period_dividends[asset]
+            dividends_post_tax = asset_dividends / periods_per_year * (100 - dividend_tax_rate_percent) / 100
+            counts[cash_index] = counts[cash_index] + dividends_post_tax
+            if accumulate_dividends[asset]:
+                buy(
+                    asset, dividends_post_tax, period_index, this_days, period_prices[asset], period_dividends[asset],
+                    counts, face_values, rates_percent, maturity_days)
+
+        maturity = 0.0
+        for slot in range(bond_ladder_capacity):
+            if this_days >= maturity_days[slot]:
+                maturity += face_values[slot]
+                face_values[slot] = 0.0
+        counts[cash_index] = counts[cash_index] + maturity
+
+        for asset in range(asset_count):
+            if asset != cash_index and asset != tb10y_index:
+                counts[asset] = counts[asset] * fee_factors[asset]
+
+        counts[cash_index] = counts[cash_index] + contributions[column] * cpi[column, period_index] / cpi[column, 0]
+
+        execute_strategy(
+            kind, growth, assets, target_percents[period_index], full_rebalancing, period_index, this_days, period_prices, period_dividends,
+            counts, face_values, rates_percent, maturity_days, balances, target_balances, deficits)
+
+        record_balances(
+            recorded_periods, period_index, column, days, cpi, prices, dividends, counts, face_values, rates_percent, maturity_days,
+            final_balances)
+
+
+# Paths are independent, so they are spread over all CPU cores.
+@jit_parallel
+def simulate_jit(
+    kind, growth, assets, start_target_percents, target_percents, full_rebalancing, recorded_periods, periods_per_year, bond_ladder_capacity,
+    days, cpi, prices, dividends, initial_balances, contributions, dividend_tax_rate_percent, fee_factors, accumulate_dividends):
+
+    size = days.shape[0]
+    final_balances = np.empty((recorded_periods.shape[0], size))
+    for column in prange(size):
+        simulate_path_jit(
+            column, kind, growth, assets, start_target_percents, target_percents, full_rebalancing, recorded_periods, periods_per_year,
+            bond_ladder_capacity, days, cpi, prices, dividends, initial_balances, contributions, dividend_tax_rate_percent, fee_factors,
+            accumulate_dividends, final_balances)
+    return final_balances
+
+
+# Same as simulate_jit, but on the calling thread only.
+@jit
+def simulate_jit_serial(
+    kind, growth, assets, start_target_percents, target_percents, full_rebalancing, recorded_periods, periods_per_year, bond_ladder_capacity,
+    days, cpi, prices, dividends, initial_balances, contributions, dividend_tax_rate_percent, fee_factors, accumulate_dividends):
+
+    size = days.shape[0]
+    final_balances = np.empty((recorded_periods.shape[0], size))
+    for column in range(size):
+        simulate_path_jit(
+            column, kind, growth, assets, start_target_percents, target_percents, full_rebalancing, recorded_periods, periods_per_year,
+            bond_ladder_capacity, days, cpi, prices, dividends, initial_balances, contributions, dividend_tax_rate_percent, fee_factors,
+            accumulate_dividends, final_balances)
+    return final_balances
+
+
+# numba's parallel threading layer keeps the process from exiting once it was started from a thread other than the main one,
+# so code that simulates on threads of its own, such as the query server, runs the paths of a simulation on the calling thread.
+class SerialJitSimulationRunner(JitSimulationRunner):
+
+    parallel = False
@@ -0,0 +1,324 @@
+import csv
+import datetime as dt
+import hashlib
+import itertools as it
+import json
+import numpy as np
+import os
+import pandas as pd
+
+from numpy.lib.stride_tricks import as_strided
+
+from instrumentation import instrumentation
+
+columns = ('cpi', 'sp500_index', 'sp500_dividend', 'vbmfx_price', 'vbmfx_dividend', 'bonds_10y_rate_percent')
+
+vbmfx_data_price_path = os.path.join('data', 'bonds', 'vbmfx_price.csv')
+vbmfx_data_div_yield_path = os.path.join('data', 'bonds', 'vbmfx_div_yield.csv')
+sp500_data_path = os.path.join('data', 'sp500', 'data', 'data_csv.csv')
+sp500_data_path_new = os.path.join('data', 'sp500_new', 'data.csv')
+source_paths = [vbmfx_data_price_path, vbmfx_data_div_yield_path, sp500_data_path, sp500_data_path_new]
+
+market_data_cache_dir = os.path.join('.cache', 'market_data')
+daily_data_cache_dir = os.path.join('.cache', 'daily_data')
+
+# How the values of a month of a daily series are turned into the value of the month: its first value, its last value or their average.
+daily_samplings = ('month_start', 'month_end', 'mean')
+
+
+class MarketData:
+
+    dates: np.ndarray
+    timestamps: np.ndarray
+    days: np.ndarray
+    cpi: np.ndarray
+    sp500_index: np.ndarray
+    sp500_dividend: np.ndarray
+    vbmfx_price: np.ndarray
+    vbmfx_dividend: np.ndarray
+    bonds_10y_rate_percent: np.ndarray
+
+    def __init__(self, dates: np.ndarray, timestamps: np.ndarray, days: np.ndarray, **column_values: np.ndarray) -> None:
+        self.dates = dates
+        self.timestamps = timestamps
+        self.days = days
+        for column in columns:
+            setattr(self, column, column_values[column])
+
+    @staticmethod
+    def from_data_frame(data: pd.DataFrame) -> 'MarketData':
+        dates = data['date'].to_numpy().astype('datetime64[D]')
+        timestamps = np.empty(dates.shape[0], dtype=object)
+        timestamps[:] = list(pd.DatetimeIndex(dates))
+        return MarketData(
+            dates,
+            timestamps,
+            dates.astype(np.int64).astype(float),
+            **{column: np.ascontiguousarray(data[column].to_numpy(dtype=float)) for column in columns})
+
+    def __len__(self) -> int:
+        return self.dates.shape[0]
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return len(self), len(columns) + 1
+
+    # Rows of the investment horizon starting from skip_rows, one every months_per_period months.
+    def periodic(self, skip_rows: int, investment_years: int, months_per_period: int = 12) -> 'MarketData':
+        stop = skip_rows + investment_years * 12 + 1
+        if skip_rows < 0 or stop > len(self):
+            raise IndexError(f'Rows {skip_rows}..{stop - 1} are out of range for {len(self)} rows')
+        return self._map(lambda values: values[skip_rows:stop:months_per_period])
+
+    def periodic_batch(self, skip_rows: range, investment_years: int, months_per_period: int = 12) -> 'MarketData':
+        period_count = investment_years * 12 // months_per_period
+        if not isinstance(skip_rows, range) or skip_rows.step != 1 or not skip_rows:
+            rows = np.asarray(skip_rows) + months_per_period * np.arange(period_count + 1)[:, np.newaxis]
+            return self._map(lambda values: values[rows])
+        stop = skip_rows[-1] + investment_years * 12 + 1
+        if skip_rows.start < 0 or stop > len(self):
+            raise IndexError(f'Rows {skip_rows.start}..{stop - 1} are out of range for {len(self)} rows')
+        shape = (period_count + 1, len(skip_rows))
+        return self._map(lambda values: as_strided(
+            values[skip_rows.start:],
+            shape=shape,
+            strides=(values.strides[0] * months_per_period, values.strides[0]),
+            writeable=False))
+
+    def tile(self, count: int) -> 'MarketData':
+        return self._map(lambda values: np.tile(values, (1, count)))
+
+    def _map(self, view) -> 'MarketData':
+        return MarketData(
+            view(self.dates),
+            view(self.timestamps),
+            view(self.days),
+            **{column: view(getattr(self, column)) for column in columns})
+
+
+def get_row_checksums(market_data: MarketData) -> np.ndarray:
+    rows = np.column_stack(
+        [market_data.dates.astype('datetime64[D]').astype(np.int64)]
+        + [np.ascontiguousarray(getattr(market_data, column)).view(np.int64) for column in columns])
+    return np.frombuffer(
+        b''.join(hashlib.blake2b(row.tobytes(), digest_size=8).digest() for row in rows),
+        dtype=np.uint64)
+
+
+def as_market_data(data) -> MarketData:
+    if isinstance(data, MarketData):
+        return data
+    return MarketData.from_data_frame(data)
+
+
+# Values of a daily series sorted by date, without the days that have no value.
+class DailySeries:
+
+    dates: np.ndarray
+    values: np.ndarray
+
+    def __init__(self, dates: np.ndarray, values: np.ndarray) -> None:
+        self.dates = dates
+        self.values = values
+
+    # Files such as data/bonds/vbmfx_price.csv have a Date and a Value column and are ordered from the newest day.
+    @staticmethod
+    def from_csv(path: str) -> 'DailySeries':
+        data = pd.read_csv(path, encoding='utf-8-sig', usecols=['Date', 'Value'], dtype=dict(Date=str), float_precision='round_trip')
+        data = data[data['Value'].notna()]
+        dates = pd.to_datetime(data['Date'], format='%Y-%m-%d').to_numpy().astype('datetime64[D]')
+        order = np.argsort(dates, kind='stable')
+        return DailySeries(dates[order], data['Value'].to_numpy(dtype=float)[order])
+
+    def __len__(self) -> int:
+        return self.dates.shape[0]
+
+    # One value per month of the given dates, NaN for months without values.
+    # The days of every month are found by a binary search of the first days of the month and of the next month.
+    def resample(self, month_dates: np.ndarray, sampling: str = 'month_end') -> np.ndarray:
+        if sampling not in daily_samplings:
+            raise ValueError(f'Unknown daily sampling {sampling}, expected one of {", ".join(daily_samplings)}')
+        months = np.asarray(month_dates).astype('datetime64[M]')
+        firsts = np.searchsorted(self.dates, months.astype('datetime64[D]'), side='left')
+        ends = np.searchsorted(self.dates, (months + 1).astype('datetime64[D]'), side='left')
+        has_values = ends > firsts
+        resampled = np.full(months.shape[0], np.nan)
+        if sampling == 'month_start':
+            resampled[has_values] = self.values[firsts[has_values]]
+        elif sampling == 'month_end':
+            resampled[has_values] = self.values[ends[has_values] - 1]
+        else:
+            sums = np.concatenate([[0.0], np.cumsum(self.values)])
+            resampled[has_values] = (sums[ends] - sums[firsts])[has_values] / (ends - firsts)[has_values]
+        return resampled
+
+
+# Parses a daily file once and keeps the sorted dates and values as .npy files, which are memory mapped on later loads.
+def load_daily_series(path: str, cache_dir: str = daily_data_cache_dir) -> DailySeries:
+
+    name = os.path.splitext(path)[0].replace(os.sep, '_')
+    manifest_path = os.path.join(cache_dir, f'{name}.json')
+    try:
+        with open(manifest_path, encoding='utf-8') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        manifest = None
+
+    if manifest is not None and _is_cache_fresh(manifest, manifest_path, [path]):
+        try:
+            return DailySeries(
+                np.load(os.path.join(cache_dir, f'{name}.dates.npy'), mmap_mode='r'),
+                np.load(os.path.join(cache_dir, f'{name}.values.npy'), mmap_mode='r'))
+        except (OSError, ValueError):
+            pass
+
+    daily_series = DailySeries.from_csv(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(os.path.join(cache_dir, f'{name}.dates.npy'), daily_series.dates)
+    np.save(os.path.join(cache_dir, f'{name}.values.npy'), daily_series.values)
+    _write_manifest(manifest_path, dict(code=_hash_file(__file__), sources={path: dict(_stat_file(path), sha256=_hash_file(path))}))
+
+    return daily_series
+
+
+def get_data(daily_sampling: str = 'month_end', cache_dir: str = daily_data_cache_dir):
+
+    vbmfx_prices = load_daily_series(vbmfx_data_price_path, cache_dir)
+    vbmfx_div_yields = load_daily_series(vbmfx_data_div_yield_path, cache_dir)
+
+    column_date = []
+    column_cpi = []
+    column_bonds_10y_rate_percent = []
+    column_sp500_index = []
+    column_sp500_dividend = []
+
+    print('getting data')
+
+    with open(sp500_data_path, newline='', encoding='utf-8-sig') as csvfile:
+        with open(sp500_data_path_new, newline='', encoding='utf-8-sig') as csvfile_new:
+
+            csvreader = csv.DictReader(csvfile)
+            csvreader_new = csv.DictReader(csvfile_new)
+
+            for row in it.chain(
+                (row for row in csvreader if row['Date'] <= '2017-12-01'),
+                (row for row in csvreader_new if row['Date'] > '2017-12-01')):
+
+                this_date_str = row['Date']
+
+                date_parts = this_date_str.split('-')
+                year = date_parts[0]
+                month = date_parts[1]
+                day = date_parts[2]
+
+                this_date = dt.date(year=int(year), month=int(month), day=int(day))
+
+                index_str = row['SP500']
+                dividend_str = row['Dividend']
+                cpi_str = row['Consumer Price Index']
+                long_interest_rate_str = row['Long Interest Rate']
+
+                if not index_str or not dividend_str or not cpi_str:
+                    continue
+
+                column_date.append(pd.to_datetime(this_date))
+                column_cpi.append(float(cpi_str))
+                column_bonds_10y_rate_percent.append(float(long_interest_rate_str))
+
+                column_sp500_index.append(float(index_str))
+                column_sp500_dividend.append(float(dividend_str))
+
+        column_vbmfx_price = vbmfx_prices.resample(np.array(column_date, dtype='datetime64[D]'), daily_sampling)
+        vbmfx_rates = vbmfx_div_yields.resample(np.array(column_date, dtype='datetime64[D]'), daily_sampling)
+        column_vbmfx_dividend = np.where((column_vbmfx_price != 0) & (vbmfx_rates != 0), column_vbmfx_price * vbmfx_rates / 100, np.nan)
+
+        return pd.DataFrame({
+            'date': column_date,
+            'cpi': column_cpi,
+            'bonds_10y_rate_percent': column_bonds_10y_rate_percent,
+            'sp500_index': column_sp500_index,
+            'sp500_dividend': column_sp500_dividend,
+            'vbmfx_price': column_vbmfx_price,
+            'vbmfx_dividend': column_vbmfx_dividend,
+        })
+
+
+def load_market_data(cache_dir: str = market_data_cache_dir, daily_sampling: str = 'month_end') -> MarketData:
+
+    manifest_path = os.path.join(cache_dir, 'manifest.json')
+    try:
+        with open(manifest_path, encoding='utf-8') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        manifest = None
+
+    if manifest is not None and manifest.get('daily_sampling') == daily_sampling and _is_cache_fresh(manifest, manifest_path, source_paths):
+        try:
+            return _load_cached_columns(cache_dir)
+        except (OSError, ValueError):
+            pass
+
+    with instrumentation.phase('get_data'):
+        data = get_data(daily_sampling)
+    data.to_csv('main_data.csv')
+    market_data = MarketData.from_data_frame(data)
+
+    print('writing market data cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(os.path.join(cache_dir, 'dates.npy'), market_data.dates)
+    for column in columns:
+        np.save(os.path.join(cache_dir, f'{column}.npy'), getattr(market_data, column))
+    _write_manifest(manifest_path, dict(
+        code=_hash_file(__file__),
+        daily_sampling=daily_sampling,
+        sources={path: dict(_stat_file(path), sha256=_hash_file(path)) for path in source_paths}))
+
+    return market_data
+
+
+def _is_cache_fresh(manifest: dict, manifest_path: str, paths: list[str]) -> bool:
+    if manifest.get('code') != _hash_file(__file__) or set(manifest['sources']) != set(paths):
+        return False
+    touched = False
+    for path in paths:
+        source = manifest['sources'][path]
+        stat = _stat_file(path)
+        if stat == dict(size=source['size'], mtime_ns=source['mtime_ns']):
+            continue
+        if _hash_file(path) != source['sha256']:
+            return False
+        source.update(stat)
+        touched = True
+    if touched:
+        _write_manifest(manifest_path, manifest)
+    return True
+
+
+def _load_cached_columns(cache_dir: str) -> MarketData:
+    dates = np.load(os.path.join(cache_dir, 'dates.npy'), mmap_mode='r')
+    timestamps = np.empty(dates.shape[0], dtype=object)
+    timestamps[:] = list(pd.DatetimeIndex(dates))
+    return MarketData(
+        dates,
+        timestamps,
+        dates.astype(np.int64).astype(float),
+        **{column: np.load(os.path.join(cache_dir, f'{column}.npy'), mmap_mode='r') for column in columns})
+
+
+def _write_manifest(manifest_path: str, manifest: dict) -> None:
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(temp_path, manifest_path)
+
+
+def _stat_file(path: str) -> dict:
+    stat = os.stat(path)
+    return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source_file:
+        digest.update(source_file.read())
+    return digest.hexdigest()
@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+
+from balance_store import BalanceWriter
+from batch_simulation import BatchSimulationRunner
+from market_data import MarketData
+from sweep import max_batch_columns
+
+
+# Builds synthetic market histories by gluing together blocks of consecutive historical months picked at random.
+# All columns of a month are taken together, so the correlation between stocks, bonds and inflation is preserved.
+# Prices and CPI are chained from the monthly returns of the picked months, while rates and dividend yields are taken as they are.
+class BlockBootstrap:
+
+    market_data: MarketData
+    path_count: int
+    investment_years: int
+    block_months: int
+    block_starts: np.ndarray
+
+    def __init__(self, market_data: MarketData, path_count: int, investment_years: int, block_months: int, seed: int) -> None:
+        if block_months < 1 or block_months >= len(market_data):
+            raise ValueError(f'Block size of {block_months} months must be between 1 and {len(market_data) - 1}')
+        self.market_data = market_data
+        self.path_count = path_count
+        self.investment_years = investment_years
+        self.block_months = block_months
+        block_count = -(-investment_years * 12 // block_months)
+        # Block b supplies the returns of months b * block_months + 1 .. (b + 1) * block_months of every path.
+        # The month before the first block is the starting month of the path.
+        self.block_starts = np.random.default_rng(seed).integers(
+            1, len(market_data) - block_months + 1, size=(block_count, path_count))
+
+    # Values at the start of every period of months_per_period months, for the selected paths.
+    def get_paths(self, investment_years: int, months_per_period: int = 12, paths: slice = slice(None)) -> MarketData:
+
+        if investment_years > self.investment_years:
+            raise ValueError(f'Paths were generated for {self.investment_years} years, not {investment_years}')
+
+        market_data = self.market_data
+        path_block_starts = self.block_starts[:, paths]
+        path_count = path_block_starts.shape[1]
+        period_count = investment_years * 12 // months_per_period
+        period_months = months_per_period * np.arange(period_count + 1)
+        path_months = period_months[1:]
+        block_indices = (path_months - 1) // self.block_months
+        block_starts = path_block_starts[block_indices]
+        sources = np.vstack([path_block_starts[0] - 1, block_starts + ((path_months - 1) % self.block_months)[:, np.newaxis]])
+
+        def get_levels(values: np.ndarray, valid: np.ndarray) -> np.ndarray:
+            log_returns = np.zeros(values.shape[0])
+            both_valid = valid[1:] & valid[:-1]
+            log_returns[1:][both_valid] = np.log(values[1:][both_valid] / values[:-1][both_valid])
+            cumulative = np.cumsum(log_returns)
+            block_totals = cumulative[path_block_starts + self.block_months - 1] - cumulative[path_block_starts - 1]
+            totals_before = np.vstack([np.zeros(path_count), np.cumsum(block_totals, axis=0)[:-1]])
+            log_levels = totals_before[block_indices] + cumulative[sources[1:]] - cumulative[block_starts - 1]
+            return np.exp(np.vstack([np.zeros(path_count), log_levels]))
+
+        all_valid = np.ones(len(market_data), dtype=bool)
+
+        cpi = market_data.cpi[sources[0]] * get_levels(market_data.cpi, all_valid)
+
+        sp500_index = market_data.sp500_index[sources[0]] * get_levels(market_data.sp500_index, all_valid)
+        sp500_dividend = sp500_index * (market_data.sp500_dividend / market_data.sp500_index)[sources]
+
+        vbmfx_valid = ~np.isnan(market_data.vbmfx_price) & ~np.isnan(market_data.vbmfx_dividend)
+        vbmfx_price = market_data.vbmfx_price[vbmfx_valid][0] * get_levels(market_data.vbmfx_price, vbmfx_valid)
+        vbmfx_dividend = vbmfx_price * (market_data.vbmfx_dividend / market_data.vbmfx_price)[sources]
+        vbmfx_is_empty = period_months[:, np.newaxis] <= self._get_last_invalid_months(investment_years, path_block_starts, sources, vbmfx_valid)
+        vbmfx_price[vbmfx_is_empty] = np.nan
+        vbmfx_dividend[vbmfx_is_empty] = np.nan
+
+        # Synthetic paths share a calendar, which only matters for the maturity of bonds.
+        dates = np.datetime64(market_data.dates[0], 'M') + period_months
+        dates = dates.astype('datetime64[D]')
+        timestamps = np.empty(dates.shape[0], dtype=object)
+        timestamps[:] = list(pd.DatetimeIndex(dates))
+        shape = (period_count + 1, path_count)
+
+        return MarketData(
+            np.broadcast_to(dates[:, np.newaxis], shape),
+            np.broadcast_to(timestamps[:, np.newaxis], shape),
+            np.broadcast_to(dates.astype(np.int64).astype(float)[:, np.newaxis], shape),
+            cpi=cpi,
+            sp500_index=sp500_index,
+            sp500_dividend=sp500_dividend,
+            vbmfx_price=vbmfx_price,
+            vbmfx_dividend=vbmfx_dividend,
+            bonds_10y_rate_percent=market_data.bonds_10y_rate_percent[sources])
+
+    # An asset can't disappear in the middle of a simulation, so an asset that has no data for some month of a path
+    # is treated as empty from the start of the path up to the last such month.
+    def _get_last_invalid_months(self, investment_years: int, path_block_starts: np.ndarray, sources: np.ndarray, valid: np.ndarray) -> np.ndarray:
+        invalid_returns = np.ones(valid.shape[0], dtype=bool)
+        invalid_returns[1:] = ~(valid[1:] & valid[:-1])
+        last_invalid_returns = np.maximum.accumulate(np.where(invalid_returns, np.arange(valid.shape[0]), -1))
+
+        month_count = investment_years * 12
+        block_count = -(-month_count // self.block_months)
+        block_first_months = self.block_months * np.arange(block_count)[:, np.newaxis] + 1
+        block_starts = path_block_starts[:block_count]
+        block_lengths = np.minimum(self.block_months, month_count + 1 - block_first_months)
+        last_invalid = last_invalid_returns[block_starts + block_lengths - 1]
+        # A month that has data but follows a month without data starts the asset anew, like the first month of its history does.
+        last_invalid_months = np.where(
+            last_invalid >= block_starts,
+            block_first_months + last_invalid - block_starts - valid[last_invalid],
+            -1).max(axis=0)
+        return np.where(valid[sources[0]], last_invalid_months, np.maximum(last_invalid_months, 0))
+
+
+default_balances_path = 'balance_monte_carlo_{investment_years}y.arrow'
+
+
+# Paths are simulated and written in chunks of at most max_batch_columns paths times strategies, so the memory used doesn't grow with path_count.
+def gather_monte_carlo_balances(
+    market_data: MarketData, investment_strategies, investment_years_options: list[int], simulation_runner: BatchSimulationRunner,
+    path_count: int, block_months: int, seed: int, balances_path: str = default_balances_path) -> dict[int, str]:
+
+    print(f'gathering balances for {path_count} synthetic paths made of blocks of {block_months} months')
+
+    bootstrap = BlockBootstrap(market_data, path_count, max(investment_years_options), block_months, seed)
+    chunk_size = max(1, max_batch_columns // len(investment_strategies))
+
+    balances_paths = {}
+    for investment_years in investment_years_options:
+        print(f'  processing investment years {investment_years}')
+        balances_paths[investment_years] = balances_path.format(investment_years=investment_years)
+        with BalanceWriter(
+                balances_paths[investment_years], [investment_strategy_label for _, investment_strategy_label in investment_strategies],
+                key_column='path') as writer:
+            for chunk_start in range(0, path_count, chunk_size):
+                chunk = slice(chunk_start, min(chunk_start + chunk_size, path_count))
+                final_balances = simulation_runner.simulate_paths_many(
+                    bootstrap.get_paths(investment_years, simulation_runner.months_per_period, chunk), investment_years,
+                    [investment_strategy for investment_strategy, _ in investment_strategies])
+                for strategy_index, strategy_balances in enumerate(final_balances):
+                    writer.write(strategy_index, np.arange(chunk.start, chunk.stop), strategy_balances)
+
+    return balances_paths
@@ -0,0 +1,129 @@
+import argparse
+import numpy as np
+import pandas as pd
+import parameters
+
+from batch_simulation import BatchSimulationRunner
+from invesment_strategies import *
+from market_data import MarketData, load_market_data
+from simulation import get_skip_rows
+from sweep import max_batch_columns
+
+strategy_families = {
+    family.__name__: family
+    for family in (Sp500AndVbmfxStrategyWoSelling, Sp500AndTb10yStrategyWoSelling, Sp500AndVbmfxStrategyWithSelling, Sp500AndTb10yStrategyWithSelling)
+}
+
+objectives = ('median', 'percentile', 'cvar')
+
+
+# Objectives of the final balances of every candidate, given as a (candidates, starting months) array.
+# percentile is the given percentile of the final balance and cvar is the mean of the given percent of the worst final balances.
+def get_objective_values(final_balances: np.ndarray, objective: str, percent: float) -> np.ndarray:
+    if objective == 'median':
+        return np.median(final_balances, axis=1)
+    if objective == 'percentile':
+        return np.percentile(final_balances, percent, axis=1)
+    if objective == 'cvar':
+        tail_count = max(1, int(np.ceil(final_balances.shape[1] * percent / 100)))
+        return np.sort(final_balances, axis=1)[:, :tail_count].mean(axis=1)
+    raise ValueError(f'Unknown objective {objective}, expected one of {", ".join(objectives)}')
+
+
+# Fixed targets for every target percent and, with glide_paths, linearly changing targets for every pair of different start and end percents.
+def get_candidates(target_sp500_percents: list[float], glide_paths: bool) -> list[tuple[float, float]]:
+    candidates = [(target_sp500_percent, target_sp500_percent) for target_sp500_percent in target_sp500_percents]
+    if glide_paths:
+        candidates += [
+            (target_sp500_percent_start, target_sp500_percent_end)
+            for target_sp500_percent_start in target_sp500_percents
+            for target_sp500_percent_end in target_sp500_percents
+            if target_sp500_percent_start != target_sp500_percent_end
+        ]
+    return candidates
+
+
+def get_candidate_strategy(family: type, target_sp500_percent_start: float, target_sp500_percent_end: float) -> RebalancingStrategy:
+    if target_sp500_percent_start == target_sp500_percent_end:
+        return family(fixed_target_sp500_percent(target_sp500_percent_start))
+    return family(linearly_changing_target_sp500_percent(target_sp500_percent_start, target_sp500_percent_end))
+
+
+# Rebalancing strategies over the same assets are stacked by the batch engine, so every chunk of candidates is simulated
+# in a single run over the starting months tiled once per candidate.
+def get_candidate_balances(
+    market_data: MarketData, simulation_runner: BatchSimulationRunner, skip_rows, investment_years: int,
+    candidate_strategies: list[RebalancingStrategy]) -> np.ndarray:
+
+    periodic_data = market_data.periodic_batch(skip_rows, investment_years, simulation_runner.months_per_period)
+    start_count = len(skip_rows)
+    chunk_size = max(1, max_batch_columns // max(1, start_count))
+    chunks = []
+    for chunk_start in range(0, len(candidate_strategies), chunk_size):
+        chunk_strategies = candidate_strategies[chunk_start:chunk_start + chunk_size]
+        print(f'  simulating candidates {chunk_start + 1} to {chunk_start + len(chunk_strategies)} of {len(candidate_strategies)}')
+        chunks += simulation_runner.simulate_paths_many(periodic_data, investment_years, chunk_strategies)
+    return np.array(chunks).reshape(len(candidate_strategies), start_count)
+
+
+def optimize(
+    market_data: MarketData, investment_years_options: list[int],
+    initial_balance: float, annual_contributions: float, dividend_tax_rate_percent: float, asset_configs: AssetConfigs,
+    families: list[str], target_sp500_percents: list[float], glide_paths: bool = True, objective: str = 'median', percent: float = 10,
+    start_from: int = 0, period: str = 'annual', capital_gains_tax_rate_percent: float = 0) -> pd.DataFrame:
+
+    if objective not in objectives:
+        raise ValueError(f'Unknown objective {objective}, expected one of {", ".join(objectives)}')
+
+    simulation_runner = BatchSimulationRunner(
+        initial_balance, annual_contributions, dividend_tax_rate_percent, asset_configs, period, capital_gains_tax_rate_percent)
+    candidates = get_candidates(target_sp500_percents, glide_paths)
+    starts, ends = (np.array(values, dtype=float) for values in zip(*candidates))
+
+    tables = []
+
+    for investment_years in investment_years_options:
+
+        skip_rows = get_skip_rows(len(market_data), start_from, investment_years)
+
+        for family_name in families:
+
+            print(f'optimizing {len(candidates)} candidates of {family_name} for investment years {investment_years}')
+            final_balances = get_candidate_balances(
+                market_data, simulation_runner, skip_rows, investment_years,
+                [get_candidate_strategy(strategy_families[family_name], start, end) for start, end in candidates])
+
+            tables.append(pd.DataFrame(dict(
+                investment_years=investment_years,
+                strategy_family=family_name,
+                target_sp500_percent_start=starts,
+                target_sp500_percent_end=ends,
+                objective=get_objective_values(final_balances, objective, percent),
+                median_final_balance=get_objective_values(final_balances, 'median', percent),
+                percentile_final_balance=get_objective_values(final_balances, 'percentile', percent),
+                cvar_final_balance=get_objective_values(final_balances, 'cvar', percent))))
+
+    return pd.concat(tables, ignore_index=True) \
+        .sort_values(['investment_years', 'objective'], ascending=[True, False], kind='stable', ignore_index=True)
+
+
+if __name__ == '__main__':
+    optimize_parameters = parameters.optimize_parameters
+    parser = argparse.ArgumentParser(description='Search fixed targets and glide paths of two asset strategies for the best objective over historical starts.')
+    parser.add_argument('--objective', choices=objectives, default=optimize_parameters['objective'])
+    parser.add_argument('--percent', type=float, default=optimize_parameters['percent'], help='percentile, or the share of worst starts for cvar')
+    parser.add_argument('--no-glide-paths', dest='glide_paths', action='store_false', default=optimize_parameters['glide_paths'])
+    parser.add_argument('--top', type=int, default=5, help='number of best candidates printed per investment horizon')
+    parser.add_argument('--output', default='optimize.csv')
+    arguments = parser.parse_args()
+    p = parameters.parameters
+    results = optimize(
+        load_market_data(daily_sampling=p['daily_sampling']),
+        p['investment_years_options'], p['initial_balance'], p['annual_contributions'], p['dividend_tax_rate_percent'], p['asset_configs'],
+        optimize_parameters['families'], optimize_parameters['target_sp500_percents'], arguments.glide_paths, arguments.objective,
+        arguments.percent, period=p['period'], capital_gains_tax_rate_percent=p['capital_gains_tax_rate_percent'])
+    results.to_csv(arguments.output, index=False)
+    for investment_years, horizon_results in results.groupby('investment_years', sort=False):
+        print(f'best candidates by {arguments.objective} for investment years {investment_years}:')
+        print(horizon_results.head(arguments.top).to_string(index=False))
+    print(f'all candidates written to {arguments.output}')
@@ -0,0 +1,53 @@
+import concurrent.futures
+import numpy as np
+import pandas as pd
+
+from simulation import SimulationRunner, get_skip_rows
+
+# Worker process state, set once per process by _initialize_worker.
+_data = None
+_investment_strategies: list = []
+_simulation_runner: SimulationRunner
+
+
+def _initialize_worker(data, investment_strategies, simulation_runner: SimulationRunner) -> None:
+    global _data, _investment_strategies, _simulation_runner
+    _data = data
+    _investment_strategies = investment_strategies
+    _simulation_runner = simulation_runner
+
+
+def _run_chunk(strategy_index: int, investment_years: int, start: int, stop: int) -> tuple[np.ndarray, np.ndarray]:
+    investment_strategy, _ = _investment_strategies[strategy_index]
+    return _simulation_runner.simulate_many(_data, range(start, stop), investment_years, [investment_strategy])[0]
+
+
+def gather_balances_parallel(
+    data, investment_strategies, start_from, tasks: list[tuple[int, int, int]],
+    simulation_runner: SimulationRunner, workers: int, chunk_size: int = 360) -> dict[tuple[int, int, int], pd.DataFrame]:
+
+    print(f'gathering balances for {len(tasks)} (investment years, strategy, first start) tasks using {workers or "all"} workers')
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_initialize_worker,
+        initargs=(data, investment_strategies, simulation_runner)) as executor:
+
+        chunks = []
+        for task in tasks:
+            investment_years, strategy_index, first_start = task
+            skip_rows = get_skip_rows(data.shape[0], start_from, investment_years)[first_start:]
+            for start in range(skip_rows.start, skip_rows.stop, chunk_size):
+                future = executor.submit(_run_chunk, strategy_index, investment_years, start, min(start + chunk_size, skip_rows.stop))
+                chunks.append((task, future))
+
+        balances: dict[tuple[int, int, int], list[tuple[np.ndarray, np.ndarray]]] = {task: [] for task in tasks}
+        for task, future in chunks:
+            balances[task].append(future.result())
+
+    return {
+        task: pd.DataFrame(dict(
+            first_date=np.concatenate([first_dates for first_dates, _ in balances[task]]),
+            final_balance=np.concatenate([final_balances for _, final_balances in balances[task]])))
+        for task in tasks
+    }
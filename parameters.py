@@ -1,32 +1,107 @@
 from invesment_strategies import *
 from simulation import AssetConfigs, AssetConfig
+from typing import Optional, TypedDict
 
-investment_strategies = [
+
+# The types of the settings below, so that the scripts reading them are type checked.
+class Parameters(TypedDict):
+    initial_balance: float
+    annual_contributions: float
+    dividend_tax_rate_percent: float
+    capital_gains_tax_rate_percent: float
+    investment_years_options: list[int]
+    skip_time_percent_options: list[int]
+    simulation_engine: str
+    period: str
+    horizon_fan_out: bool
+    daily_sampling: str
+    workers: int
+    result_cache_dir: str
+    result_cache_max_bytes: int
+    record_balance_paths: bool
+    chart_points: int
+    chart_data_dir: Optional[str]
+    monte_carlo_paths: int
+    monte_carlo_block_months: int
+    monte_carlo_seed: int
+    instrumentation_report_path: Optional[str]
+    investment_strategies: list[tuple[InvestmentStrategy, str]]
+    asset_configs: AssetConfigs
+
+
+class SweepParameters(TypedDict):
+    initial_balances: list[float]
+    annual_contributions: list[float]
+    dividend_tax_rate_percents: list[float]
+    fees_percents: dict[str, list[float]]
+
+
+class OptimizeParameters(TypedDict):
+    families: list[str]
+    target_sp500_percents: list[float]
+    glide_paths: bool
+    objective: str
+    percent: float
+
+
+capital_gains_tax_rate_percent = 0
+
+investment_strategies: list[tuple[InvestmentStrategy, str]] = [
     (Sp500Strategy(), 'sp500'),
     (Sp500AndTb10yStrategyWoSelling(fixed_target_sp500_percent(70)), 'sp500 & tb10y 70/30 w/o selling'),
     (Sp500AndVbmfxStrategyWoSelling(fixed_target_sp500_percent(70)), 'sp500 & vbmfx 70/30 w/o selling'),
-    (Sp500AndTb10yStrategyWithSelling(fixed_target_sp500_percent(70)), 'sp500 & tb10y 70/30 with selling, 0% capital gains tax'),
-    (Sp500AndVbmfxStrategyWithSelling(fixed_target_sp500_percent(70)), 'sp500 & vbmfx 70/30 with selling, 0% capital gains tax'),
+    (Sp500AndTb10yStrategyWithSelling(fixed_target_sp500_percent(70)), f'sp500 & tb10y 70/30 with selling, {capital_gains_tax_rate_percent}% capital gains tax'),
+    (Sp500AndVbmfxStrategyWithSelling(fixed_target_sp500_percent(70)), f'sp500 & vbmfx 70/30 with selling, {capital_gains_tax_rate_percent}% capital gains tax'),
     (Sp500AndTb10yStrategyWoSelling(linearly_changing_target_sp500_percent(100, 70)), 'sp500 & tb10y 100/0 -> 70/30 w/o selling'),
     (Sp500AndVbmfxStrategyWoSelling(linearly_changing_target_sp500_percent(100, 70)), 'sp500 & vbmfx 100/0 -> 70/30 w/o selling'),
-    (Sp500AndTb10yStrategyWithSelling(linearly_changing_target_sp500_percent(100, 70)), 'sp500 & tb10y 100/0 -> 70/30 with selling, 0% capital gains tax'),
-    (Sp500AndVbmfxStrategyWithSelling(linearly_changing_target_sp500_percent(100, 70)), 'sp500 & vbmfx 100/0 -> 70/30 with selling, 0% capital gains tax'),
+    (Sp500AndTb10yStrategyWithSelling(linearly_changing_target_sp500_percent(100, 70)), f'sp500 & tb10y 100/0 -> 70/30 with selling, {capital_gains_tax_rate_percent}% capital gains tax'),
+    (Sp500AndVbmfxStrategyWithSelling(linearly_changing_target_sp500_percent(100, 70)), f'sp500 & vbmfx 100/0 -> 70/30 with selling, {capital_gains_tax_rate_percent}% capital gains tax'),
     (FixedPercentStrategy(0), 'cash only'),
     (FixedPercentStrategy(2), f'fixed 2%'),
     (FixedPercentStrategy(4), f'fixed 4%'),
     (FixedPercentStrategy(6), f'fixed 6%'),
 ]
 
-parameters = dict(
+parameters: Parameters = dict(
     initial_balance=100,
     annual_contributions=20,
     dividend_tax_rate_percent=15,
+    capital_gains_tax_rate_percent=capital_gains_tax_rate_percent,
     investment_years_options=[15, 20, 25, 30],
     skip_time_percent_options=[0, 20, 40, 60, 80],
+    simulation_engine='batch',
+    period='annual',
+    horizon_fan_out=True,
+    daily_sampling='month_end',
+    workers=1,
+    result_cache_dir='.cache/results',
+    result_cache_max_bytes=256 * 1024 * 1024,
+    record_balance_paths=False,
+    chart_points=200,
+    chart_data_dir=None,
+    monte_carlo_paths=0,
+    monte_carlo_block_months=12,
+    monte_carlo_seed=0,
+    instrumentation_report_path=None,
     investment_strategies=investment_strategies,
     asset_configs=AssetConfigs({
-        sp500: AssetConfig(fees_percent=0.07, accumulate_dividens=False),
-        vbmfx: AssetConfig(fees_percent=0.15, accumulate_dividens=False),
+        sp500: AssetConfig(fees_percent=0.07, accumulate_dividens=False, lot_selection=fifo),
+        vbmfx: AssetConfig(fees_percent=0.15, accumulate_dividens=False, lot_selection=fifo),
         tb10y: AssetConfig(fees_percent=0.0, accumulate_dividens=False),
     })
 )
+
+sweep_parameters: SweepParameters = dict(
+    initial_balances=[100, 1000, 10000],
+    annual_contributions=[0, 20, 200],
+    dividend_tax_rate_percents=[0, 15],
+    fees_percents={sp500: [0.03, 0.07]},
+)
+
+optimize_parameters: OptimizeParameters = dict(
+    families=['Sp500AndVbmfxStrategyWoSelling', 'Sp500AndTb10yStrategyWoSelling', 'Sp500AndVbmfxStrategyWithSelling', 'Sp500AndTb10yStrategyWithSelling'],
+    target_sp500_percents=list(range(0, 101, 5)),
+    glide_paths=True,
+    objective='median',
+    percent=10,
+)
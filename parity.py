@@ -0,0 +1,84 @@
+import argparse
+import numpy as np
+import parameters
+import sys
+
+from typing import Optional
+
+from batch_simulation import BATCH_RELATIVE_TOLERANCE
+from invesment_strategies import InvestmentStrategy, fifo, hifo
+from market_data import MarketData, load_market_data
+from prepare_charts import simulation_runners
+from simulation import AssetConfig, AssetConfigs, SimulationRunner, get_skip_rows, months_per_period
+
+
+# The asset configs of parameters.py with every asset selling its tax lots the given way.
+def get_asset_configs(lot_selection: str) -> AssetConfigs:
+    return AssetConfigs({
+        label: AssetConfig(config.fees_percent, config.accumulate_dividens, lot_selection)
+        for label, config in parameters.parameters['asset_configs'].items()
+    })
+
+
+def get_simulation_runner(
+    engine: str, period: str = 'annual', capital_gains_tax_rate_percent: float = 0, asset_configs: Optional[AssetConfigs] = None) -> SimulationRunner:
+    p = parameters.parameters
+    return simulation_runners[engine](
+        p['initial_balance'], p['annual_contributions'], p['dividend_tax_rate_percent'], asset_configs or p['asset_configs'], period,
+        capital_gains_tax_rate_percent)
+
+
+def get_final_balances(
+    simulation_runner: SimulationRunner, market_data: MarketData, skip_rows, investment_years: int, investment_strategy: InvestmentStrategy) -> np.ndarray:
+    return np.array([
+        result['final_balance'] for result in simulation_runner.run_simulations(market_data, skip_rows, investment_years, investment_strategy)
+    ])
+
+
+# The largest relative difference from the final balances of the reference engine, infinite if the number of balances differs.
+def get_relative_error(final_balances: np.ndarray, reference_balances: np.ndarray) -> float:
+    if final_balances.shape != reference_balances.shape:
+        return np.inf
+    return float(np.abs(final_balances / reference_balances - 1).max())
+
+
+# Runs every strategy from parameters.py with the given engines over the whole history
+# and compares the final balances with the ones of the reference engine. test_parity.py runs the same comparison with pytest.
+def check_parity(
+    engines: list[str], investment_years_options: list[int], step: int = 1, period: str = 'annual',
+    capital_gains_tax_rate_percent: float = 0, lot_selection: Optional[str] = None) -> bool:
+
+    asset_configs = get_asset_configs(lot_selection) if lot_selection is not None else None
+    market_data = load_market_data(daily_sampling=parameters.parameters['daily_sampling'])
+    reference_runner = get_simulation_runner('reference', period, capital_gains_tax_rate_percent, asset_configs)
+    runners = {engine: get_simulation_runner(engine, period, capital_gains_tax_rate_percent, asset_configs) for engine in engines}
+
+    passed = True
+    for investment_years in investment_years_options:
+        skip_rows = get_skip_rows(len(market_data), 0, investment_years)[::step]
+        for investment_strategy, investment_strategy_label in parameters.parameters['investment_strategies']:
+            reference_balances = get_final_balances(reference_runner, market_data, skip_rows, investment_years, investment_strategy)
+            for engine, simulation_runner in runners.items():
+                relative_error = get_relative_error(
+                    get_final_balances(simulation_runner, market_data, skip_rows, investment_years, investment_strategy), reference_balances)
+                engine_passed = relative_error <= BATCH_RELATIVE_TOLERANCE
+                passed = passed and engine_passed
+                print(
+                    f'{"ok  " if engine_passed else "FAIL"} {engine} {investment_years}y {investment_strategy_label}: '
+                    f'max relative error {relative_error:.1e} over {len(skip_rows)} starting months')
+
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the final balances of the simulation engines with the reference engine.')
+    parser.add_argument('engines', nargs='*', default=[engine for engine in simulation_runners if engine != 'reference'])
+    parser.add_argument('--investment-years', type=int, nargs='+', default=parameters.parameters['investment_years_options'])
+    parser.add_argument('--step', type=int, default=1, help='only simulate every n-th starting month')
+    parser.add_argument('--period', choices=list(months_per_period), default=parameters.parameters['period'])
+    parser.add_argument('--capital-gains-tax-rate-percent', type=float, default=parameters.parameters['capital_gains_tax_rate_percent'])
+    parser.add_argument('--lot-selection', choices=[fifo, hifo], help='sell the tax lots of every asset this way instead of as configured')
+    arguments = parser.parse_args()
+    sys.exit(0 if check_parity(
+        arguments.engines, arguments.investment_years, arguments.step, arguments.period, arguments.capital_gains_tax_rate_percent,
+        arguments.lot_selection) else 1)
@@ -0,0 +1,154 @@
+import numpy as np
+
+from typing import Sequence
+
+from batch_simulation import BatchSimulationRunner
+from instrumentation import instrumentation
+from invesment_strategies import *
+from market_data import MarketData, as_market_data
+from simulation import get_skip_rows
+
+
+# Strategies that never look at balances hold a single asset, whose amount follows x[i] = x[i - 1] * g[i] + k[i] * c[i],
+# where g is the growth of the holding over period i, c is the contribution and k is how much of the asset it buys.
+# Over a window (a, b] that is x[b] = x[a] * G[b] / G[a] + G[b] * (S[b] - S[a]) with the prefix products G of g
+# and the prefix sums S of k * c / G. Computed once along the data, they give the final balance of every start and horizon in O(1).
+class LinearStrategyChains:
+
+    growth_products: np.ndarray
+    prefix_sums: np.ndarray
+    suffix_sums: np.ndarray
+    initial_holdings: np.ndarray
+    holding_values: np.ndarray
+    cpi: np.ndarray
+
+    # Values are laid out as (periods, chains), every chain being a sequence of consecutive periods.
+    # The contributions are summed both from the start and from the end of the chains, because the difference of two sums
+    # loses the precision of the larger one: prefix sums are precise when the terms grow over time and suffix sums when they shrink.
+    def __init__(self, growth: np.ndarray, contribution_holdings: np.ndarray, initial_holdings: np.ndarray, holding_values: np.ndarray, cpi: np.ndarray) -> None:
+        self.growth_products = np.cumprod(growth, axis=0)
+        # Chains shorter than the others are padded with NaN, which must not reach the sums of the earlier periods.
+        terms = np.nan_to_num(contribution_holdings * cpi / self.growth_products, nan=0.0)
+        self.prefix_sums = np.cumsum(terms, axis=0)
+        self.suffix_sums = np.vstack([np.cumsum(terms[::-1], axis=0)[::-1], np.zeros((1, terms.shape[1]))])
+        self.initial_holdings = initial_holdings
+        self.holding_values = holding_values
+        self.cpi = cpi
+
+    def get_final_balances(
+        self, starts: np.ndarray, ends: np.ndarray, chains: np.ndarray, initial_balances, period_contributions) -> np.ndarray:
+        prefix_window = self.prefix_sums[ends, chains] - self.prefix_sums[starts, chains]
+        suffix_window = self.suffix_sums[starts + 1, chains] - self.suffix_sums[ends + 1, chains]
+        window_sums = np.where(self.prefix_sums[ends, chains] <= self.suffix_sums[starts + 1, chains], prefix_window, suffix_window)
+        holdings = \
+            initial_balances * self.initial_holdings[starts, chains] * self.growth_products[ends, chains] / self.growth_products[starts, chains] \
+            + period_contributions / self.cpi[starts, chains] * self.growth_products[ends, chains] * window_sums
+        return holdings * self.holding_values[ends, chains] * self.cpi[starts, chains] / self.cpi[ends, chains]
+
+
+def is_linear_solvable(investment_strategy: InvestmentStrategy) -> bool:
+    return type(investment_strategy) in (Sp500Strategy, FixedPercentStrategy)
+
+
+# Runs Sp500Strategy and FixedPercentStrategy in closed form and other strategies with the batch engine.
+class PrefixSimulationRunner(BatchSimulationRunner):
+
+    def simulate_many(self, data, skip_rows, investment_years: int, investment_strategies: Sequence[InvestmentStrategy]) -> list[tuple[np.ndarray, np.ndarray]]:
+        market_data = as_market_data(data)
+        solvable = [is_linear_solvable(investment_strategy) for investment_strategy in investment_strategies]
+        batch_simulations = iter(super().simulate_many(
+            market_data, skip_rows, investment_years,
+            [investment_strategy for investment_strategy, is_solvable in zip(investment_strategies, solvable) if not is_solvable]))
+        first_dates = market_data.dates[np.asarray(skip_rows, dtype=np.int64)].astype('datetime64[ns]')
+        return [
+            (first_dates, self._solve_starts(market_data, investment_strategy, {investment_years: skip_rows})[investment_years])
+            if is_solvable else next(batch_simulations)
+            for investment_strategy, is_solvable in zip(investment_strategies, solvable)
+        ]
+
+    # The chains are built once for all horizons, e.g. every horizon from 1 to 60 years takes about as long as a single one.
+    def simulate_horizons(
+        self, data, start_from: int, investment_years_options: list[int],
+        investment_strategies: Sequence[InvestmentStrategy]) -> dict[int, list[tuple[np.ndarray, np.ndarray]]]:
+        market_data = as_market_data(data)
+        solvable = [is_linear_solvable(investment_strategy) for investment_strategy in investment_strategies]
+        batch_simulations = super().simulate_horizons(
+            market_data, start_from, investment_years_options,
+            [investment_strategy for investment_strategy, is_solvable in zip(investment_strategies, solvable) if not is_solvable])
+        skip_rows = {
+            investment_years: get_skip_rows(len(market_data), start_from, investment_years) for investment_years in investment_years_options
+        }
+        solved_balances = [
+            self._solve_starts(market_data, investment_strategy, skip_rows)
+            for investment_strategy, is_solvable in zip(investment_strategies, solvable) if is_solvable
+        ]
+        simulations = {}
+        for investment_years, rows in skip_rows.items():
+            first_dates = market_data.dates[np.asarray(rows, dtype=np.int64)].astype('datetime64[ns]')
+            final_balances = iter(solved_balances)
+            batch_balances = iter(batch_simulations[investment_years])
+            simulations[investment_years] = [
+                (first_dates, next(final_balances)[investment_years]) if is_solvable else next(batch_balances)
+                for is_solvable in solvable
+            ]
+        return simulations
+
+    def simulate_paths_many_periods(
+        self, market_data: MarketData, recorded_periods: list[int], investment_strategies: Sequence[InvestmentStrategy]) -> list[np.ndarray]:
+        solvable = [is_linear_solvable(investment_strategy) for investment_strategy in investment_strategies]
+        batch_balances = iter(super().simulate_paths_many_periods(
+            market_data, recorded_periods,
+            [investment_strategy for investment_strategy, is_solvable in zip(investment_strategies, solvable) if not is_solvable]))
+        return [
+            self.simulate_paths_periods(market_data, recorded_periods, investment_strategy) if is_solvable else next(batch_balances)
+            for investment_strategy, is_solvable in zip(investment_strategies, solvable)
+        ]
+
+    def simulate_paths_periods(self, market_data: MarketData, recorded_periods: list[int], investment_strategy: InvestmentStrategy) -> np.ndarray:
+        if not is_linear_solvable(investment_strategy):
+            return super().simulate_paths_periods(market_data, recorded_periods, investment_strategy)
+        size = market_data.days.shape[1]
+        if instrumentation.enabled:
+            instrumentation.count('simulations', size)
+        chains = self._get_chains(investment_strategy, market_data.cpi, market_data.sp500_index, market_data.sp500_dividend)
+        columns = np.arange(size)
+        return np.array([
+            chains.get_final_balances(
+                np.zeros(size, dtype=np.int64), np.full(size, recorded_period), columns,
+                np.broadcast_to(self.initial_balance, size), np.broadcast_to(self.annual_contributions / self.periods_per_year, size))
+            for recorded_period in recorded_periods
+        ]).reshape(len(recorded_periods), size)
+
+    # The rows of the historical data are split into one chain per month of a period, so that a start and the end of its horizon
+    # are in the same chain.
+    def _solve_starts(self, market_data: MarketData, investment_strategy: InvestmentStrategy, skip_rows: dict[int, range]) -> dict[int, np.ndarray]:
+        months = self.months_per_period
+        padding = np.full(-len(market_data) % months, np.nan)
+        chains = self._get_chains(investment_strategy, *(
+            np.concatenate([values, padding]).reshape(-1, months)
+            for values in (market_data.cpi, market_data.sp500_index, market_data.sp500_dividend)))
+        final_balances = {}
+        for investment_years, row_range in skip_rows.items():
+            rows = np.asarray(row_range, dtype=np.int64)
+            if instrumentation.enabled:
+                instrumentation.count('simulations', rows.shape[0])
+            final_balances[investment_years] = chains.get_final_balances(
+                rows // months, rows // months + investment_years * self.periods_per_year, rows % months,
+                self.initial_balance, self.annual_contributions / self.periods_per_year)
+        return final_balances
+
+    # Follows SimulationRunner.run_simulation: dividends are collected after taxes, then fees are paid, then the contribution is added
+    # and the strategy buys the asset with all the cash.
+    def _get_chains(
+        self, investment_strategy: InvestmentStrategy, cpi: np.ndarray, sp500_index: np.ndarray, sp500_dividend: np.ndarray) -> LinearStrategyChains:
+        if type(investment_strategy) is FixedPercentStrategy:
+            growth = np.full(cpi.shape, (1 + investment_strategy.percent / 100) ** (1 / self.periods_per_year))
+            return LinearStrategyChains(growth, growth, np.ones(cpi.shape), np.ones(cpi.shape), cpi)
+        prices = sp500_index
+        dividends = sp500_dividend / self.periods_per_year * (100 - self.dividend_tax_rate_percent) / 100
+        fee_factor = ((100 - self.asset_configs[sp500].fees_percent) / 100) ** (1 / self.periods_per_year)
+        if self.asset_configs[sp500].accumulate_dividens:
+            growth = (1 + dividends / prices) * fee_factor
+        else:
+            growth = fee_factor + dividends / prices
+        return LinearStrategyChains(growth, 1 / prices, 1 / prices, prices, cpi)
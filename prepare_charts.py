@@ -1,264 +1,597 @@
 import altair as alt
-import csv
-import datetime as dt
-import itertools as it
+import numpy as np
+import os
 import pandas as pd
 import parameters
 
-from simulation import AssetConfigs, SimulationRunner
+from typing import Optional
 
+from balance_matrix import BalanceMatrix
+from balance_paths import BalancePaths, default_band_percents, risk_metrics
+from balance_store import BalanceReader, BalanceWriter
+from batch_simulation import BatchSimulationRunner
+from instrumentation import instrumentation
+from jit_simulation import JitSimulationRunner
+from market_data import MarketData, as_market_data, get_data, get_row_checksums, load_market_data
+from monte_carlo import gather_monte_carlo_balances
+from parallel_simulation import gather_balances_parallel
+from prefix_simulation import PrefixSimulationRunner
+from result_cache import ResultCache, default_cache_dir, default_cache_max_bytes
+from simulation import AssetConfigs, SimulationRunner, get_skip_rows
+from sweep import max_batch_columns
 
-def get_data():
+simulation_runners = {
+    'reference': SimulationRunner,
+    'batch': BatchSimulationRunner,
+    'jit': JitSimulationRunner,
+    'prefix': PrefixSimulationRunner,
+}
 
-    vbmfx_data_price_path = 'data\\bonds\\vbmfx_price.csv'
-    vbmfx_prices = {}
+default_balances_path = 'balance_{investment_years}y.arrow'
+default_balance_paths_path = 'balance_paths_{investment_years}y'
 
-    with open(vbmfx_data_price_path, newline='', encoding='utf-8-sig') as csvfile:
+period_names = dict(annual='yearly', quarterly='quarterly', monthly='monthly')
 
-        csvreader = csv.DictReader(csvfile)
 
-        for row in csvreader:
-
-            date_parts = row['Date'].split('-')
-            year = date_parts[0]
-            month = date_parts[1]
-            day = date_parts[2]
-
-            price_str = row['Value']
-            if not price_str:
-                continue
+def gather_balances(
+    data, investment_strategies, start_from, investment_years,
+    initial_balance: float, annual_contributions: float, dividend_tax_rate_percent: float, asset_configs: AssetConfigs,
+    simulation_engine: str = 'reference', period: str = 'annual', capital_gains_tax_rate_percent: float = 0) -> BalanceMatrix:
 
-            price = float(price_str)
+    print(f'gathering balances for investment years {investment_years}')
 
-            this_date = dt.date(year=int(year), month=int(month), day=1)
-            this_date_str = this_date.strftime('%Y-%m-%d')
-            vbmfx_prices.setdefault(this_date_str, price)
+    market_data = as_market_data(data)
+    simulation_runner = simulation_runners[simulation_engine](
+        initial_balance, annual_contributions, dividend_tax_rate_percent, asset_configs, period, capital_gains_tax_rate_percent)
+    skip_rows = get_skip_rows(len(market_data), start_from, investment_years)
+    strategy_balances = simulation_runner.simulate_many(
+        market_data, skip_rows, investment_years, [investment_strategy for investment_strategy, _ in investment_strategies])
+    return BalanceMatrix(
+        market_data.dates[np.asarray(skip_rows, dtype=np.int64)],
+        [investment_strategy_label for _, investment_strategy_label in investment_strategies],
+        np.array([final_balances for _, final_balances in strategy_balances]).reshape(len(investment_strategies), len(skip_rows)))
+
+
+# Balances of each strategy are streamed to a file as soon as they are simulated or loaded from the cache, in the order of the strategies.
+# Strategies are simulated in chunks of at most max_batch_columns strategies times starting months, so the memory used is bounded
+# by one chunk of simulated balances and the cached balances of one strategy, regardless of the number of strategies.
+def gather_all_balances(
+    market_data: MarketData, investment_strategies, start_from, investment_years_options: list[int],
+    simulation_runner: SimulationRunner, workers: int, result_cache: ResultCache,
+    balances_path: str = default_balances_path, horizon_fan_out: bool = True) -> dict[int, str]:
+
+    row_checksums = get_row_checksums(market_data)
+    settings = dict(simulation_runner=simulation_runner, start_from=start_from)
+    strategy_labels = [investment_strategy_label for _, investment_strategy_label in investment_strategies]
+
+    if horizon_fan_out and len(set(investment_years_options)) > 1:
+        fan_out_horizons(market_data, investment_strategies, start_from, investment_years_options, simulation_runner, result_cache)
+
+    def simulate(tasks: list[tuple[int, int, int]]) -> dict[tuple[int, int, int], pd.DataFrame]:
+        if workers == 1:
+            return simulate_tasks(market_data, investment_strategies, start_from, tasks, simulation_runner)
+        return gather_balances_parallel(market_data, investment_strategies, start_from, tasks, simulation_runner, workers)
+
+    balances_paths = {}
+    for investment_years in investment_years_options:
+
+        start_count = len(get_skip_rows(len(market_data), start_from, investment_years))
+        keys = [result_cache.get_key(settings, investment_strategy, investment_years) for investment_strategy, _ in investment_strategies]
+        # Only the number of cached starting months is kept here, the cached balances are loaded again when they are written.
+        cached_counts: list[Optional[int]] = []
+        for key in keys:
+            cached_balances = result_cache.load(key, row_checksums)
+            cached_counts.append(cached_balances.shape[0] if cached_balances is not None and cached_balances.shape[0] <= start_count else None)
+        tasks = [
+            (investment_years, strategy_index, cached_count or 0) for strategy_index, cached_count in enumerate(cached_counts)
+            if cached_count is None or cached_count < start_count
+        ]
+
+        extended_count = sum(1 for _, _, first_start in tasks if first_start)
+        print(
+            f'gathering balances for investment years {investment_years}: {len(keys) - len(tasks)} loaded from cache, '
+            f'{extended_count} extended with new start dates, {len(tasks) - extended_count} to simulate')
+
+        def write_strategy(writer: BalanceWriter, strategy_index: int, simulated: dict[tuple[int, int, int], pd.DataFrame]) -> None:
+            cached_count = cached_counts[strategy_index]
+            task = (investment_years, strategy_index, cached_count or 0)
+            if cached_count is None or (task in simulated and not cached_count):
+                balances = simulated[task]
+            else:
+                cached_balances = result_cache.load(keys[strategy_index], row_checksums)
+                if cached_balances is None or cached_balances.shape[0] != cached_count:
+                    # The cached balances were evicted since they were counted.
+                    balances = simulate([(investment_years, strategy_index, 0)])[investment_years, strategy_index, 0]
+                elif task not in simulated:
+                    writer.write(strategy_index, cached_balances['first_date'].to_numpy(), cached_balances['final_balance'].to_numpy())
+                    return
+                else:
+                    balances = pd.concat([cached_balances, simulated[task]], ignore_index=True)
+            result_cache.store(keys[strategy_index], balances, row_checksums)
+            writer.write(strategy_index, balances['first_date'].to_numpy(), balances['final_balance'].to_numpy())
+
+        balances_paths[investment_years] = balances_path.format(investment_years=investment_years)
+        with BalanceWriter(balances_paths[investment_years], strategy_labels) as writer:
+            written_count = 0
+            for task_chunk in get_task_chunks(tasks, start_count):
+                simulated = simulate(task_chunk)
+                for strategy_index in range(written_count, task_chunk[-1][1] + 1):
+                    write_strategy(writer, strategy_index, simulated)
+                written_count = task_chunk[-1][1] + 1
+            for strategy_index in range(written_count, len(investment_strategies)):
+                write_strategy(writer, strategy_index, {})
+
+    return balances_paths
+
+
+# Consecutive tasks that start at the same starting month are simulated together, up to max_batch_columns strategies times starting months.
+def get_task_chunks(tasks: list[tuple[int, int, int]], start_count: int) -> list[list[tuple[int, int, int]]]:
+    task_chunks: list[list[tuple[int, int, int]]] = []
+    for task in tasks:
+        _, _, first_start = task
+        if task_chunks and task_chunks[-1][-1][2] == first_start and (len(task_chunks[-1]) + 1) * (start_count - first_start) <= max_batch_columns:
+            task_chunks[-1].append(task)
+        else:
+            task_chunks.append([task])
+    return task_chunks
+
+
+# Horizon independent strategies without usable results for some horizons are simulated for those horizons in one pass
+# and the results are stored in the cache, where gather_all_balances finds them. Horizons with results for the first starting months
+# only are left to gather_all_balances, which extends them with the starting months that became possible.
+def fan_out_horizons(
+    market_data: MarketData, investment_strategies, start_from, investment_years_options: list[int],
+    simulation_runner: SimulationRunner, result_cache: ResultCache) -> None:
+
+    row_checksums = get_row_checksums(market_data)
+    settings = dict(simulation_runner=simulation_runner, start_from=start_from)
+    strategy_groups: dict[tuple[int, ...], list[int]] = {}
+    for strategy_index, (investment_strategy, _) in enumerate(investment_strategies):
+        if not investment_strategy.horizon_independent:
+            continue
+        missing_investment_years_options = []
+        for investment_years in dict.fromkeys(investment_years_options):
+            cached_balances = result_cache.load(result_cache.get_key(settings, investment_strategy, investment_years), row_checksums)
+            if cached_balances is None or cached_balances.shape[0] > len(get_skip_rows(len(market_data), start_from, investment_years)):
+                missing_investment_years_options.append(investment_years)
+        if missing_investment_years_options:
+            strategy_groups.setdefault(tuple(missing_investment_years_options), []).append(strategy_index)
+
+    # Every horizon is simulated for the starting months of the shortest one, so the chunks are sized by those.
+    for group_investment_years_options, group_strategy_indices in strategy_groups.items():
+        start_count = len(get_skip_rows(len(market_data), start_from, min(group_investment_years_options)))
+        chunk_size = max(1, max_batch_columns // max(1, start_count))
+        for chunk_start in range(0, len(group_strategy_indices), chunk_size):
+            strategy_indices = group_strategy_indices[chunk_start:chunk_start + chunk_size]
+            print(
+                f'  processing {len(strategy_indices)} horizon independent strategies for investment years '
+                f'{", ".join(map(str, group_investment_years_options))} at once')
+            simulations: dict[int, list[tuple[np.ndarray, np.ndarray]]]
+            if instrumentation.enabled:
+                simulations = {investment_years: [] for investment_years in group_investment_years_options}
+                for strategy_index in strategy_indices:
+                    investment_strategy, investment_strategy_label = investment_strategies[strategy_index]
+                    with instrumentation.strategy(investment_strategy_label):
+                        for investment_years, strategy_balances in simulation_runner.simulate_horizons(
+                                market_data, start_from, list(group_investment_years_options), [investment_strategy]).items():
+                            simulations[investment_years] += strategy_balances
+            else:
+                simulations = simulation_runner.simulate_horizons(
+                    market_data, start_from, list(group_investment_years_options),
+                    [investment_strategies[strategy_index][0] for strategy_index in strategy_indices])
+
+            for investment_years, strategy_balances in simulations.items():
+                for strategy_index, (first_dates, final_balances) in zip(strategy_indices, strategy_balances):
+                    result_cache.store(
+                        result_cache.get_key(settings, investment_strategies[strategy_index][0], investment_years),
+                        pd.DataFrame(dict(first_date=first_dates, final_balance=final_balances)), row_checksums)
+
+
+# Every strategy is simulated once per horizon with the balance at the start of every year recorded to BalancePaths files.
+# The final balances are stored in the cache, where gather_all_balances finds them, so recording doesn't take a second run.
+def gather_balance_paths(
+    market_data: MarketData, investment_strategies, start_from, investment_years_options: list[int],
+    simulation_runner: SimulationRunner, result_cache: ResultCache, balance_paths_path: str = default_balance_paths_path) -> dict[int, str]:
+
+    row_checksums = get_row_checksums(market_data)
+    settings = dict(simulation_runner=simulation_runner, start_from=start_from)
+    strategy_labels = [investment_strategy_label for _, investment_strategy_label in investment_strategies]
+
+    balance_paths_paths = {}
+    for investment_years in investment_years_options:
+
+        print(f'recording balance paths for investment years {investment_years}')
+        skip_rows = get_skip_rows(len(market_data), start_from, investment_years)
+        first_dates = market_data.dates[np.asarray(skip_rows, dtype=np.int64)].astype('datetime64[ns]')
+        if instrumentation.enabled:
+            yearly_balances = []
+            for investment_strategy, investment_strategy_label in investment_strategies:
+                with instrumentation.strategy(investment_strategy_label):
+                    yearly_balances += simulation_runner.simulate_yearly_balances(market_data, skip_rows, investment_years, [investment_strategy])
+        else:
+            yearly_balances = simulation_runner.simulate_yearly_balances(
+                market_data, skip_rows, investment_years, [investment_strategy for investment_strategy, _ in investment_strategies])
+
+        balance_paths_paths[investment_years] = balance_paths_path.format(investment_years=investment_years)
+        with BalancePaths.create(balance_paths_paths[investment_years], first_dates, strategy_labels, investment_years) as balance_paths:
+            for strategy_index, ((investment_strategy, _), strategy_balances) in enumerate(zip(investment_strategies, yearly_balances)):
+                balance_paths.balances[strategy_index] = strategy_balances
+                result_cache.store(
+                    result_cache.get_key(settings, investment_strategy, investment_years),
+                    pd.DataFrame(dict(first_date=first_dates, final_balance=strategy_balances[:, -1])), row_checksums)
+
+    return balance_paths_paths
+
+
+def simulate_tasks(
+    market_data: MarketData, investment_strategies, start_from, tasks: list[tuple[int, int, int]],
+    simulation_runner: SimulationRunner) -> dict[tuple[int, int, int], pd.DataFrame]:
+
+    simulated = {}
+    task_groups: dict[tuple[int, int], list[tuple[int, int, int]]] = {}
+    for task in tasks:
+        investment_years, _, first_start = task
+        task_groups.setdefault((investment_years, first_start), []).append(task)
+    for (investment_years, first_start), group_tasks in task_groups.items():
+        print(f'  processing {len(group_tasks)} strategies for investment years {investment_years} from start {first_start}')
+        skip_rows = get_skip_rows(len(market_data), start_from, investment_years)[first_start:]
+        if instrumentation.enabled:
+            # Strategies are simulated one by one, so that time and events can be attributed to each of them.
+            group_balances = []
+            for _, strategy_index, _ in group_tasks:
+                investment_strategy, investment_strategy_label = investment_strategies[strategy_index]
+                with instrumentation.strategy(investment_strategy_label):
+                    group_balances += simulation_runner.simulate_many(market_data, skip_rows, investment_years, [investment_strategy])
+        else:
+            group_balances = simulation_runner.simulate_many(
+                market_data, skip_rows, investment_years, [investment_strategies[strategy_index][0] for _, strategy_index, _ in group_tasks])
+        for task, (first_dates, final_balances) in zip(group_tasks, group_balances):
+            simulated[task] = pd.DataFrame(dict(first_date=first_dates, final_balance=final_balances))
+    return simulated
+
+
+def get_distribution_points(balance_matrix: BalanceMatrix, start_dates: list, points: int) -> list[Optional[pd.DataFrame]]:
+
+    # Each strategy is sorted once, and the panels pick their starting months from the sorted balances by the sort order.
+    order = np.argsort(balance_matrix.final_balances, axis=1, kind='stable')
+    sorted_balances = np.take_along_axis(balance_matrix.final_balances, order, axis=1)
+
+    distributions: list[Optional[pd.DataFrame]] = []
+
+    for start_date in start_dates:
+        first_index = np.searchsorted(balance_matrix.first_dates, np.datetime64(start_date), side='right')
+        if first_index == balance_matrix.first_dates.shape[0]:
+            distributions.append(None)
+            continue
+        panel_starts = order >= first_index
+        distributions.append(pd.concat(
+            [
+                get_downsampled_distribution(strategy_sorted_balances[strategy_panel_starts], points, investment_strategy_label)
+                for investment_strategy_label, strategy_sorted_balances, strategy_panel_starts
+                in zip(balance_matrix.strategy_labels, sorted_balances, panel_starts)
+            ],
+            ignore_index=True))
+
+    return distributions
+
+
+def get_downsampled_distribution(
+    sorted_balances: np.ndarray, points: int, investment_strategy_label: str, value_column: str = 'final_balance') -> pd.DataFrame:
+    count = sorted_balances.shape[0]
+    ranks = np.unique(np.linspace(0, count - 1, min(points, count)).round().astype(np.int64))
+    return pd.DataFrame({
+        value_column: sorted_balances[ranks],
+        'percent_of_years_with_lower_balance': (ranks + 1) / count * 100,
+        'investment_strategy': investment_strategy_label,
+    })
+
+
+def get_chart_data(points: pd.DataFrame, chart_data_dir, name: str):
+    if chart_data_dir is None:
+        return points
+    os.makedirs(chart_data_dir, exist_ok=True)
+    points.to_json(os.path.join(chart_data_dir, f'{name}.json'), orient='records')
+    return alt.Data(url='/'.join(chart_data_dir.split(os.sep) + [f'{name}.json']))
 
-    vbmfx_data_div_yield_path = 'data\\bonds\\vbmfx_div_yield.csv'
-    vbmfx_div_yields = {}
 
-    with open(vbmfx_data_div_yield_path, newline='', encoding='utf-8-sig') as csvfile:
+def prepare_charts(
+    investment_strategies,
+    initial_balance: float, annual_contributions: float, dividend_tax_rate_percent: float, asset_configs: AssetConfigs,
+    investment_years_options: list[int], skip_time_percent_options: list[int], simulation_engine: str = 'reference', period: str = 'annual',
+    capital_gains_tax_rate_percent: float = 0,
+    horizon_fan_out: bool = True, daily_sampling: str = 'month_end', workers: int = 1, result_cache_dir: str = default_cache_dir, result_cache_max_bytes: int = default_cache_max_bytes,
+    record_balance_paths: bool = False, chart_points: int = 200, chart_data_dir=None,
+    monte_carlo_paths: int = 0, monte_carlo_block_months: int = 12, monte_carlo_seed: int = 0,
+    instrumentation_report_path=None):
 
-        csvreader = csv.DictReader(csvfile)
+    if instrumentation_report_path is not None:
+        instrumentation.enable()
 
-        for row in csvreader:
+    with instrumentation.phase('load_market_data'):
+        market_data = load_market_data(daily_sampling=daily_sampling)
 
-            date_parts = row['Date'].split('-')
-            year = date_parts[0]
-            month = date_parts[1]
-            day = date_parts[2]
+    start_date_options = get_start_date_options(market_data, skip_time_percent_options)
 
-            price_str = row['Value']
-            if not price_str:
-                continue
+    simulation_runner = simulation_runners[simulation_engine](
+        initial_balance, annual_contributions, dividend_tax_rate_percent, asset_configs, period, capital_gains_tax_rate_percent)
+    result_cache = ResultCache(result_cache_dir, result_cache_max_bytes)
 
-            div_yield = float(price_str)
+    if record_balance_paths:
+        with instrumentation.phase('gather_balance_paths'):
+            balance_paths_paths = gather_balance_paths(
+                market_data, investment_strategies, 0, investment_years_options, simulation_runner, result_cache)
 
-            this_date = dt.date(year=int(year), month=int(month), day=1)
-            this_date_str = this_date.strftime('%Y-%m-%d')
-            vbmfx_div_yields.setdefault(this_date_str, div_yield)
+    with instrumentation.phase('gather_balances'):
+        balances_paths = gather_all_balances(
+            market_data, investment_strategies, 0, investment_years_options,
+            simulation_runner, workers, result_cache, horizon_fan_out=horizon_fan_out)
 
-    sp500_data_path = 'data\\sp500\\data\\data_csv.csv'
-    sp500_data_path_new = 'data\\sp500_new\\data.csv'
+    with instrumentation.phase('write_balances'):
+        for investment_years, balances_path in balances_paths.items():
+            with BalanceReader(balances_path) as balances_reader:
+                balances_reader.write_csv(f'balance_{investment_years}y.csv')
 
-    column_date = []
-    column_cpi = []
-    column_bonds_10y_rate_percent = []
-    column_sp500_index = []
-    column_sp500_dividend = []
-    column_vbmfx_price = []
-    column_vbmfx_dividend = []
+    print('preparing charts')
 
-    print('getting data')
+    selection = alt.selection_multi(
+        bind='legend',
+        fields=['investment_strategy'])
 
-    with open(sp500_data_path, newline='', encoding='utf-8-sig') as csvfile:
-        with open(sp500_data_path_new, newline='', encoding='utf-8-sig') as csvfile_new:
+    title = \
+        'Likelihood of getting particular final balance adjusted to inflation if investing for different number of years. ' \
+        f'Initial balance is {initial_balance}, annual contributions are {annual_contributions}, ' \
+        f'dividend tax rate is {dividend_tax_rate_percent}%, contributions, dividends and fees are applied {period_names[period]}.'
 
-            csvreader = csv.DictReader(csvfile)
-            csvreader_new = csv.DictReader(csvfile_new)
+    with instrumentation.phase('build_charts'):
+        charts = get_returns_charts(balances_paths, start_date_options, investment_years_options, chart_points, chart_data_dir, selection)
 
-            for row in it.chain(
-                (row for row in csvreader if row['Date'] <= '2017-12-01'),
-                (row for row in csvreader_new if row['Date'] > '2017-12-01')):
+    with instrumentation.phase('save_charts'):
+        save_charts(charts, title, 'returns.html')
 
-                this_date_str = row['Date']
+    if record_balance_paths:
 
-                date_parts = this_date_str.split('-')
-                year = date_parts[0]
-                month = date_parts[1]
-                day = date_parts[2]
+        print('preparing risk charts')
 
-                this_date = dt.date(year=int(year), month=int(month), day=int(day))
+        with instrumentation.phase('build_risk_charts'):
+            for investment_years, balance_paths_path in balance_paths_paths.items():
+                with BalancePaths.open(balance_paths_path) as balance_paths:
+                    balance_paths.get_risk_metrics_data_frame(annual_contributions).to_csv(f'risk_metrics_{investment_years}y.csv')
+            charts = get_risk_charts(balance_paths_paths, annual_contributions, chart_points, chart_data_dir, selection)
 
-                index_str = row['SP500']
-                dividend_str = row['Dividend']
-                cpi_str = row['Consumer Price Index']
-                long_interest_rate_str = row['Long Interest Rate']
+        with instrumentation.phase('save_risk_charts'):
+            save_charts(charts, title.replace('final balance', 'balances and risk metrics'), 'risk.html')
 
-                if not index_str or not dividend_str or not cpi_str:
-                    continue
+    if monte_carlo_paths:
 
-                column_date.append(pd.to_datetime(this_date))
-                column_cpi.append(float(cpi_str))
-                column_bonds_10y_rate_percent.append(float(long_interest_rate_str))
+        with instrumentation.phase('gather_monte_carlo_balances'):
+            monte_carlo_balances_paths = gather_monte_carlo_balances(
+                market_data, investment_strategies, investment_years_options,
+                simulation_runner if isinstance(simulation_runner, BatchSimulationRunner)
+                else BatchSimulationRunner(
+                    initial_balance, annual_contributions, dividend_tax_rate_percent, asset_configs, period, capital_gains_tax_rate_percent),
+                monte_carlo_paths, monte_carlo_block_months, monte_carlo_seed)
 
-                column_sp500_index.append(float(index_str))
-                column_sp500_dividend.append(float(dividend_str))
+        print('preparing monte carlo charts')
 
-                vbmfx_price = vbmfx_prices.get(this_date_str)
-                vbmfx_rate = vbmfx_div_yields.get(this_date_str)
-                column_vbmfx_price.append(vbmfx_price)
-                if vbmfx_price and vbmfx_rate:
-                    column_vbmfx_dividend.append(vbmfx_price * vbmfx_rate / 100)
-                else:
-                    column_vbmfx_dividend.append(None)
+        row = []
 
-        return pd.DataFrame({
-            'date': column_date,
-            'cpi': column_cpi,
-            'bonds_10y_rate_percent': column_bonds_10y_rate_percent,
-            'sp500_index': column_sp500_index,
-            'sp500_dividend': column_sp500_dividend,
-            'vbmfx_price': column_vbmfx_price,
-            'vbmfx_dividend': column_vbmfx_dividend,
-        })
+        for investment_years in investment_years_options:
 
+            with BalanceReader(monte_carlo_balances_paths[investment_years]) as balances_reader:
+                points = pd.concat(
+                    [
+                        get_downsampled_distribution(np.sort(final_balances), chart_points, investment_strategy_label)
+                        for investment_strategy_label, _, final_balances in balances_reader.iter_strategy_balances()
+                    ],
+                    ignore_index=True)
+
+            row.append(get_balance_chart(
+                get_chart_data(points, chart_data_dir, f'returns_monte_carlo_{investment_years}y'),
+                f'% of paths with lower final balance if investing for {investment_years}y',
+                selection))
+
+        with instrumentation.phase('save_monte_carlo_charts'):
+            save_charts(
+                [(f'{monte_carlo_paths} synthetic paths made of blocks of {monte_carlo_block_months} consecutive historical months, seed {monte_carlo_seed}', row)],
+                title,
+                'returns_monte_carlo.html')
+
+    if instrumentation_report_path is not None:
+        instrumentation.write_report(instrumentation_report_path)
+        instrumentation.disable()
+        print(f'instrumentation report written to {instrumentation_report_path}')
+
+
+def get_start_date_options(market_data: MarketData, skip_time_percent_options: list[int]) -> list:
+    length = len(market_data)
+    start_date_options = []
+    for skip_time_percent in skip_time_percent_options:
+        start_index = length * skip_time_percent // 100
+        start_date = market_data.timestamps[start_index]
+        start_date_options.append(start_date)
+    return start_date_options
 
-def gather_balances(
-    data, investment_strategies, start_from, investment_years,
-    initial_balance: float, annual_contributions: float, dividend_tax_rate_percent: float, asset_configs: AssetConfigs):
 
-    print(f'gathering balances for investment years {investment_years}')
+def get_returns_charts(
+    balances_paths: dict[int, str], start_date_options: list, investment_years_options: list[int], chart_points: int, chart_data_dir,
+    selection) -> list:
 
-    balances = []
-    simulation_runner = SimulationRunner(initial_balance, annual_contributions, dividend_tax_rate_percent, asset_configs)
-    for investment_strategy, investment_strategy_label in investment_strategies:
-        print(f'  processing strategy {investment_strategy_label}')
-        for i in range(((data.shape[0] - start_from) // 12 - investment_years) * 12):
-            balance_dict = simulation_runner.run_simulation(data, i, investment_years, investment_strategy)
-            balance_dict['investment_strategy'] = investment_strategy_label
-            balances.append(balance_dict)
+    distribution_points = {}
+    for investment_years in investment_years_options:
+        with BalanceReader(balances_paths[investment_years]) as balances_reader:
+            distribution_points[investment_years] = get_distribution_points(
+                balances_reader.to_matrix(), start_date_options, chart_points)
 
-    return pd.DataFrame(balances)
+    charts = []
 
+    for start_date_index, start_date in enumerate(start_date_options):
 
-def prepare_charts(
-    investment_strategies,
-    initial_balance: float, annual_contributions: float, dividend_tax_rate_percent: float, asset_configs: AssetConfigs,
-    investment_years_options: list[int], skip_time_percent_options: list[int]):
-
-    data = get_data()
-    data.to_csv(f'main_data.csv')
+        print(f'  processing preparing charts {start_date}')
 
-    length = data.shape[0]
-    start_date_options = []
-    for skip_time_percent in skip_time_percent_options:
-        start_index = length * skip_time_percent // 100
-        start_date = data.at[start_index, 'date']
-        start_date_options.append(start_date)
+        row = []
 
-    balances_all = {}
+        for investment_years in investment_years_options:
 
-    write_data = True
-    #write_data = False
+            points = distribution_points[investment_years][start_date_index]
 
-    if write_data:
-        for investment_years in investment_years_options:
-            balances = gather_balances(
-                data, investment_strategies, 0, investment_years,
-                initial_balance, annual_contributions, dividend_tax_rate_percent, asset_configs)
-            balances.to_csv(f'balance_{investment_years}y.csv')
-            balances_all[investment_years] = balances
-    else:
-        for investment_years in investment_years_options:
-            balances_all[investment_years] = \
-                pd.read_csv(f'balance_{investment_years}y.csv').astype({'first_date': 'datetime64[ns]'})
+            if points is None:
+                continue
 
-    charts = []
+            row.append(get_balance_chart(
+                get_chart_data(points, chart_data_dir, f'returns_{start_date:%Y_%m}_{investment_years}y'),
+                f'% of years with lower final balance if investing for {investment_years}y',
+                selection))
 
-    print('preparing charts')
+        charts.append((f'Data for analysis starting from {start_date}', row))
 
-    color = alt.Color('investment_strategy', title='Investment strategy')
+    return charts
 
-    selection = alt.selection_multi(
-        bind='legend',
-        fields=['investment_strategy'])
-    opacity = alt.condition(
-        selection,
-        alt.value(1),
-        alt.value(0.15))
 
-    for start_date in start_date_options:
+# One row per investment horizon with the percentile bands of the balance over the years and the distributions of the risk metrics.
+def get_risk_charts(
+    balance_paths_paths: dict[int, str], annual_contributions: float, chart_points: int, chart_data_dir, selection) -> list:
 
-        print(f'  processing preparing charts {start_date}')
+    charts = []
 
-        row = []
+    for investment_years, balance_paths_path in balance_paths_paths.items():
+
+        print(f'  processing preparing risk charts {investment_years}y')
+
+        with BalancePaths.open(balance_paths_path) as balance_paths:
+            bands = balance_paths.get_percentile_bands()
+            metrics = balance_paths.get_risk_metrics(annual_contributions)
+            strategy_labels = balance_paths.strategy_labels
+
+        band_points = pd.concat(
+            [
+                pd.DataFrame(dict(
+                    year=np.arange(investment_years + 1),
+                    low_balance=strategy_bands[0],
+                    median_balance=strategy_bands[1],
+                    high_balance=strategy_bands[2],
+                    investment_strategy=investment_strategy_label))
+                for investment_strategy_label, strategy_bands in zip(strategy_labels, bands)
+            ],
+            ignore_index=True)
+        row = [get_band_chart(get_chart_data(band_points, chart_data_dir, f'risk_bands_{investment_years}y'), selection)]
+
+        for metric, metric_title in risk_metrics.items():
+            points = pd.concat(
+                [
+                    get_downsampled_distribution(np.sort(values), chart_points, investment_strategy_label, metric)
+                    for investment_strategy_label, values in zip(strategy_labels, metrics[metric])
+                ],
+                ignore_index=True)
+            row.append(get_metric_chart(
+                get_chart_data(points, chart_data_dir, f'risk_{metric}_{investment_years}y'), metric, metric_title,
+                f'% of years with a lower value if investing for {investment_years}y', selection))
+
+        charts.append((f'Investing for {investment_years}y', row))
+
+    return charts
+
+
+def get_band_chart(chart_data, selection):
+    base = alt.Chart(chart_data).encode(
+        x=alt.X('year:Q', title='Years since the start'),
+        color=alt.Color('investment_strategy:N', title='Investment strategy'),
+    )
+    low_percent, median_percent, high_percent = default_band_percents
+    return alt.layer(
+        base.mark_area(
+            opacity=0.1
+        ).encode(
+            y=alt.Y('low_balance:Q', title=f'Balance, {low_percent}th to {high_percent}th percentile and median', scale=alt.Scale(type='log')),
+            y2='high_balance:Q',
+            opacity=alt.condition(selection, alt.value(0.15), alt.value(0.02)),
+        ),
+        base.mark_line().encode(
+            y='median_balance:Q',
+            opacity=alt.condition(selection, alt.value(1), alt.value(0.15)),
+            tooltip=['year:Q', 'low_balance:Q', 'median_balance:Q', 'high_balance:Q', 'investment_strategy:N'],
+        ),
+    ).add_selection(
+        selection
+    ).properties(
+        width=400
+    )
+
+
+def get_metric_chart(chart_data, metric: str, x_title: str, y_title: str, selection):
+    return alt.Chart(chart_data) \
+        .mark_line(
+            clip=True
+        ).encode(
+            x=alt.X(f'{metric}:Q', title=x_title),
+            y=alt.Y(
+                'percent_of_years_with_lower_balance:Q',
+                title=y_title,
+                scale=alt.Scale(domain=[0, 100])
+            ),
+            color=alt.Color('investment_strategy:N', title='Investment strategy'),
+            opacity=alt.condition(
+                selection,
+                alt.value(1),
+                alt.value(0.15)
+            ),
+            tooltip=[f'{metric}:Q', 'percent_of_years_with_lower_balance:Q', 'investment_strategy:N']
+        ).add_selection(
+            selection
+        ).properties(
+            width=300
+        )
 
-        for investment_years in investment_years_options:
 
-            balances_for_investment_years = balances_all[investment_years]
-            balances_sliced = balances_for_investment_years[balances_for_investment_years['first_date'] > start_date]
+def get_balance_chart(chart_data, y_title: str, selection):
+    return alt.Chart(chart_data) \
+        .mark_line(
+            clip=True
+        ).encode(
+            x=alt.X(
+                'final_balance:Q',
+                title='Final balance',
+                scale=alt.Scale(type='log')
+            ),
+            y=alt.X(
+                'percent_of_years_with_lower_balance:Q',
+                title=y_title,
+                scale=alt.Scale(domain=[0, 100])
+            ),
+            color=alt.Color('investment_strategy:N', title='Investment strategy'),
+            opacity=alt.condition(
+                selection,
+                alt.value(1),
+                alt.value(0.15)
+            ),
+            strokeWidth=alt.condition(
+                "datum.investment_strategy == 'sp500'",
+                alt.value(2),
+                alt.value(1)
+            ),
+            tooltip=['final_balance:Q', 'percent_of_years_with_lower_balance:Q', 'investment_strategy:N']
+        ).add_selection(
+            selection
+        ).properties(
+            width=1200
+        )
 
-            if balances_sliced.shape[0] == 0:
-                continue
 
-            balance_chart = alt.Chart(balances_sliced) \
-                .mark_line(
-                    clip=True
-                ).transform_joinaggregate(
-                    total_count='count(*)',
-                    groupby=['investment_strategy']
-                ).transform_window(
-                    cumulative_count='count()',
-                    sort=[{'field': 'final_balance'}],
-                    groupby=['investment_strategy']
-                ).transform_calculate(
-                    percent_of_years_with_lower_balance='datum.cumulative_count / datum.total_count * 100'
-                ).encode(
-                    x=alt.X(
-                        'final_balance:Q',
-                        title='Final balance',
-                        scale=alt.Scale(type='log')
-                    ),
-                    y=alt.X(
-                        'percent_of_years_with_lower_balance:Q',
-                        title=f'% of years with lower final balance if investing for {investment_years}y',
-                        scale=alt.Scale(domain=[0, 100])
-                    ),
-                    color=color,
-                    opacity=opacity,
-                    strokeWidth=alt.condition(
-                        "datum.investment_strategy == 'sp500'",
-                        alt.value(2),
-                        alt.value(1)
-                    ),
-                    tooltip=['final_balance:Q', 'percent_of_years_with_lower_balance:Q', 'investment_strategy']
-                ).add_selection(
-                    selection
-                ).properties(
-                    width=1200
-                )
-
-            row.append(balance_chart)
-
-        charts.append(
+def save_charts(rows: list, title: str, path: str) -> None:
+    alt \
+        .vconcat(*[
             alt
                 .hconcat(*row)
-                .properties(title=f'Data for analysis starting from {start_date}')
+                .properties(title=row_title)
                 .resolve_scale(x='shared')
-        )
-
-    alt \
-        .vconcat(*charts) \
+            for row_title, row in rows
+        ]) \
         .properties(
-            title=
-                'Likelihood of getting particular final balance adjusted to inflation if investing for different number of years. '
-                f'Initial balance is {initial_balance}, annual contributions are {annual_contributions}, '
-                f'dividend tax rate is {dividend_tax_rate_percent}%.'
+            title=title
         ) \
         .resolve_scale(x='shared') \
-        .save('returns.html')
+        .save(path)
 
-prepare_charts(
-    **parameters.parameters  # type: ignore
-)
+if __name__ == '__main__':
+    prepare_charts(
+        **parameters.parameters  # type: ignore
+    )
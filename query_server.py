@@ -0,0 +1,312 @@
+import altair as alt
+import argparse
+import collections
+import concurrent.futures
+import http.server
+import json
+import numpy as np
+import pandas as pd
+import parameters
+import threading
+import time
+import traceback
+
+from balance_matrix import BalanceMatrix
+from invesment_strategies import *
+from jit_simulation import SerialJitSimulationRunner
+from market_data import MarketData, load_market_data
+from prepare_charts import get_balance_chart, get_downsampled_distribution, simulation_runners
+from simulation import AssetConfig, AssetConfigs, get_max_investment_years, get_skip_rows, months_per_period
+
+default_host = '127.0.0.1'
+default_port = 8050
+default_workers = 4
+default_cache_entries = 256
+default_percents = [5, 10, 25, 50, 75, 90, 95]
+
+outputs = ('distribution', 'chart')
+query_keys = ('strategies', 'investment_years', 'start_date', 'end_date', 'overrides', 'output', 'percents', 'points')
+overridable_parameters = (
+    'initial_balance', 'annual_contributions', 'dividend_tax_rate_percent', 'capital_gains_tax_rate_percent', 'simulation_engine', 'period',
+    'fees_percents')
+
+# Queries are simulated on threads of the service, see SerialJitSimulationRunner.
+query_simulation_runners = {**simulation_runners, 'jit': SerialJitSimulationRunner}
+
+rebalancing_strategy_types = dict(
+    Sp500AndVbmfxStrategyWoSelling=Sp500AndVbmfxStrategyWoSelling,
+    Sp500AndTb10yStrategyWoSelling=Sp500AndTb10yStrategyWoSelling,
+    Sp500AndVbmfxStrategyWithSelling=Sp500AndVbmfxStrategyWithSelling,
+    Sp500AndTb10yStrategyWithSelling=Sp500AndTb10yStrategyWithSelling,
+)
+
+
+# A strategy is either the label of one of the strategies in parameters.py or a spec such as
+# {"type": "FixedPercentStrategy", "percent": 4}, {"type": "Sp500AndTb10yStrategyWithSelling", "target_sp500_percent": 70},
+# {"type": "Sp500AndVbmfxStrategyWoSelling", "target_sp500_percent": [100, 70]} for a linearly changing target or
+# {"type": "RebalancingStrategy", "assets": ["sp500", "vbmfx", "tb10y"], "target_points": [[0, [60, 20]], [1, [40, 30]]],
+# "rebalancing": "full_rebalancing"}. Specs may give a "label", otherwise the spec itself is the label.
+def get_strategy(spec) -> tuple[InvestmentStrategy, str]:
+    if isinstance(spec, str):
+        for investment_strategy, investment_strategy_label in parameters.parameters['investment_strategies']:
+            if investment_strategy_label == spec:
+                return investment_strategy, investment_strategy_label
+        raise ValueError(f'Unknown strategy label {spec}')
+    if not isinstance(spec, dict) or 'type' not in spec:
+        raise ValueError(f'Strategy {spec} is neither a label nor a spec with a type')
+    label = spec.get('label', json.dumps(spec, sort_keys=True))
+    strategy_type = spec['type']
+    if strategy_type == 'Sp500Strategy':
+        return Sp500Strategy(), label
+    if strategy_type == 'FixedPercentStrategy':
+        return FixedPercentStrategy(float(spec['percent'])), label
+    if strategy_type in rebalancing_strategy_types:
+        target_sp500_percent = spec['target_sp500_percent']
+        if isinstance(target_sp500_percent, list):
+            return rebalancing_strategy_types[strategy_type](linearly_changing_target_sp500_percent(*map(float, target_sp500_percent))), label
+        return rebalancing_strategy_types[strategy_type](fixed_target_sp500_percent(float(target_sp500_percent))), label
+    if strategy_type == 'RebalancingStrategy':
+        for target_point in spec['target_points']:
+            if len(target_point) != 2 or len(target_point[1]) != len(spec['assets']) - 1:
+                raise ValueError(
+                    f'Target point {target_point} must give a fraction and {len(spec["assets"]) - 1} percents, one per asset but the last one')
+        return RebalancingStrategy(spec['assets'], piecewise_target_percents(spec['target_points']), spec['rebalancing']), label
+    raise ValueError(f'Unknown strategy type {strategy_type}')
+
+
+# Fills in the defaults, so that queries asking for the same thing in different ways share a cache entry.
+# max_investment_years is the longest horizon with at least one starting month in the market data.
+def normalize_query(query: dict, max_investment_years: int) -> dict:
+    if not isinstance(query, dict):
+        raise ValueError('The query must be a JSON object')
+    unknown_keys = set(query) - set(query_keys)
+    if unknown_keys:
+        raise ValueError(f'Unknown query keys {", ".join(sorted(unknown_keys))}, expected some of {", ".join(query_keys)}')
+    if 'investment_years' not in query:
+        raise ValueError('The query must give investment_years')
+    investment_years = int(query['investment_years'])
+    if not 1 <= investment_years <= max_investment_years:
+        raise ValueError(f'investment_years must be between 1 and {max_investment_years}, got {investment_years}')
+
+    overrides = dict(query.get('overrides') or {})
+    unknown_overrides = set(overrides) - set(overridable_parameters)
+    if unknown_overrides:
+        raise ValueError(f'Unknown overrides {", ".join(sorted(unknown_overrides))}, expected some of {", ".join(overridable_parameters)}')
+    if overrides.get('simulation_engine', parameters.parameters['simulation_engine']) not in query_simulation_runners:
+        raise ValueError(f'Unknown simulation engine {overrides["simulation_engine"]}, expected one of {", ".join(query_simulation_runners)}')
+    if overrides.get('period', parameters.parameters['period']) not in months_per_period:
+        raise ValueError(f'Unknown period {overrides["period"]}, expected one of {", ".join(months_per_period)}')
+    for label in overrides.get('fees_percents', {}):
+        if label not in parameters.parameters['asset_configs']:
+            raise ValueError(f'Unknown asset {label} in fees_percents')
+
+    output = query.get('output', 'distribution')
+    if output not in outputs:
+        raise ValueError(f'Unknown output {output}, expected one of {", ".join(outputs)}')
+
+    strategies = query.get('strategies') or [label for _, label in parameters.parameters['investment_strategies']]
+    for spec in strategies:
+        get_strategy(spec)
+
+    return dict(
+        strategies=strategies,
+        investment_years=investment_years,
+        start_date=None if query.get('start_date') is None else str(np.datetime64(query['start_date'], 'D')),
+        end_date=None if query.get('end_date') is None else str(np.datetime64(query['end_date'], 'D')),
+        overrides={
+            name: {label: float(fees_percent) for label, fees_percent in value.items()} if name == 'fees_percents'
+            else value if name in ('simulation_engine', 'period') else float(value)
+            for name, value in overrides.items()
+        },
+        output=output,
+        percents=[float(percent) for percent in query.get('percents', default_percents)] if output == 'distribution' else None,
+        points=int(query.get('points', parameters.parameters['chart_points'])) if output == 'chart' else None,
+    )
+
+
+# Keeps the market data in memory and answers queries on a pool of threads. Results are memoized in a least recently used
+# cache keyed by the normalized query. The cache holds futures, so a query that arrives while the same query is running waits for it
+# instead of running it again.
+class QueryService:
+
+    market_data: MarketData
+    cache_entries: int
+    hits: int
+    misses: int
+    _executor: concurrent.futures.ThreadPoolExecutor
+    _results: collections.OrderedDict
+    _lock: threading.Lock
+
+    def __init__(self, market_data: MarketData, workers: int = default_workers, cache_entries: int = default_cache_entries) -> None:
+        self.market_data = market_data
+        self.cache_entries = cache_entries
+        self.hits = 0
+        self.misses = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._results = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def query(self, query: dict) -> dict:
+        normalized_query = normalize_query(query, get_max_investment_years(len(self.market_data)))
+        key = json.dumps(normalized_query, sort_keys=True)
+        with self._lock:
+            future = self._results.get(key)
+            if future is not None:
+                self.hits += 1
+                self._results.move_to_end(key)
+            else:
+                self.misses += 1
+                future = self._executor.submit(self._run_query, normalized_query)
+                self._results[key] = future
+                while len(self._results) > self.cache_entries:
+                    self._results.popitem(last=False)
+        try:
+            return future.result()
+        except Exception:
+            with self._lock:
+                if self._results.get(key) is future:
+                    del self._results[key]
+            raise
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return dict(cache_entries=len(self._results), max_cache_entries=self.cache_entries, hits=self.hits, misses=self.misses)
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+    def _run_query(self, normalized_query: dict) -> dict:
+        start = time.perf_counter()
+        balance_matrix = self._simulate(normalized_query)
+        if normalized_query['output'] == 'distribution':
+            result = get_distribution(balance_matrix, normalized_query['percents'])
+        else:
+            result = dict(chart=get_chart(balance_matrix, normalized_query['investment_years'], normalized_query['points']))
+        return dict(query=normalized_query, seconds=time.perf_counter() - start, **result)
+
+    def _simulate(self, normalized_query: dict) -> BalanceMatrix:
+        p = {**parameters.parameters, **normalized_query['overrides']}
+        fees_percents = p.get('fees_percents', {})
+        asset_configs = AssetConfigs({
+            label: AssetConfig(
+                fees_percent=fees_percents.get(label, config.fees_percent), accumulate_dividens=config.accumulate_dividens,
+                lot_selection=config.lot_selection)
+            for label, config in parameters.parameters['asset_configs'].items()
+        })
+        simulation_runner = query_simulation_runners[p['simulation_engine']](
+            p['initial_balance'], p['annual_contributions'], p['dividend_tax_rate_percent'], asset_configs, p['period'],
+            p['capital_gains_tax_rate_percent'])
+
+        investment_years = normalized_query['investment_years']
+        skip_rows = get_skip_rows(len(self.market_data), 0, investment_years)
+        first_dates = self.market_data.dates[np.asarray(skip_rows, dtype=np.int64)].astype('datetime64[D]')
+        if normalized_query['start_date'] is not None:
+            skip_rows = skip_rows[np.searchsorted(first_dates, np.datetime64(normalized_query['start_date']), side='left'):]
+        if normalized_query['end_date'] is not None:
+            skip_rows = skip_rows[:np.searchsorted(first_dates[skip_rows.start:], np.datetime64(normalized_query['end_date']), side='right')]
+        if not len(skip_rows):
+            raise ValueError(
+                f'No starting months with {investment_years} years of data between {normalized_query["start_date"] or "the first month"} '
+                f'and {normalized_query["end_date"] or "the last month"}')
+
+        investment_strategies = [get_strategy(spec) for spec in normalized_query['strategies']]
+        strategy_balances = simulation_runner.simulate_many(
+            self.market_data, skip_rows, investment_years, [investment_strategy for investment_strategy, _ in investment_strategies])
+        return BalanceMatrix(
+            self.market_data.dates[np.asarray(skip_rows, dtype=np.int64)],
+            [investment_strategy_label for _, investment_strategy_label in investment_strategies],
+            np.array([final_balances for _, final_balances in strategy_balances]))
+
+
+def get_distribution(balance_matrix: BalanceMatrix, percents: list[float]) -> dict:
+    percentiles = balance_matrix.get_percentiles(percents)
+    return dict(
+        start_count=balance_matrix.shape[1],
+        first_start_date=str(balance_matrix.first_dates[0].astype('datetime64[D]')),
+        last_start_date=str(balance_matrix.first_dates[-1].astype('datetime64[D]')),
+        strategies=[
+            dict(
+                label=investment_strategy_label,
+                mean=float(balance_matrix.final_balances[strategy_index].mean()),
+                percentiles={f'{percent:g}': float(percentile) for percent, percentile in zip(percents, percentiles[strategy_index])},
+            )
+            for strategy_index, investment_strategy_label in enumerate(balance_matrix.strategy_labels)
+        ])
+
+
+# The Vega-Lite spec of the same chart as a panel of returns.html.
+def get_chart(balance_matrix: BalanceMatrix, investment_years: int, points: int) -> dict:
+    selection = alt.selection_multi(bind='legend', fields=['investment_strategy'])
+    chart_points = pd.concat(
+        [
+            get_downsampled_distribution(sorted_balances, points, investment_strategy_label)
+            for investment_strategy_label, sorted_balances in zip(balance_matrix.strategy_labels, balance_matrix.get_sorted_balances())
+        ],
+        ignore_index=True)
+    return get_balance_chart(chart_points, f'% of years with lower final balance if investing for {investment_years}y', selection).to_dict()
+
+
+class QueryRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    server: 'QueryServer'
+
+    def do_GET(self) -> None:
+        if self.path == '/strategies':
+            self._send_json(200, [label for _, label in parameters.parameters['investment_strategies']])
+        elif self.path == '/stats':
+            self._send_json(200, self.server.service.get_stats())
+        else:
+            self._send_json(404, dict(error=f'Unknown path {self.path}'))
+
+    def do_POST(self) -> None:
+        if self.path != '/query':
+            self._send_json(404, dict(error=f'Unknown path {self.path}'))
+            return
+        try:
+            query = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            self._send_json(200, self.server.service.query(query))
+        except (ValueError, KeyError, TypeError) as error:
+            self._send_json(400, dict(error=str(error)))
+        except Exception as error:
+            self.log_error('query failed\n%s', traceback.format_exc())
+            self._send_json(500, dict(error=f'{type(error).__name__}: {error}'))
+
+    def _send_json(self, status: int, body) -> None:
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+# Every connection is handled on its own thread, which waits for the result of the query from the service.
+class QueryServer(http.server.ThreadingHTTPServer):
+
+    service: QueryService
+
+    def __init__(self, address: tuple[str, int], service: QueryService) -> None:
+        super().__init__(address, QueryRequestHandler)
+        self.service = service
+
+
+def serve(host: str, port: int, workers: int, cache_entries: int) -> None:
+    service = QueryService(load_market_data(daily_sampling=parameters.parameters['daily_sampling']), workers, cache_entries)
+    with QueryServer((host, port), service) as server:
+        print(f'serving queries on http://{host}:{server.server_address[1]}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            service.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Answer simulation queries over HTTP with the market data kept in memory.')
+    parser.add_argument('--host', default=default_host)
+    parser.add_argument('--port', type=int, default=default_port)
+    parser.add_argument('--workers', type=int, default=default_workers, help='number of queries simulated at once')
+    parser.add_argument('--cache-entries', type=int, default=default_cache_entries, help='number of query results kept in memory')
+    arguments = parser.parse_args()
+    serve(arguments.host, arguments.port, arguments.workers, arguments.cache_entries)
@@ -0,0 +1,151 @@
+import argparse
+import hashlib
+import inspect
+import json
+import numpy as np
+import os
+import pandas as pd
+import sys
+import types
+
+default_cache_dir = os.path.join('.cache', 'results')
+default_cache_max_bytes = 256 * 1024 * 1024
+
+
+# Private attributes hold derived state such as precomputed arrays, so they are not part of the description.
+def describe(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [describe(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): describe(item) for key, item in sorted(value.items())}
+    if isinstance(value, types.FunctionType):
+        return _describe_function(value)
+    return dict(
+        type=f'{type(value).__module__}.{type(value).__qualname__}',
+        source=_hash_sources(type(value)),
+        config=describe({key: item for key, item in vars(value).items() if not key.startswith('_')}) if hasattr(value, '__dict__') else repr(value))
+
+
+# Functions have no attributes to describe, so they are described by their byte code, constants, defaults, the contents of their closure
+# and the simple values of the globals they read, e.g. two lambdas that return different target percents.
+def _describe_function(function: types.FunctionType) -> dict:
+    return dict(
+        type=f'{function.__module__}.{function.__qualname__}',
+        code=_describe_code(function.__code__),
+        defaults=describe(function.__defaults__),
+        keyword_defaults=describe(function.__kwdefaults__),
+        closure=[describe(cell.cell_contents) for cell in function.__closure__ or ()],
+        globals={
+            name: function.__globals__[name] for name in function.__code__.co_names
+            if isinstance(function.__globals__.get(name), (bool, int, float, str))})
+
+
+def _describe_code(code: types.CodeType) -> dict:
+    return dict(
+        code=hashlib.sha256(code.co_code).hexdigest(),
+        constants=[_describe_code(constant) if isinstance(constant, types.CodeType) else describe(constant) for constant in code.co_consts],
+        names=list(code.co_names))
+
+
+def _hash_sources(cls) -> str:
+    digest = hashlib.sha256()
+    for base in cls.__mro__:
+        module = sys.modules.get(base.__module__)
+        if module is None or base.__module__ == 'builtins':
+            continue
+        try:
+            path = inspect.getsourcefile(module)
+        except TypeError:
+            continue
+        if path:
+            with open(path, 'rb') as source_file:
+                digest.update(source_file.read())
+    return digest.hexdigest()
+
+
+class ResultCache:
+
+    cache_dir: str
+    max_bytes: int
+
+    def __init__(self, cache_dir: str = default_cache_dir, max_bytes: int = default_cache_max_bytes) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    # Keys don't include the market data. Every entry stores a checksum of each market data row
+    # instead, so that results stay usable when new months are appended to the data.
+    @staticmethod
+    def get_key(settings: dict, investment_strategy, investment_years: int) -> str:
+        key = json.dumps(
+            dict(
+                settings=describe(settings),
+                investment_strategy=describe(investment_strategy),
+                investment_years=investment_years),
+            sort_keys=True)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def load(self, key: str, row_checksums: np.ndarray):
+        path = self._path(key)
+        try:
+            with np.load(path) as stored:
+                stored_row_checksums = stored['row_checksums']
+                if stored_row_checksums.shape[0] > row_checksums.shape[0] \
+                        or not np.array_equal(stored_row_checksums, row_checksums[:stored_row_checksums.shape[0]]):
+                    return None
+                balances = pd.DataFrame(dict(first_date=stored['first_date'], final_balance=stored['final_balance']))
+        except (FileNotFoundError, KeyError, ValueError, OSError):
+            return None
+        os.utime(path)
+        return balances
+
+    def store(self, key: str, balances: pd.DataFrame, row_checksums: np.ndarray) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        temp_path = path + '.tmp.npz'
+        np.savez(
+            temp_path,
+            first_date=balances['first_date'].to_numpy().astype('datetime64[ns]'),
+            final_balance=balances['final_balance'].to_numpy(dtype=float),
+            row_checksums=row_checksums)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self) -> None:
+        entries = self._entries()
+        total_bytes = sum(size for _, size, _ in entries)
+        for path, size, _ in sorted(entries, key=lambda entry: entry[2]):
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(path)
+            total_bytes -= size
+
+    def purge(self) -> int:
+        entries = self._entries()
+        for path, _, _ in entries:
+            os.remove(path)
+        return len(entries)
+
+    def _entries(self) -> list[tuple[str, int, float]]:
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((os.path.join(self.cache_dir, name), stat.st_size, stat.st_mtime))
+        return entries
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the cache of simulation results.')
+    parser.add_argument('command', choices=['purge'])
+    parser.add_argument('--cache-dir', default=default_cache_dir)
+    arguments = parser.parse_args()
+    if arguments.command == 'purge':
+        removed = ResultCache(arguments.cache_dir).purge()
+        print(f'removed {removed} cached results from {arguments.cache_dir}')
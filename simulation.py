@@ -1,61 +1,145 @@
+import numpy as np
+
+from typing import Sequence, Union
+
+from instrumentation import instrumentation
 from invesment_strategies import *
+from market_data import MarketData, as_market_data
+
+
+# Contributions, dividends, fees and the investment strategy are applied once per period.
+months_per_period = dict(annual=12, quarterly=3, monthly=1)
+
+
+def get_skip_rows(data_length: int, start_from: int, investment_years: int) -> range:
+    return range(((data_length - start_from) // 12 - investment_years) * 12)
+
 
+# The longest horizon for which get_skip_rows has a starting month.
+def get_max_investment_years(data_length: int, start_from: int = 0) -> int:
+    return (data_length - start_from) // 12 - 1
 
+
+# The batch engines also take an array with an initial balance and contributions per simulated path, which they broadcast.
 class SimulationRunner:
 
-    initial_balance: float
-    annual_contributions: float
+    initial_balance: Union[float, np.ndarray]
+    annual_contributions: Union[float, np.ndarray]
     dividend_tax_rate_percent: float
     asset_configs: AssetConfigs
-
-    def __init__(self, initial_balance: float, annual_contributions: float, dividend_tax_rate_percent: float, asset_configs: AssetConfigs) -> None:
+    period: str
+    months_per_period: int
+    periods_per_year: int
+    capital_gains_tax_rate_percent: float
+
+    def __init__(
+        self, initial_balance: Union[float, np.ndarray], annual_contributions: Union[float, np.ndarray], dividend_tax_rate_percent: float,
+        asset_configs: AssetConfigs, period: str = 'annual', capital_gains_tax_rate_percent: float = 0) -> None:
+        if period not in months_per_period:
+            raise ValueError(f'Unknown period {period}, expected one of {", ".join(months_per_period)}')
         self.initial_balance = initial_balance
         self.annual_contributions = annual_contributions
         self.dividend_tax_rate_percent = dividend_tax_rate_percent
         self.asset_configs = asset_configs
-
-    def run_simulation(self, data, skip_rows: int, investment_years: int, investment_strategy: InvestmentStrategy):
-
+        self.period = period
+        self.months_per_period = months_per_period[period]
+        self.periods_per_year = 12 // self.months_per_period
+        self.capital_gains_tax_rate_percent = capital_gains_tax_rate_percent
+
+    def run_simulations(self, data, skip_rows, investment_years: int, investment_strategy: InvestmentStrategy) -> list[dict]:
+        market_data = as_market_data(data)
+        return [self.run_simulation(market_data, i, investment_years, investment_strategy) for i in skip_rows]
+
+    def run_many_simulations(self, data, skip_rows, investment_years: int, investment_strategies: Sequence[InvestmentStrategy]) -> list[list[dict]]:
+        return [self.run_simulations(data, skip_rows, investment_years, investment_strategy) for investment_strategy in investment_strategies]
+
+    # Same as run_many_simulations, but returns arrays of first dates and final balances instead of a dict per simulation.
+    def simulate_many(self, data, skip_rows, investment_years: int, investment_strategies: Sequence[InvestmentStrategy]) -> list[tuple[np.ndarray, np.ndarray]]:
+        market_data = as_market_data(data)
+        first_dates = market_data.dates[np.asarray(skip_rows, dtype=np.int64)].astype('datetime64[ns]')
+        return [
+            (
+                first_dates,
+                np.array([self.run_simulation(market_data, i, investment_years, investment_strategy)['final_balance'] for i in skip_rows], dtype=float),
+            )
+            for investment_strategy in investment_strategies
+        ]
+
+    # Inflation adjusted balances at the start of every year of every simulation, as a (starting months, years + 1) array per strategy.
+    # The first column is the initial balance and the last one is the final balance.
+    def simulate_yearly_balances(self, data, skip_rows, investment_years: int, investment_strategies: Sequence[InvestmentStrategy]) -> list[np.ndarray]:
+        market_data = as_market_data(data)
+        return [
+            np.array([
+                self.run_simulation(market_data, i, investment_years, investment_strategy, record_yearly_balances=True)['yearly_balances']
+                for i in skip_rows
+            ], dtype=float).reshape(len(skip_rows), investment_years + 1)
+            for investment_strategy in investment_strategies
+        ]
+
+    # Final balances of every starting month from start_from for every horizon, simulated one horizon after another.
+    def simulate_horizons(
+        self, data, start_from: int, investment_years_options: list[int],
+        investment_strategies: Sequence[InvestmentStrategy]) -> dict[int, list[tuple[np.ndarray, np.ndarray]]]:
+        market_data = as_market_data(data)
+        return {
+            investment_years: self.simulate_many(
+                market_data, get_skip_rows(len(market_data), start_from, investment_years), investment_years, investment_strategies)
+            for investment_years in investment_years_options
+        }
+
+    def run_simulation(self, data, skip_rows: int, investment_years: int, investment_strategy: InvestmentStrategy, record_yearly_balances: bool = False):
+
+        if instrumentation.enabled:
+            instrumentation.count('simulations')
+
+        # One results buffer is filled in place every period.
         asset_results = AssetResults()
+        sp500_result, vbmfx_result, tb10y_result = (asset_results.results[asset_index] for asset_index in (sp500_index, vbmfx_index, tb10y_index))
 
-        portfolio = Portfolio(self.initial_balance, self.asset_configs)
+        portfolio = Portfolio(float(self.initial_balance), self.asset_configs, self.periods_per_year, self.capital_gains_tax_rate_percent)
+        yearly_balances = []
 
-        for year_index in range(investment_years + 1):
+        market_data = as_market_data(data).periodic(skip_rows, investment_years, self.months_per_period)
+        period_count = investment_years * self.periods_per_year
 
-            data_index = skip_rows + year_index * 12
-            row = data.iloc[data_index]
+        for period_index in range(period_count + 1):
 
-            this_date = row['date']
-            cpi = row['cpi']
+            this_date = market_data.timestamps[period_index]
+            cpi = market_data.cpi[period_index]
 
-            asset_results = AssetResults(
-                sp500=AssetResult(row['sp500_index'], row['sp500_dividend']),
-                vbmfx=AssetResult(row['vbmfx_price'], row['vbmfx_dividend']),
-                tb10y=AssetResult(100, row['bonds_10y_rate_percent'])
-            )
+            sp500_result.set(market_data.sp500_index[period_index], market_data.sp500_dividend[period_index])
+            vbmfx_result.set(market_data.vbmfx_price[period_index], market_data.vbmfx_dividend[period_index])
+            tb10y_result.set(100, market_data.bonds_10y_rate_percent[period_index])
 
-            if year_index == 0:
+            if period_index == 0:
                 first_date = this_date
                 first_cpi = cpi
 
-            if this_date.month != first_date.month:
-                raise Exception(f'Current month ({this_date}) is not the same as the first month ({first_date})')
+            if (this_date.month - first_date.month) % self.months_per_period:
+                raise Exception(f'Current month ({this_date}) is not a whole number of periods after the first month ({first_date})')
 
-            if year_index == 0:
+            if period_index == 0:
                 investment_strategy.start_investing(this_date, portfolio, asset_results)
             else:
                 self._collect_dividends_and_pay_devidend_taxes(this_date, portfolio, asset_results)
                 self._collect_maturity(this_date, portfolio)
                 self._pay_all_fees(portfolio)
-                portfolio.cash += self.annual_contributions * cpi / first_cpi
-                investment_strategy.execute(this_date, year_index, investment_years, portfolio, asset_results)
+                portfolio.cash += self.annual_contributions / self.periods_per_year * cpi / first_cpi
+                investment_strategy.execute(this_date, period_index, period_count, portfolio, asset_results)
+
+            if record_yearly_balances and period_index % self.periods_per_year == 0:
+                yearly_balances.append(self._summarize(this_date, portfolio, asset_results) * first_cpi / cpi)
 
-        return dict(first_date=first_date, final_balance=self._summarize(this_date, portfolio, asset_results) * first_cpi / cpi)
+        simulation = dict(first_date=first_date, final_balance=self._summarize(this_date, portfolio, asset_results) * first_cpi / cpi)
+        if record_yearly_balances:
+            simulation['yearly_balances'] = yearly_balances
+        return simulation
 
+    # Dividends and coupons in the data are yearly amounts.
     def _collect_dividends_and_pay_devidend_taxes(self, this_date: datetime, portfolio: Portfolio, results: AssetResults) -> None:
-        for label, position in portfolio.items():
-            result = results.get(label)
-            dividends = position.get_dividends(result)
+        for label, position, result in zip(assets, portfolio.positions, results.results):
+            dividends = position.get_dividends(result) / self.periods_per_year
             dividends_post_tax = dividends * (100 - self.dividend_tax_rate_percent) / 100
             portfolio.cash += dividends_post_tax
             config = self.asset_configs[label]
@@ -63,19 +147,18 @@ class SimulationRunner:
                 portfolio.buy(this_date, label, dividends_post_tax, results)
 
     def _collect_maturity(self, this_date: datetime, portfolio: Portfolio) -> None:
-        for position in portfolio.values():
+        for position in portfolio.positions:
             maturity = position.get_maturity(this_date)
             if maturity:
                 portfolio.cash += maturity
 
     def _pay_all_fees(self, portfolio: Portfolio) -> None:
-        for position in portfolio.values():
+        for position in portfolio.positions:
             position.pay_fees()
 
     @staticmethod
     def _summarize(this_date: datetime, portfolio: Portfolio, results: AssetResults) -> float:
         balance = 0.0
-        for label, position in portfolio.items():
-            result = results.get(label)
+        for position, result in zip(portfolio.positions, results.results):
             balance += position.get_value(this_date, result)
         return balance
@@ -0,0 +1,105 @@
+import itertools as it
+import numpy as np
+import pandas as pd
+import parameters
+
+from typing import Optional
+
+from batch_simulation import BatchSimulationRunner
+from market_data import MarketData, load_market_data
+from simulation import AssetConfig, AssetConfigs, get_skip_rows, months_per_period
+
+# Upper bound on the number of (start month, grid point) columns simulated at once by path dependent strategies.
+max_batch_columns = 250_000
+
+
+def get_asset_config_grid(asset_configs: AssetConfigs, fees_percents: dict[str, list[float]]) -> list[AssetConfigs]:
+    labels = list(fees_percents)
+    return [
+        AssetConfigs({
+            label: AssetConfig(
+                fees_percent=dict(zip(labels, fees)).get(label, config.fees_percent), accumulate_dividens=config.accumulate_dividens,
+                lot_selection=config.lot_selection)
+            for label, config in asset_configs.items()
+        })
+        for fees in it.product(*fees_percents.values())
+    ]
+
+
+def sweep(
+    market_data: MarketData, investment_strategies, investment_years_options: list[int], asset_configs: AssetConfigs,
+    initial_balances: list[float], annual_contributions: list[float], dividend_tax_rate_percents: list[float],
+    fees_percents: Optional[dict[str, list[float]]] = None, start_from: int = 0, period: str = 'annual',
+    capital_gains_tax_rate_percent: float = 0) -> pd.DataFrame:
+
+    pairs = np.array(list(it.product(initial_balances, annual_contributions)), dtype=float).reshape(-1, 2)
+    pair_initial_balances = pairs[:, 0]
+    pair_annual_contributions = pairs[:, 1]
+
+    tables = []
+
+    for dividend_tax_rate_percent, sweep_asset_configs in it.product(dividend_tax_rate_percents, get_asset_config_grid(asset_configs, fees_percents or {})):
+
+        fees = ', '.join(f'{label} fees {config.fees_percent}%' for label, config in sweep_asset_configs.items())
+        print(f'sweeping dividend tax rate {dividend_tax_rate_percent}%, {fees}')
+
+        for investment_years in investment_years_options:
+
+            skip_rows = get_skip_rows(len(market_data), start_from, investment_years)
+            start_count = len(skip_rows)
+            first_dates = market_data.dates[np.asarray(skip_rows, dtype=np.int64)].astype('datetime64[ns]')
+            periodic_data = market_data.periodic_batch(skip_rows, investment_years, months_per_period[period])
+
+            for investment_strategy, investment_strategy_label in investment_strategies:
+
+                if investment_strategy.linear:
+                    # Final balances for a unit initial balance and for unit contributions, combined for every grid point.
+                    simulation_runner = BatchSimulationRunner(
+                        np.repeat([1.0, 0.0], start_count), np.repeat([0.0, 1.0], start_count), dividend_tax_rate_percent, sweep_asset_configs, period,
+                        capital_gains_tax_rate_percent)
+                    basis = simulation_runner \
+                        .simulate_paths(periodic_data.tile(2), investment_years, investment_strategy) \
+                        .reshape(2, start_count)
+                    final_balances = pair_initial_balances[:, np.newaxis] * basis[0] + pair_annual_contributions[:, np.newaxis] * basis[1]
+                else:
+                    chunk_size = max(1, max_batch_columns // start_count)
+                    chunks = []
+                    for chunk_start in range(0, len(pairs), chunk_size):
+                        chunk = slice(chunk_start, chunk_start + chunk_size)
+                        chunk_pair_count = len(pairs[chunk])
+                        simulation_runner = BatchSimulationRunner(
+                            np.repeat(pair_initial_balances[chunk], start_count), np.repeat(pair_annual_contributions[chunk], start_count),
+                            dividend_tax_rate_percent, sweep_asset_configs, period, capital_gains_tax_rate_percent)
+                        chunks.append(
+                            simulation_runner
+                                .simulate_paths(periodic_data.tile(chunk_pair_count), investment_years, investment_strategy)
+                                .reshape(chunk_pair_count, start_count))
+                    final_balances = np.concatenate(chunks)
+
+                tables.append(pd.DataFrame(dict(
+                    initial_balance=np.repeat(pair_initial_balances, start_count),
+                    annual_contributions=np.repeat(pair_annual_contributions, start_count),
+                    dividend_tax_rate_percent=dividend_tax_rate_percent,
+                    **{f'{label}_fees_percent': config.fees_percent for label, config in sweep_asset_configs.items()},
+                    investment_years=investment_years,
+                    investment_strategy=investment_strategy_label,
+                    first_date=np.tile(first_dates, len(pairs)),
+                    final_balance=final_balances.reshape(-1))))
+
+    return pd.concat(tables, ignore_index=True)
+
+
+if __name__ == '__main__':
+    sweep_balances = sweep(
+        load_market_data(daily_sampling=parameters.parameters['daily_sampling']),
+        parameters.parameters['investment_strategies'],
+        parameters.parameters['investment_years_options'],
+        parameters.parameters['asset_configs'],
+        period=parameters.parameters['period'],
+        capital_gains_tax_rate_percent=parameters.parameters['capital_gains_tax_rate_percent'],
+        **parameters.sweep_parameters)
+    grid_columns = [column for column in sweep_balances.columns if column not in ('first_date', 'final_balance')]
+    sweep_balances \
+        .groupby(grid_columns, sort=False)['final_balance'] \
+        .describe(percentiles=[0.1, 0.5, 0.9]) \
+        .to_csv('sweep.csv')
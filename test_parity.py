@@ -0,0 +1,59 @@
+import parameters
+import pytest
+
+from batch_simulation import BATCH_RELATIVE_TOLERANCE
+from invesment_strategies import fifo, hifo
+from market_data import load_market_data
+from parity import get_asset_configs, get_final_balances, get_relative_error, get_simulation_runner
+from simulation import get_skip_rows
+
+engines = ['batch', 'jit', 'prefix']
+investment_strategies = parameters.parameters['investment_strategies']
+investment_years = 20
+capital_gains_tax_rate_percent = 15
+
+# A few starting months per period cover the strategies while keeping the reference engine fast.
+steps = dict(annual=12, monthly=48)
+
+
+@pytest.fixture(scope='module')
+def market_data():
+    return load_market_data(daily_sampling=parameters.parameters['daily_sampling'])
+
+
+# Final balances of an engine, with the ones of the reference engine shared by the engines compared with them.
+@pytest.fixture(scope='module')
+def final_balances(market_data):
+    cache = {}
+
+    def get_engine_balances(engine, period, investment_strategy_label, investment_strategy, lot_selection=None):
+        key = (engine, period, investment_strategy_label, lot_selection)
+        if engine != 'reference' or key not in cache:
+            skip_rows = get_skip_rows(len(market_data), 0, investment_years)[::steps[period]]
+            simulation_runner = get_simulation_runner(engine, period) if lot_selection is None else get_simulation_runner(
+                engine, period, capital_gains_tax_rate_percent, get_asset_configs(lot_selection))
+            cache[key] = get_final_balances(simulation_runner, market_data, skip_rows, investment_years, investment_strategy)
+        return cache[key]
+
+    return get_engine_balances
+
+
+@pytest.mark.parametrize('investment_strategy, investment_strategy_label', investment_strategies, ids=[label for _, label in investment_strategies])
+@pytest.mark.parametrize('engine', engines)
+@pytest.mark.parametrize('period', list(steps))
+def test_engines_match_reference(final_balances, engine, period, investment_strategy, investment_strategy_label):
+    relative_error = get_relative_error(
+        final_balances(engine, period, investment_strategy_label, investment_strategy),
+        final_balances('reference', period, investment_strategy_label, investment_strategy))
+    assert relative_error <= BATCH_RELATIVE_TOLERANCE
+
+
+# Taxed sales depend on which lots are sold, which the engines track in different ways.
+@pytest.mark.parametrize('investment_strategy, investment_strategy_label', investment_strategies, ids=[label for _, label in investment_strategies])
+@pytest.mark.parametrize('engine', ['batch', 'jit'])
+@pytest.mark.parametrize('lot_selection', [fifo, hifo])
+def test_engines_match_reference_with_capital_gains_tax(final_balances, lot_selection, engine, investment_strategy, investment_strategy_label):
+    relative_error = get_relative_error(
+        final_balances(engine, 'monthly', investment_strategy_label, investment_strategy, lot_selection),
+        final_balances('reference', 'monthly', investment_strategy_label, investment_strategy, lot_selection))
+    assert relative_error <= BATCH_RELATIVE_TOLERANCE
@@ -0,0 +1,74 @@
+import json
+import os
+import pytest
+import subprocess
+import sys
+import threading
+import urllib.error
+import urllib.request
+
+from query_server import QueryServer, normalize_query
+
+# The server runs in a child process, since a process that hangs at interpreter exit can only be noticed from outside of it.
+server_script = '''
+import json
+import threading
+import urllib.request
+
+import parameters
+from market_data import load_market_data
+from query_server import QueryServer, QueryService
+
+service = QueryService(load_market_data(daily_sampling=parameters.parameters['daily_sampling']), workers=2)
+with QueryServer(('127.0.0.1', 0), service) as server:
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    query = dict(strategies=['sp500', 'sp500 & tb10y 70/30 w/o selling'], investment_years=20, overrides=dict(simulation_engine='jit'))
+    request = urllib.request.Request(
+        f'http://127.0.0.1:{server.server_address[1]}/query', data=json.dumps(query).encode('utf-8'), method='POST')
+    with urllib.request.urlopen(request) as response:
+        print(json.load(response)['start_count'])
+    server.shutdown()
+    thread.join()
+    service.close()
+'''
+
+
+def test_server_exits_after_jit_query():
+    completed = subprocess.run(
+        [sys.executable, '-c', server_script], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, timeout=180)
+    assert completed.returncode == 0, completed.stderr
+    assert int(completed.stdout.split()[-1]) > 0
+
+
+@pytest.mark.parametrize('investment_years', [-1, 0, 101])
+def test_investment_years_out_of_range(investment_years):
+    with pytest.raises(ValueError, match='investment_years'):
+        normalize_query(dict(investment_years=investment_years), 100)
+
+
+def test_target_points_with_wrong_number_of_percents():
+    spec = dict(type='RebalancingStrategy', assets=['sp500', 'vbmfx', 'tb10y'], target_points=[[0, [60, 20]], [1, [40]]], rebalancing='full_rebalancing')
+    with pytest.raises(ValueError, match='Target point'):
+        normalize_query(dict(strategies=[spec], investment_years=20), 100)
+
+
+class FailingService:
+
+    def query(self, query: dict) -> dict:
+        raise IndexError('index 3 is out of bounds')
+
+
+def test_unexpected_error_is_answered_with_500():
+    with QueryServer(('127.0.0.1', 0), FailingService()) as server:  # type: ignore
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            request = urllib.request.Request(f'http://127.0.0.1:{server.server_address[1]}/query', data=b'{}', method='POST')
+            with pytest.raises(urllib.error.HTTPError) as error_info:
+                urllib.request.urlopen(request)
+            assert error_info.value.code == 500
+            assert json.load(error_info.value) == dict(error='IndexError: index 3 is out of bounds')
+        finally:
+            server.shutdown()
+            thread.join()
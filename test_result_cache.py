@@ -0,0 +1,30 @@
+from invesment_strategies import Sp500AndVbmfxStrategyWithSelling, fixed_target_sp500_percent
+from result_cache import ResultCache
+
+settings = dict(initial_balance=100, annual_contributions=20)
+
+
+def get_key(investment_strategy) -> str:
+    return ResultCache.get_key(settings, investment_strategy, 20)
+
+
+def test_different_lambdas_have_different_keys():
+    assert get_key(Sp500AndVbmfxStrategyWithSelling(lambda i, n: 50)) != get_key(Sp500AndVbmfxStrategyWithSelling(lambda i, n: 90))
+
+
+def test_same_lambdas_have_same_keys():
+    assert get_key(Sp500AndVbmfxStrategyWithSelling(lambda i, n: 50)) == get_key(Sp500AndVbmfxStrategyWithSelling(lambda i, n: 50))
+
+
+def test_closures_with_different_contents_have_different_keys():
+
+    def get_target_sp500_percent(target_sp500_percent):
+        return lambda i, n: target_sp500_percent
+
+    assert get_key(Sp500AndVbmfxStrategyWithSelling(get_target_sp500_percent(50))) \
+        != get_key(Sp500AndVbmfxStrategyWithSelling(get_target_sp500_percent(90)))
+
+
+def test_schedules_with_different_targets_have_different_keys():
+    assert get_key(Sp500AndVbmfxStrategyWithSelling(fixed_target_sp500_percent(50))) \
+        != get_key(Sp500AndVbmfxStrategyWithSelling(fixed_target_sp500_percent(90)))
@@ -0,0 +1,34 @@
+import numpy as np
+import parameters
+
+from batch_simulation import BatchSimulationRunner
+from invesment_strategies import FixedPercentStrategy, Sp500AndVbmfxStrategyWithSelling, Sp500Strategy, fixed_target_sp500_percent
+from market_data import load_market_data
+from simulation import get_skip_rows
+from sweep import sweep
+
+# Sp500Strategy is combined from the balances for a unit initial balance and unit contributions, the rebalancing one is simulated directly.
+investment_strategies = [
+    (Sp500Strategy(), 'sp500'),
+    (FixedPercentStrategy(4), 'fixed 4%'),
+    (Sp500AndVbmfxStrategyWithSelling(fixed_target_sp500_percent(70)), 'sp500 & vbmfx 70/30 with selling'),
+]
+
+
+def test_sweep_matches_simulations_of_swept_values():
+    market_data = load_market_data(daily_sampling=parameters.parameters['daily_sampling'])
+    asset_configs = parameters.parameters['asset_configs']
+    initial_balances = [100.0, 1000.0]
+    annual_contributions = [0.0, 20.0]
+    sweep_balances = sweep(market_data, investment_strategies, [20], asset_configs, initial_balances, annual_contributions, [15])
+    for initial_balance in initial_balances:
+        for annual_contribution in annual_contributions:
+            simulation_runner = BatchSimulationRunner(initial_balance, annual_contribution, 15, asset_configs)
+            for investment_strategy, investment_strategy_label in investment_strategies:
+                [(first_dates, final_balances)] = simulation_runner.simulate_many(
+                    market_data, get_skip_rows(len(market_data), 0, 20), 20, [investment_strategy])
+                swept = sweep_balances[
+                    (sweep_balances['initial_balance'] == initial_balance) & (sweep_balances['annual_contributions'] == annual_contribution)
+                    & (sweep_balances['investment_strategy'] == investment_strategy_label)]
+                assert np.array_equal(swept['first_date'].to_numpy(), first_dates)
+                np.testing.assert_allclose(swept['final_balance'].to_numpy(), final_balances, rtol=1e-12)
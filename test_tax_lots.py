@@ -0,0 +1,65 @@
+import pytest
+
+from datetime import datetime
+
+from invesment_strategies import AssetConfig, AssetConfigs, AssetResult, AssetResults, EquityPosition, Portfolio, fifo, hifo, sp500, tb10y, vbmfx
+
+dates = [datetime(2000 + year, 1, 1) for year in range(4)]
+
+
+def get_results(sp500_price: float) -> AssetResults:
+    return AssetResults(sp500=AssetResult(sp500_price, 0), vbmfx=AssetResult(10, 0), tb10y=AssetResult(100, 5))
+
+
+def get_portfolio(lot_selection: str, capital_gains_tax_rate_percent: float) -> Portfolio:
+    configs = AssetConfigs({
+        sp500: AssetConfig(0, accumulate_dividens=False, lot_selection=lot_selection),
+        vbmfx: AssetConfig(0, accumulate_dividens=False, lot_selection=lot_selection),
+        tb10y: AssetConfig(0, accumulate_dividens=False),
+    })
+    return Portfolio(1000, configs, capital_gains_tax_rate_percent=capital_gains_tax_rate_percent)
+
+
+# 10 shares bought at 10 and 5 shares bought at 20, then 5 shares sold at 30.
+@pytest.mark.parametrize('lot_selection, capital_gain', [(fifo, 150 - 50), (hifo, 150 - 100)])
+def test_lot_selection(lot_selection, capital_gain):
+    position = EquityPosition(0, 0, lot_selection=lot_selection)
+    position.buy(dates[0], 100, AssetResult(10, 0))
+    position.buy(dates[1], 100, AssetResult(20, 0))
+    assert position.sell(dates[2], 150, AssetResult(30, 0)) == pytest.approx(capital_gain)
+    assert position.count == pytest.approx(10)
+
+
+def test_sell_lot_sells_the_given_lot():
+    position = EquityPosition(0, 0)
+    position.buy(dates[0], 100, AssetResult(10, 0))
+    position.buy(dates[1], 100, AssetResult(20, 0))
+    second_lot_id = max(position.lots)
+    assert position.sell_lot(dates[2], second_lot_id, 150, AssetResult(30, 0)) == pytest.approx(50)
+    assert second_lot_id not in position.lots
+    assert position.sell(dates[3], 150, AssetResult(30, 0)) == pytest.approx(100)
+
+
+def test_sell_lot_of_an_asset_without_lots():
+    portfolio = get_portfolio(fifo, 20)
+    with pytest.raises(ValueError, match='tax lots'):
+        portfolio.sell_lot(dates[0], tb10y, 0, 10, get_results(10))
+
+
+# A loss of 25 is carried forward and offsets the later gain of 50, so only 25 of it is taxed.
+def test_losses_are_carried_forward():
+    portfolio = get_portfolio(fifo, 20)
+    portfolio.buy(dates[0], sp500, 100, get_results(10))
+    portfolio.sell(dates[1], sp500, 25, get_results(5))
+    assert portfolio.capital_losses == pytest.approx(25)
+    assert portfolio.cash == pytest.approx(925)
+    portfolio.sell(dates[2], sp500, 100, get_results(20))
+    assert portfolio.capital_losses == 0
+    assert portfolio.cash == pytest.approx(1025 - 25 * 20 / 100)
+
+
+def test_gains_are_not_taxed_without_a_rate():
+    portfolio = get_portfolio(hifo, 0)
+    portfolio.buy(dates[0], sp500, 100, get_results(10))
+    portfolio.sell(dates[1], sp500, 200, get_results(20))
+    assert portfolio.cash == pytest.approx(1100)